@@ -1,13 +1,19 @@
 import torch
-import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 import os
+import sys
 import argparse
 import numpy as np
 
 # 같은 폴더에 있는 classifier_model.py에서 모델 구조 가져오기
-from model import get_animal_model
+from model import get_animal_model, mc_dropout_probs, mc_dropout_draw, predictive_entropy, attach_backbone
+
+# src/Animals-10/common 공유 모듈 경로 추가
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.sequential_mc import EntropyAccumulator, add_adaptive_args, adaptive_config, sequential_mc
+from common.weights import load_checkpoint_model
+from common.profiling import StartupTimer
 
 # --- [설정] ---
 # 학습된 모델 경로 (Docker 내부 경로)
@@ -19,6 +25,7 @@ CLASSES = ['butterfly', 'cat', 'chicken', 'cow', 'dog',
 
 # 하이퍼파라미터
 NUM_MC_SAMPLES = 30  # 불확실성 계산을 위한 반복 횟수
+MC_MODE = 'head'  # 'head': backbone 1회 + Dropout head만 샘플링, 'full': 전체 모델 반복 실행
 ENTROPY_THRESHOLD = 0.6  # OOD 판단 기준값
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -30,29 +37,15 @@ transform = transforms.Compose([
 ])
 
 
-def load_model():
+def load_model(startup=None):
     """학습된 모델을 로드합니다."""
     # pretrained=False: 구조만 가져오고 가중치는 내가 학습한 것을 씀
-    model = get_animal_model(num_classes=len(CLASSES), pretrained=False)
-
-    if not os.path.exists(MODEL_PATH):
-        raise FileNotFoundError(f"Model file not found at {MODEL_PATH}")
-
-    # 가중치 덮어쓰기
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-    model.to(DEVICE)
-    return model
-
+    # meta device에서 구조만 만들고(랜덤 초기화 생략) 변환된 .safetensors 가중치를 mmap으로 연결
+    return load_checkpoint_model(lambda: get_animal_model(num_classes=len(CLASSES), pretrained=False),
+                                 MODEL_PATH, DEVICE, startup)
 
-def enable_dropout(model):
-    """추론(Eval) 중에도 Dropout을 켜서 불확실성을 계산할 수 있게 함"""
-    model.eval()
-    for m in model.modules():
-        if m.__class__.__name__.startswith('Dropout'):
-            m.train()
 
-
-def predict_image(model, image_path):
+def predict_image(model, image_path, mc_mode=MC_MODE, adaptive=None):
     # 1. 이미지 로드
     try:
         image = Image.open(image_path).convert('RGB')
@@ -63,25 +56,26 @@ def predict_image(model, image_path):
     # 2. 전처리 및 배치 차원 추가 (3, 224, 224) -> (1, 3, 224, 224)
     img_tensor = transform(image).unsqueeze(0).to(DEVICE)
 
-    # 3. MC Dropout 활성화
-    enable_dropout(model)
-
-    # 4. 반복 추론 (MC Sampling)
-    mc_outputs = []
+    # 3~4. MC Dropout 반복 추론 (MC Sampling) -> (30, 1, 10)
+    # adaptive: 엔트로피가 임계값에서 충분히 멀어지면 조기 종료
     with torch.no_grad():
-        for _ in range(NUM_MC_SAMPLES):
-            logits = model(img_tensor)
-            probs = F.softmax(logits, dim=1)
-            mc_outputs.append(probs.cpu().numpy())
+        if adaptive is None:
+            mc_probs = mc_dropout_probs(model, img_tensor, NUM_MC_SAMPLES, mode=mc_mode)
+            # analytic: 샘플링 없이 결정적 forward 1회
+            num_samples = 1 if mc_mode == 'analytic' else NUM_MC_SAMPLES
+        else:
+            accumulator = EntropyAccumulator(1, len(CLASSES), DEVICE)
+            draw = mc_dropout_draw(model, img_tensor, mode=mc_mode)
+            _, n_used = sequential_mc(draw, accumulator, ENTROPY_THRESHOLD, **adaptive)
+            num_samples = n_used[0].item()
 
     # 5. 결과 계산
     # (30, 1, 10) -> (1, 10) 평균 확률
-    mc_probs = np.vstack(mc_outputs)
-    mean_prob = np.mean(mc_probs, axis=0)
+    mean_prob = mc_probs.mean(dim=0) if adaptive is None else accumulator.mean_probs()
 
     # Entropy (불확실성) 계산
-    epsilon = 1e-12
-    entropy = -np.sum(mean_prob * np.log(mean_prob + epsilon))
+    entropy = predictive_entropy(mean_prob)[0].item()
+    mean_prob = mean_prob[0].cpu().numpy()
 
     # 가장 높은 확률의 클래스 찾기
     pred_idx = np.argmax(mean_prob)
@@ -96,6 +90,7 @@ def predict_image(model, image_path):
     print("-" * 50)
     print(f"📂 Image      : {os.path.basename(image_path)}")
     print(f"📊 Entropy    : {entropy:.4f} (Threshold: {ENTROPY_THRESHOLD})")
+    print(f"🎲 MC Samples : {num_samples}")
     print(f"🏷️ Prediction : {pred_class} ({confidence * 100:.1f}%)")
     print(f"🎯 Result     : {result_str}")
     print("-" * 50)
@@ -104,8 +99,21 @@ def predict_image(model, image_path):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Detect OOD from a single image")
     parser.add_argument('--image', type=str, required=True, help="Path to the image file")
+    parser.add_argument('--mc-mode', choices=['head', 'full', 'analytic'], default=MC_MODE,
+                        help="head: run the backbone once and sample only the dropout head; full: legacy full passes; "
+                             "analytic: deterministic moment propagation, no sampling")
+    parser.add_argument('--backbone', type=str, default=None,
+                        help="Run the backbone from an export.py artifact (INT8 / TorchScript .pt or .onnx)")
+    add_adaptive_args(parser, max_samples=NUM_MC_SAMPLES)
     args = parser.parse_args()
-
-    # 모델 로드 및 추론 실행
-    model = load_model()
-    predict_image(model, args.image)
\ No newline at end of file
+    if args.adaptive and args.mc_mode == 'analytic':
+        parser.error("--adaptive samples sequentially and cannot be combined with --mc-mode analytic")
+    startup = StartupTimer()
+
+    # 모델 로드 및 추론 실행 (--backbone: export된 backbone + 기존 MC Dropout head)
+    model = load_model(startup)
+    if args.backbone:
+        attach_backbone(model, args.backbone)
+    startup.report()
+    predict_image(model, args.image, mc_mode=args.mc_mode,
+                  adaptive=adaptive_config(args) if args.adaptive else None)
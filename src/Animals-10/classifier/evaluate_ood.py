@@ -3,36 +3,71 @@ import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 import os
-import shutil
-import csv
+import sys
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 from tqdm import tqdm
-from torch.utils.data import Dataset, DataLoader
-from model import get_animal_model
+from torch.utils.data import Dataset, DataLoader, Subset
+from model import (get_animal_model, get_backbone, mc_dropout_probs, mc_dropout_draw, predictive_entropy,
+                   attach_backbone)
+from feature_bank import BANK_DIR, KNN_K, SCORERS, FeatureBank
+
+# src/Animals-10/common 공유 모듈 경로 추가
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import DEFAULT_CACHE_DIR, file_checksum, load_cached_dataset, normalize_batch
+from common.score_store import ScoreStore
+from common.sequential_mc import EntropyAccumulator, add_adaptive_args, adaptive_config, sequential_mc
+from common.checkpoint import EvalCheckpoint, add_checkpoint_args, exclude_paths, resolve_run_dir
+from common.profiling import NULL_PROFILER, StageProfiler, StartupTimer, add_profiling_args
+from common.weights import load_checkpoint_model
+from common.student import UncertaintyStudent, student_predict
+from common.sorted_output import SortedImageWriter, add_sorted_output_args
+from common.fast_decode import FastImageLoader, add_fast_decode_args, dataset_paths
+from common.result_sink import add_result_args, export_csv, histograms, read_columns
+from common.streaming_metrics import StreamingMetrics, add_metrics_args, labelled_batches, live_metrics_from_args
+from common.autotune import add_autotune_args, resolve_settings
+from common.worker_pool import SharedModelPool, add_pool_args
+from common.file_manifest import add_manifest_args, fan_out, manifest_from_args, split_duplicates, write_groups
+from common.sharding import (add_shard_args, configure_worker, launch_local_shards, merge_shard_sinks,
+                             run_id_from_dir, shard_indices, shard_sink_path, strip_launcher_args)
 
 # --- [설정] ---
 # ... (설정 부분은 변경 없음) ...
 MODEL_PATH = '/app/models/Animals-10/classifier/animals10_resnet18.pth'
+STUDENT_PATH = '/app/models/Animals-10/student/uncertainty_student.pth'  # pipeline/distill.py 산출물
 
 ID_DATA_DIR = '/app/data/animals'
 OOD_DATA_DIR = '/app/data/pokemon'
 
 BASE_RESULT_DIR = '/app/results/Animals-10/classifier'
+# run 간 공유되는 점수 저장소 (model hash, 설정, 이미지 content hash -> 점수)
+SCORE_STORE_PATH = os.path.join(BASE_RESULT_DIR, 'score_store.sqlite')
 
 CLASSES = ['butterfly', 'cat', 'chicken', 'cow', 'dog',
            'elephant', 'horse', 'sheep', 'spider', 'squirrel']
 NUM_MC_SAMPLES = 30
+MC_MODE = 'head'  # 'head': backbone 1회 + Dropout head만 샘플링, 'full': 전체 모델 반복 실행
 ENTROPY_THRESHOLD = 0.6
-BATCH_SIZE = 64
+BATCH_SIZE = 64  # 기본값: common/autotune.py가 이 머신에서 측정한 값이 있으면 그 값을 사용
 NUM_WORKERS = 4
+ID_LABEL = "ID(Animal)"
+OOD_LABEL = "OOD(Pokemon)"
+LABEL_NAMES = np.array([ID_LABEL, OOD_LABEL])  # result sink label 0 / 1
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+IMAGE_SIZE = 224
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')  # OODDataset와 --cache-dir 경로가 같은 파일을 평가하도록 공유
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+
+# 이미지별 결과 sink 컬럼 (CSV는 --export-csv 시 실행 종료 후 생성)
+RESULT_SCHEMA = {'path': 'str', 'label': 'int8', 'score': 'float32', 'pred': 'int16', 'ood': 'bool',
+                 'mc_samples': 'int16'}
 
 # --- 전처리, Dataset 정의, load_trained_model, get_next_run_dir 함수들은 변경 없음 ---
 transform = transforms.Compose([
-    transforms.Resize((224, 224)),
+    transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
     transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    transforms.Normalize(mean=NORM_MEAN, std=NORM_STD)
 ])
 
 
@@ -52,15 +87,21 @@ def get_next_run_dir(base_dir):
 
 # --- Dataset 정의 ---
 class OODDataset(Dataset):
-    def __init__(self, root_dir, transform=None):
+    def __init__(self, root_dir, transform=None, manifest=None):
         self.transform = transform
         self.samples = []
-        valid_extensions = ('.jpg', '.jpeg', '.png')
+        if manifest is not None:
+            # 파일 manifest의 목록 사용 (os.walk 없음, 변경된 디렉터리만 다시 나열)
+            self.samples = [(path, file) for path, _, file in manifest.samples
+                            if file.lower().endswith(IMAGE_EXTENSIONS)]
+            return
         for root, _, files in os.walk(root_dir):
             for file in files:
-                if file.lower().endswith(valid_extensions):
+                if file.lower().endswith(IMAGE_EXTENSIONS):
                     path = os.path.join(root, file)
                     self.samples.append((path, file))
+        # os.walk 순서는 파일 시스템마다 다르므로 정렬 (shard_indices가 모든 shard에서 같은 목록을 나누도록)
+        self.samples.sort()
 
     def __len__(self):
         return len(self.samples)
@@ -76,120 +117,346 @@ class OODDataset(Dataset):
             return torch.zeros(3, 224, 224), "", ""
 
 
-def load_trained_model():
-    model = get_animal_model(num_classes=len(CLASSES), pretrained=False)
-    if not os.path.exists(MODEL_PATH):
-        raise FileNotFoundError(f"Model file not found at {MODEL_PATH}")
-    model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-    model.to(DEVICE)
-    return model
+def load_trained_model(startup=None):
+    # meta device에서 구조만 생성(랜덤 초기화 생략) 후 mmap된 가중치 연결 (첫 로드 시 .pth -> .safetensors 변환)
+    return load_checkpoint_model(lambda: get_animal_model(num_classes=len(CLASSES), pretrained=False),
+                                 MODEL_PATH, DEVICE, startup)
+
+
+# --- autotune probe용 점수 함수 (spawn된 probe 프로세스에서 모델을 다시 로드) ---
+def autotune_scorer(scorer, mc_mode, student_path, feature_bank, knn_k, backbone):
+    # run_evaluation()과 같이 eval 모드로 측정 (BatchNorm이 배치 통계를 쓰지 않도록)
+    if scorer == 'student':
+        model = load_checkpoint_model(UncertaintyStudent, student_path, DEVICE).eval()
+        return lambda images: student_batch(model, prepare_batch(images))
+    model = load_trained_model().eval()
+    if backbone:
+        attach_backbone(model, backbone)
+    if scorer in SCORERS:
+        bank = FeatureBank(feature_bank, MODEL_PATH)
+        return lambda images: feature_bank_batch(model, prepare_batch(images), bank, scorer, knn_k)
+    return lambda images: score_batch(model, prepare_batch(images), mc_mode)
+
+
+# --- 공유 메모리 worker pool용 점수 함수 (spawn된 worker가 parent의 공유 가중치로 실행) ---
+def pool_score(model, images, scorer, mc_mode, adaptive):
+    images = prepare_batch(images)
+    if scorer == 'student':
+        return student_batch(model, images)
+    return score_batch(model, images, mc_mode, adaptive)
+
+
+def prepare_batch(images):
+    """tensor cache의 uint8 배치는 정규화, DataLoader의 float 배치는 그대로"""
+    if images.dtype == torch.uint8:
+        return normalize_batch(images, NORM_MEAN, NORM_STD)
+    return images
+
+
+# --- 점수 저장소 조회: 이미 점수가 있는 이미지는 추론에서 제외 ---
+def split_by_score_store(dataset, score_store):
+    """(추론할 dataset, [(path, filename, 저장된 값), ...]) 반환"""
+    if score_store is None:
+        return dataset, []
+    # shard 모드에서는 dataset이 Subset으로 들어옴
+    if isinstance(dataset, Subset):
+        base, indices = dataset.dataset, list(dataset.indices)
+    else:
+        base, indices = dataset, list(range(len(dataset)))
+    paths = [base.samples[i][0] for i in indices]
+    hits, misses = score_store.partition(paths)
+    stored = [(paths[i], os.path.basename(paths[i]), hits[i]) for i in sorted(hits)]
+    print(f">>> Score store: {len(stored)} reused, {len(misses)} to score")
+    return Subset(base, [indices[i] for i in misses]), stored
+
+
+# --- 배치 점수 계산 ---
+def score_batch(model, images, mc_mode=MC_MODE, adaptive=None, profiler=NULL_PROFILER):
+    """
+    (엔트로피 [B], 평균 확률 [B, C], 사용한 MC 샘플 수 [B]) 반환
+    adaptive: sequential_mc 설정 dict -> 결과가 임계값 한쪽으로 확실해지면 이미지별로 샘플링 조기 종료
+    """
+    if mc_mode == 'analytic':
+        # 샘플링 없는 해석적 근사: 결정적 forward 1회 -> 평균 확률 [B, C]
+        with profiler.stage('analytic_forward'):
+            mc_probs = mc_dropout_probs(model, images, NUM_MC_SAMPLES, mode=mc_mode)[0]
+        with profiler.stage('entropy'):
+            entropy = predictive_entropy(mc_probs)
+        return entropy, mc_probs, torch.ones(images.shape[0], dtype=torch.long)
+
+    if adaptive is None:
+        # MC Dropout 샘플링 [S, B, C] -> 평균 [B, C]
+        with profiler.stage('mc_forward'):
+            probs = mc_dropout_probs(model, images, NUM_MC_SAMPLES, mode=mc_mode)
+        with profiler.stage('entropy'):
+            mc_probs = probs.mean(dim=0)
+            entropy = predictive_entropy(mc_probs)
+        n_samples = torch.full((images.shape[0],), NUM_MC_SAMPLES, dtype=torch.long)
+        return entropy, mc_probs, n_samples
+
+    # 적응형 모드는 forward와 엔트로피 추정이 chunk마다 번갈아 실행되므로 하나의 구간으로 측정
+    with profiler.stage('mc_adaptive'):
+        accumulator = EntropyAccumulator(images.shape[0], len(CLASSES), images.device)
+        draw = mc_dropout_draw(model, images, mode=mc_mode)
+        entropy, n_samples = sequential_mc(draw, accumulator, ENTROPY_THRESHOLD, **adaptive)
+    return entropy, accumulator.mean_probs(), n_samples
+
+
+# --- feature bank 점수 (kNN / Mahalanobis) ---
+def feature_bank_batch(model, images, bank, scorer, k=KNN_K, paths=None, profiler=NULL_PROFILER):
+    """
+    결정적 forward 1회: penultimate feature -> feature bank 거리 (클수록 OOD)
+    (점수 [B], Dropout 없는 fc 확률 [B, C], 사용한 MC 샘플 수 [B] = 1) 반환
+    """
+    with profiler.stage('backbone'):
+        features = get_backbone(model)(images)
+    with profiler.stage('bank_search'):
+        scores = bank.score(features, scorer, k=k, paths=paths)
+    probs = F.softmax(model.fc(features), dim=1)  # eval 모드에서 Dropout은 identity
+    return scores, probs, torch.ones(len(scores), dtype=torch.long)
+
+
+# --- distill된 student 점수 (MC 30회 엔트로피를 1회 forward로 근사) ---
+def student_batch(student, images, profiler=NULL_PROFILER):
+    """
+    정규화된 224 입력을 [0, 1] 범위로 되돌려 student에 전달 (student 내부에서 64x64로 리사이즈)
+    (예측 엔트로피 [B], 클래스 확률 [B, C], 사용한 MC 샘플 수 [B] = 1) 반환
+    """
+    mean = torch.tensor(NORM_MEAN, device=images.device).view(1, -1, 1, 1)
+    std = torch.tensor(NORM_STD, device=images.device).view(1, -1, 1, 1)
+    with profiler.stage('student'):
+        outputs = student_predict(student, images * std + mean)
+    return outputs['entropy'], outputs['probs'], torch.ones(images.shape[0], dtype=torch.long)
 
 
 # --- 배치 처리 및 저장 ---
-def process_dataloader(model, dataloader, label_type, csv_writer, run_dir):
-    scores = []
+def process_dataloader(model, sources, sink, sorter, mc_mode=MC_MODE, score_store=None, adaptive=None,
+                       checkpoint=None, profiler=NULL_PROFILER, score_fn=None, threshold=ENTROPY_THRESHOLD,
+                       live=None, pool=None, duplicates=None):
+    """
+    sources: [(label_type, dataloader, 저장소에서 재사용한 점수), ...] (ID, OOD 순)
+    score_fn(images, paths) -> (점수, 확률, 샘플 수); None이면 MC Dropout 엔트로피
+    pool: SharedModelPool -> 배치를 worker 프로세스들이 나누어 점수 계산 (결과는 입력 순서대로)
+    duplicates: {대표 이미지 경로: [중복 이미지 경로, ...]} -> 대표 이미지의 결과를 중복 이미지에도 기록 (--dedup)
+    live: LiveMetrics -> 배치마다 실시간 지표 갱신, --early-stop 시 ID / OOD 배치를 번갈아 처리하고 수렴하면 중단
+    """
+    totals = {label_type: [0, 0] for label_type, _, _ in sources}  # label_type -> [MC 샘플 합, 이미지 수]
     model.eval()
-    # MC Dropout 활성화
-    for m in model.modules():
-        if m.__class__.__name__.startswith('Dropout'):
-            m.train()
-
-    img_save_dir = os.path.join(run_dir, 'sorted_images')
-    path_ood = os.path.join(img_save_dir, 'Predicted_OOD')
-    path_id = os.path.join(img_save_dir, 'Predicted_ID')
-    os.makedirs(path_ood, exist_ok=True)
-    os.makedirs(path_id, exist_ok=True)
-
-    print(f"Processing {label_type}...")
-    with torch.no_grad():
-        for images, paths, filenames in tqdm(dataloader):
-            images = images.to(DEVICE)
-            if images.sum() == 0: continue
-
-            mc_outputs = []
-            for _ in range(NUM_MC_SAMPLES):
-                logits = model(images)
-                probs = F.softmax(logits, dim=1)
-                mc_outputs.append(probs.unsqueeze(0))
-
-            mc_probs = torch.cat(mc_outputs, dim=0).mean(dim=0)
-            epsilon = 1e-12
-            entropy_batch = -torch.sum(mc_probs * torch.log(mc_probs + epsilon), dim=1)
-            entropy_list = entropy_batch.cpu().numpy().tolist()
-            pred_indices = torch.argmax(mc_probs, dim=1).cpu().numpy()
-
-            scores.extend(entropy_list)
-
-            for i in range(len(paths)):
-                score = entropy_list[i]
-                file_path = paths[i]
-                file_name = filenames[i]
-                pred_class_name = CLASSES[pred_indices[i]]
 
-                is_ood = score > ENTROPY_THRESHOLD
-                prediction = "OOD" if is_ood else "ID"
-
-                csv_writer.writerow([file_name, label_type, score, prediction, pred_class_name, file_path])
-
-                dest_folder = path_ood if is_ood else path_id
-                dest_name = f"[{score:.4f}]_{prediction}_{file_name}"
-                shutil.copy(file_path, os.path.join(dest_folder, dest_name))
-    return scores
-
-
-def main():
-    print(f"Using Device: {DEVICE}")
-    model = load_trained_model()
-
-    # 실행 폴더 생성 (run_X)
-    run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
-    csv_path = os.path.join(run_dir, f'ood_results_run_{run_id}.csv')
-
-    print(f">>> Loading datasets...")
-    id_dataset = OODDataset(ID_DATA_DIR, transform=transform)
-    ood_dataset = OODDataset(OOD_DATA_DIR, transform=transform)
-
-    id_loader = DataLoader(id_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
-    ood_loader = DataLoader(ood_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
-
-    if len(id_dataset) == 0:
-        print("Error: No ID data found.")
-        return
-
-    f = open(csv_path, 'w', newline='', encoding='utf-8')
-    writer = csv.writer(f)
-    writer.writerow(['Filename', 'True_Label', 'Entropy_Score', 'Final_Prediction', 'Pred_Class', 'Full_Path'])
+    def emit(label_type, scores, pred_indices, n_samples, file_paths, file_names):
+        """기록한 경로 목록 반환 (중복 그룹 멤버 포함)"""
+        if duplicates:
+            file_paths, scores, pred_indices, n_samples = fan_out(duplicates, file_paths, scores, pred_indices,
+                                                                  n_samples)
+            file_names = [os.path.basename(file_path) for file_path in file_paths]
+        label = 0 if label_type == ID_LABEL else 1
+        is_ood = scores > threshold
+        # 배치 단위로 타입이 지정된 컬럼에 추가 (행별 문자열 포맷 없음)
+        with profiler.stage('result_write'):
+            sink.append(path=file_paths, label=np.full(len(scores), label), score=scores, pred=pred_indices,
+                        ood=is_ood, mc_samples=n_samples)
+        if live is not None:
+            live.update(scores, label)
+        totals[label_type][0] += int(np.sum(n_samples))
+        totals[label_type][1] += len(scores)
+        if sorter.mode == 'none':
+            return file_paths
+
+        # sorted_images 기록은 백그라운드 writer가 처리 (추론 루프를 막지 않음)
+        with profiler.stage('sorted_output'):
+            for score, ood, file_path, file_name in zip(scores, is_ood, file_paths, file_names):
+                prediction = "OOD" if ood else "ID"
+                dest_folder = 'Predicted_OOD' if ood else 'Predicted_ID'
+                sorter.submit(file_path, dest_folder, f"[{score:.4f}]_{prediction}_{file_name}")
+        return file_paths
+
+    # 저장소에 이미 있는 점수는 추론 없이 그대로 기록
+    for label_type, _, stored in sources:
+        if not stored:
+            continue
+        written = emit(label_type, np.array([values['entropy'] for _, _, values in stored]),
+                       np.array([values['pred'] for _, _, values in stored]),
+                       np.array([values.get('samples', NUM_MC_SAMPLES) for _, _, values in stored]),
+                       [file_path for file_path, _, _ in stored], [file_name for _, file_name, _ in stored])
+        if checkpoint is not None:
+            checkpoint.update(written)
+
+    loaders = [dataloader for _, dataloader, _ in sources]
+    print(f"Processing {' + '.join(label_type for label_type, _, _ in sources)}...")
+    batches = labelled_batches(loaders, live is not None and live.interleaved)
+
+    def scored():
+        """(source, paths, filenames, (점수, 확률, 샘플 수))를 입력 순서대로 생성"""
+        # profiler.iterate: DataLoader 대기 시간(data_wait) 측정
+        batch_iter = profiler.iterate(tqdm(batches, total=sum(len(l) for l in loaders)))
+        if pool is not None:
+            # 정규화와 점수 계산은 worker에서 실행 (uint8 캐시 배치는 그대로 공유 메모리로 전달)
+            items = (((source, paths, filenames), images) for source, (images, paths, filenames) in batch_iter
+                     if images.sum() != 0)
+            for (source, paths, filenames), outputs in pool.map(items):
+                yield source, paths, filenames, outputs
+            return
+        for source, (images, paths, filenames) in batch_iter:
+            with profiler.stage('h2d'):
+                images = images.to(DEVICE)
+            if images.sum() == 0: continue
+            # tensor cache 사용 시 uint8 배치를 여기서 한 번에 정규화
+            if images.dtype == torch.uint8:
+                with profiler.stage('normalize'):
+                    images = normalize_batch(images, NORM_MEAN, NORM_STD)
 
-    print(f"\n=== Starting Evaluation (Run {run_id}) ===")
-    id_scores = process_dataloader(model, id_loader, "ID(Animal)", writer, run_dir)
-    ood_scores = process_dataloader(model, ood_loader, "OOD(Pokemon)", writer, run_dir)
-    f.close()
+            if score_fn is None:
+                yield source, paths, filenames, score_batch(model, images, mc_mode, adaptive, profiler)
+            else:
+                yield source, paths, filenames, score_fn(images, paths)
 
-    if not id_scores or not ood_scores:
+    with torch.no_grad():
+        for source, paths, filenames, (entropy_batch, mc_probs, n_samples) in scored():
+            label_type = sources[source][0]
+            with profiler.stage('d2h'):
+                entropy_array = entropy_batch.cpu().numpy()
+                pred_indices = torch.argmax(mc_probs, dim=1).cpu().numpy()
+                sample_array = n_samples.cpu().numpy()
+
+            written = emit(label_type, entropy_array, pred_indices, sample_array, paths, filenames)
+            if score_store is not None:
+                with profiler.stage('score_store'):
+                    for i in range(len(paths)):
+                        if paths[i]:
+                            score_store.put(paths[i], {'entropy': float(entropy_array[i]),
+                                                       'pred': int(pred_indices[i]),
+                                                       'samples': int(sample_array[i])})
+                    score_store.commit()
+            if checkpoint is not None:
+                with profiler.stage('checkpoint'):
+                    checkpoint.update(written)
+
+            profiler.count('images', len(paths))
+            profiler.count('mc_samples', int(sample_array.sum()))
+            profiler.gauge('queue_depth', sorter.pending(), queue='sorted_output')
+            profiler.step()
+            if live is not None and live.step():
+                break
+
+    for label_type, (sample_total, image_total) in totals.items():
+        if image_total:
+            print(f"    {label_type}: mean MC samples per image {sample_total / image_total:.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate MC Dropout OOD detection on the full ID/OOD datasets")
+    parser.add_argument('--mc-mode', choices=['head', 'full', 'analytic'], default=MC_MODE,
+                        help="head: run the backbone once and sample only the dropout head; full: legacy full passes; "
+                             "analytic: deterministic moment propagation, no sampling")
+    parser.add_argument('--scorer', choices=('entropy',) + SCORERS + ('student',), default='entropy',
+                        help="entropy: MC Dropout predictive entropy; knn / mahalanobis: one deterministic pass "
+                             "scored against the feature bank (build it with feature_bank.py); student: the "
+                             "entropy predicted in one pass by the distilled student (pipeline/distill.py)")
+    parser.add_argument('--student', type=str, default=STUDENT_PATH)
+    parser.add_argument('--feature-bank', type=str, default=BANK_DIR)
+    parser.add_argument('--knn-k', type=int, default=KNN_K)
+    parser.add_argument('--score-threshold', type=float, default=None,
+                        help="OOD threshold (default: 0.6 for entropy, the bank's 95%% ID TPR threshold otherwise)")
+    parser.add_argument('--backbone', type=str, default=None,
+                        help="Run the backbone from an export.py artifact (INT8 / TorchScript .pt or .onnx); "
+                             "the MC Dropout head stays FP32 and stochastic")
+    parser.add_argument('--cache-dir', nargs='?', const=DEFAULT_CACHE_DIR, default=None,
+                        help=f"Read images from the preprocessed uint8 tensor cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--score-store', nargs='?', const=SCORE_STORE_PATH, default=None,
+                        help=f"Reuse scores of unchanged images across runs (default: {SCORE_STORE_PATH})")
+    add_adaptive_args(parser, max_samples=NUM_MC_SAMPLES)
+    add_shard_args(parser)
+    add_checkpoint_args(parser)
+    add_sorted_output_args(parser)
+    add_profiling_args(parser)
+    add_result_args(parser)
+    add_metrics_args(parser)
+    add_fast_decode_args(parser)
+    add_autotune_args(parser, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS)
+    add_pool_args(parser)
+    add_manifest_args(parser)
+    args = parser.parse_args()
+    if args.adaptive and args.scorer != 'entropy':
+        parser.error("--adaptive only applies to the MC Dropout entropy scorer")
+    if args.adaptive and args.mc_mode == 'analytic':
+        parser.error("--adaptive samples sequentially and cannot be combined with --mc-mode analytic")
+    if args.early_stop is not None and args.metrics_every <= 0:
+        parser.error("--early-stop needs live metrics (--metrics-every > 0)")
+    if args.fast_decode and args.cache_dir:
+        parser.error("--fast-decode and --cache-dir are alternatives (the cache is already decoded)")
+    if args.backbone and args.scorer == 'student':
+        parser.error("--backbone replaces the ResNet18 backbone, which the student does not use")
+    if args.pool_workers > 1:
+        if DEVICE.type != 'cpu':
+            parser.error("--pool-workers shares the weights between CPU processes; a GPU scores in one process")
+        if args.scorer in SCORERS or args.backbone:
+            parser.error("--pool-workers supports the entropy and student scorers with the FP32 backbone")
+    return args
+
+
+# --- CSV 내보내기: sink chunk -> CSV 컬럼 ---
+def csv_header(score_name='Entropy'):
+    return ['Filename', 'True_Label', 'Entropy_Score' if score_name == 'Entropy' else 'OOD_Score',
+            'Final_Prediction', 'Pred_Class', 'Full_Path', 'MC_Samples']
+
+
+def csv_columns(chunk):
+    return [[os.path.basename(p) for p in chunk['path']], LABEL_NAMES[chunk['label']].tolist(),
+            np.char.mod('%.6f', chunk['score']).tolist(), np.where(chunk['ood'], "OOD", "ID").tolist(),
+            np.asarray(CLASSES)[chunk['pred']].tolist(), chunk['path'].tolist(), chunk['mc_samples'].tolist()]
+
+
+# --- 결과 요약 (평균 점수 + AUROC + 히스토그램) ---
+def write_report(run_dir, run_id, sink_dir, threshold=ENTROPY_THRESHOLD, score_name='Entropy'):
+    # 지표 계산에 필요한 숫자 컬럼만 읽음 (경로 등 문자열 컬럼은 로드하지 않음)
+    columns = read_columns(sink_dir, ['label', 'score'])
+    id_scores = columns['score'][columns['label'] == 0]
+    ood_scores = columns['score'][columns['label'] == 1]
+    if not len(id_scores) or not len(ood_scores):
         print("Error: Not enough data.")
         return
 
-    # 1. 평균 엔트로피 계산
+    # 1. 평균 점수 계산
     mean_id_entropy = np.mean(id_scores)
     mean_ood_entropy = np.mean(ood_scores)
 
+    # AUROC / AUPR (OOD = positive): scorer 간 비교용 (exact 모드는 sklearn과 같은 값)
+    # 95% TPR에서의 FPR, TPR - FPR이 최대인 임계값 (고정 임계값 대신 참고용)
+    y_true, y_scores = columns['label'], columns['score']
+    sweep = StreamingMetrics(exact=True)
+    sweep.update(y_scores, y_true)
+    operating = sweep.summary()
+    auroc, aupr = operating['auroc'], operating['aupr']
+
     # 2. 결과 텍스트 파일 저장
     results_txt_path = os.path.join(run_dir, f'mean_entropy_run_{run_id}.txt')
     with open(results_txt_path, 'w') as txt_file:
         txt_file.write(f"--- OOD Evaluation Summary (Run {run_id}) ---\n")
-        txt_file.write(f"ID (Animals) Mean Entropy: {mean_id_entropy:.4f}\n")
-        txt_file.write(f"OOD (Pokemon) Mean Entropy: {mean_ood_entropy:.4f}\n")
-        txt_file.write(f"Entropy Threshold Used: {ENTROPY_THRESHOLD:.4f}\n")
-
-    print(f"\nMean entropy summary saved to: {results_txt_path}")
-
-    # 3. 그래프 저장
+        txt_file.write(f"ID (Animals) Mean {score_name}: {mean_id_entropy:.4f}\n")
+        txt_file.write(f"OOD (Pokemon) Mean {score_name}: {mean_ood_entropy:.4f}\n")
+        txt_file.write(f"{score_name} Threshold Used: {threshold:.4f}\n")
+        txt_file.write(f"AUROC: {auroc:.5f}\n")
+        txt_file.write(f"AUPR: {aupr:.5f}\n")
+        txt_file.write(f"FPR at 95% TPR: {operating['fpr_at_95_tpr']:.5f}\n")
+        txt_file.write(f"Best {score_name} Threshold: {operating['best_threshold']:.4f} "
+                       f"(TPR {operating['best_tpr']:.4f}, FPR {operating['best_fpr']:.4f})\n")
+
+    print(f"\nAUROC: {auroc:.5f}, AUPR: {aupr:.5f}, FPR@95TPR: {operating['fpr_at_95_tpr']:.5f}, "
+          f"best threshold: {operating['best_threshold']:.4f}")
+    print(f"Mean {score_name.lower()} summary saved to: {results_txt_path}")
+
+    # 3. 그래프 저장 (히스토그램은 sink에서 chunk 단위로 집계)
+    # matplotlib은 시작 시간을 줄이기 위해 리포트 작성 시에만 import
+    import matplotlib.pyplot as plt
+    edges, counts = histograms(sink_dir, 'score', by='label', bins=50)
+    widths = np.diff(edges)
     plt.figure(figsize=(10, 6))
-    plt.hist(id_scores, bins=50, alpha=0.5, label='ID: Animals', color='blue', density=True)
-    plt.hist(ood_scores, bins=50, alpha=0.5, label='OOD: Pokemon', color='red', density=True)
-    plt.axvline(x=ENTROPY_THRESHOLD, color='black', linestyle='--', label=f'Threshold ({ENTROPY_THRESHOLD})')
+    for label, name, color in ((0, 'ID: Animals', 'blue'), (1, 'OOD: Pokemon', 'red')):
+        plt.stairs(counts[label] / (counts[label].sum() * widths), edges, fill=True, alpha=0.5, label=name,
+                   color=color)
+    plt.axvline(x=threshold, color='black', linestyle='--', label=f'Threshold ({threshold:.4g})')
 
-    plt.xlabel('Uncertainty (Entropy)')
+    plt.xlabel('Uncertainty (Entropy)' if score_name == 'Entropy' else f'OOD Score ({score_name})')
     plt.ylabel('Density')
     plt.title(f'OOD Detection Result (Run {run_id})\nID Mean: {mean_id_entropy:.4f}, OOD Mean: {mean_ood_entropy:.4f}')
     plt.legend()
@@ -201,5 +468,224 @@ def main():
     print(f"    Saved to: {run_dir}")
 
 
+def finish_run(run_dir, run_id, sink_dir, threshold, score_name, export):
+    write_report(run_dir, run_id, sink_dir, threshold, score_name)
+    if export:
+        export_csv(sink_dir, os.path.normpath(sink_dir) + '.csv', csv_header(score_name), csv_columns)
+
+
+# --- shard 결과 병합: part sink들 -> 하나의 sink + 요약 + 히스토그램 ---
+def merge_run(run_dir, threshold=ENTROPY_THRESHOLD, score_name='Entropy', export=False):
+    run_id = run_id_from_dir(run_dir)
+    sink_dir = os.path.join(run_dir, f'ood_results_run_{run_id}')
+    chunks = merge_shard_sinks(run_dir, sink_dir)
+    print(f">>> Merged {chunks} shard chunks into {sink_dir}")
+    finish_run(run_dir, run_id, sink_dir, threshold, score_name, export)
+
+
+def main():
+    args = parse_args()
+    startup = StartupTimer()
+    configure_worker(args.threads, args.cpus)
+
+    # scorer별 임계값: entropy는 고정값, kNN / Mahalanobis는 feature bank 생성 시 계산된 95% TPR 값
+    # student은 MC Dropout 엔트로피를 회귀하므로 같은 임계값 사용
+    # bank는 FP32 MODEL_PATH로 추출 (--backbone export도 같은 checkpoint에서 나오므로 MODEL_PATH로 확인)
+    bank = FeatureBank(args.feature_bank, MODEL_PATH) if args.scorer in SCORERS else None
+    threshold = args.score_threshold
+    if threshold is None:
+        threshold = ENTROPY_THRESHOLD if bank is None else bank.threshold(args.scorer)
+    score_name = 'Entropy' if bank is None else args.scorer.capitalize()
+
+    if args.merge:
+        merge_run(args.merge, threshold, score_name, args.export_csv)
+        return
+
+    if args.workers > 1:
+        # 로컬 shard 프로세스 N개 실행 (프로세스별 CPU 고정 + thread 수 설정) 후 병합
+        # --resume은 각 shard 프로세스에 그대로 전달되어 shard별 checkpoint에서 이어서 실행
+        if args.resume:
+            run_dir = resolve_run_dir(BASE_RESULT_DIR, args.resume)
+        else:
+            run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
+        launch_local_shards(os.path.abspath(__file__), strip_launcher_args(sys.argv[1:]),
+                            args.workers, run_dir, args.threads)
+        merge_run(run_dir, threshold, score_name, args.export_csv)
+        return
+
+    print(f"Using Device: {DEVICE}")
+    if args.scorer == 'student':
+        # teacher(ResNet18)는 로드하지 않음: student 단독으로 점수 계산
+        model = load_checkpoint_model(UncertaintyStudent, args.student, DEVICE, startup)
+        print(f">>> Using distilled student: {args.student}")
+    else:
+        model = load_trained_model(startup)
+    if args.backbone:
+        # export.py 산출물(INT8 / TorchScript / ONNX)로 backbone 교체, head는 그대로
+        attach_backbone(model, args.backbone)
+        print(f">>> Using exported backbone: {args.backbone}")
+
+    # 실행 폴더 생성 (run_X), 공유 run 폴더 사용 (multi-node shard) 또는 중단된 run 이어서 실행
+    if args.run_dir:
+        run_dir, run_id = args.run_dir, run_id_from_dir(args.run_dir)
+        os.makedirs(run_dir, exist_ok=True)
+    elif args.resume:
+        run_dir = resolve_run_dir(BASE_RESULT_DIR, args.resume)
+        run_id = run_id_from_dir(run_dir)
+    else:
+        run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
+    sharded = args.num_shards > 1
+    if sharded:
+        sink_dir = shard_sink_path(run_dir, args.num_shards, args.shard_index)
+    else:
+        sink_dir = os.path.join(run_dir, f'ood_results_run_{run_id}')
+
+    print(f">>> Loading datasets...")
+    # --manifest / --dedup: 파일 목록, 크기, mtime, content hash, perceptual hash를 증분 갱신되는 manifest에서 읽음
+    id_manifest = manifest_from_args(args, ID_DATA_DIR)
+    ood_manifest = manifest_from_args(args, OOD_DATA_DIR)
+    if args.cache_dir:
+        # 디코딩/리사이즈 결과를 캐시에서 읽음 (변경된 이미지만 다시 디코딩)
+        # OODDataset과 같은 확장자만 평가 (캐시는 ImageFolder 확장자 전체를 보관)
+        id_dataset = load_cached_dataset(ID_DATA_DIR, IMAGE_SIZE, cache_dir=args.cache_dir, manifest=id_manifest,
+                                         extensions=IMAGE_EXTENSIONS)
+        ood_dataset = load_cached_dataset(OOD_DATA_DIR, IMAGE_SIZE, cache_dir=args.cache_dir,
+                                          manifest=ood_manifest, extensions=IMAGE_EXTENSIONS)
+    else:
+        id_dataset = OODDataset(ID_DATA_DIR, transform=transform, manifest=id_manifest)
+        ood_dataset = OODDataset(OOD_DATA_DIR, transform=transform, manifest=ood_manifest)
+
+    if len(id_dataset) == 0:
+        print("Error: No ID data found.")
+        return
+
+    # batch 크기 / thread / DataLoader worker 수: 플래그 > 이 머신(host fingerprint)에 저장된 autotune 결과 > 새로 측정
+    # shard 프로세스는 저장된 결과만 재사용 (같은 머신에서 여러 shard가 동시에 측정하지 않도록)
+    key_parts = ['classifier', args.scorer] + ([args.mc_mode] if args.scorer == 'entropy' else [])
+    if args.adaptive:
+        key_parts.append('adaptive')
+    if args.backbone:
+        key_parts.append(os.path.basename(args.backbone))
+    key_parts.append('cache' if args.cache_dir else 'fast_decode' if args.fast_decode else 'decode')
+    settings = resolve_settings(args, '/'.join(key_parts), autotune_scorer,
+                                (args.scorer, args.mc_mode, args.student, args.feature_bank, args.knn_k, args.backbone),
+                                id_dataset, DEVICE, probe_loader=not args.fast_decode, allow_probe=not sharded)
+
+    if sharded:
+        # 정렬된 파일 목록의 연속 구간을 shard별로 결정적으로 분할
+        id_dataset = Subset(id_dataset, shard_indices(len(id_dataset), args.num_shards, args.shard_index))
+        ood_dataset = Subset(ood_dataset, shard_indices(len(ood_dataset), args.num_shards, args.shard_index))
+
+    # checkpoint에 기록된 이미지는 다시 점수 계산하지 않음
+    checkpoint = EvalCheckpoint(sink_dir, args.checkpoint_every, resume=args.resume is not None)
+    id_dataset = exclude_paths(id_dataset, checkpoint.done)
+    ood_dataset = exclude_paths(ood_dataset, checkpoint.done)
+
+    # --dedup: 중복 그룹마다 대표 이미지 하나만 점수 계산, 결과는 기록할 때 그룹의 다른 이미지에 복사
+    id_dataset, id_groups = split_duplicates(id_dataset, id_manifest, args.dedup, args.dedup_distance)
+    ood_dataset, ood_groups = split_duplicates(ood_dataset, ood_manifest, args.dedup, args.dedup_distance)
+    duplicates = {**id_groups, **ood_groups}
+    if duplicates:
+        write_groups(os.path.join(run_dir, f"part_{args.shard_index:03d}_duplicate_groups.json" if sharded
+                                  else 'duplicate_groups.json'), duplicates)
+
+    # 점수 저장소: 모델 가중치와 점수 설정이 같으면 변경되지 않은 이미지의 점수를 재사용
+    # (head / full MC 모드는 같은 분포이므로 설정 키에 포함하지 않음, analytic은 근사값이므로 별도 키)
+    adaptive = adaptive_config(args) if args.adaptive else None
+    score_store = None
+    if args.score_store:
+        if args.scorer == 'student':
+            store_config = {'scorer': 'student', 'student': file_checksum(args.student), 'image_size': IMAGE_SIZE}
+        elif bank is None:
+            store_config = {'scorer': 'mc_entropy', 'samples': NUM_MC_SAMPLES, 'image_size': IMAGE_SIZE}
+            if args.mc_mode == 'analytic':
+                store_config = {'scorer': 'mc_entropy', 'mode': 'analytic', 'image_size': IMAGE_SIZE}
+        else:
+            store_config = {'scorer': args.scorer, 'k': args.knn_k, 'image_size': IMAGE_SIZE,
+                            'bank': file_checksum(os.path.join(args.feature_bank, 'meta.json'))}
+        if adaptive:
+            store_config.update(adaptive=adaptive, threshold=ENTROPY_THRESHOLD)
+        if args.fast_decode:
+            # draft 모드 디코딩 입력은 전체 디코딩과 약간 달라 별도 키로 저장
+            store_config.update(decode='draft')
+        if args.backbone:
+            # 양자화 backbone의 점수는 FP32와 다르므로 별도 키로 저장
+            store_config.update(backbone=file_checksum(args.backbone))
+        score_store = ScoreStore(args.score_store, MODEL_PATH, store_config)
+        for manifest in (id_manifest, ood_manifest):
+            if manifest is not None:
+                # manifest의 SHA-1 재사용 (이미지마다 stat / 읽기 없음)
+                score_store.seed_hashes(manifest.hashes())
+    id_dataset, id_stored = split_by_score_store(id_dataset, score_store)
+    ood_dataset, ood_stored = split_by_score_store(ood_dataset, score_store)
+
+    if args.fast_decode:
+        # JPEG draft 모드(축소 디코딩) + thread pool, uint8 배치로 반환 (process_dataloader에서 정규화)
+        id_loader = FastImageLoader(dataset_paths(id_dataset), IMAGE_SIZE, settings['batch_size'], args.decode_threads)
+        ood_loader = FastImageLoader(dataset_paths(ood_dataset), IMAGE_SIZE, settings['batch_size'],
+                                     args.decode_threads)
+    else:
+        id_loader = DataLoader(id_dataset, batch_size=settings['batch_size'], shuffle=False,
+                               num_workers=settings['num_workers'])
+        ood_loader = DataLoader(ood_dataset, batch_size=settings['batch_size'], shuffle=False,
+                                num_workers=settings['num_workers'])
+
+    # 결과 sink는 checkpoint마다 chunk로 fsync, resume 시 마지막 checkpoint 이후 chunk는 버리고 이어서 기록
+    sink = checkpoint.open_sink(RESULT_SCHEMA)
+
+    # --scorer knn / mahalanobis: MC Dropout 대신 feature bank 거리 (결정적 forward 1회)
+    score_fn = None
+    if bank is not None:
+        def score_fn(images, paths):
+            return feature_bank_batch(model, images, bank, args.scorer, args.knn_k, paths, profiler)
+    elif args.scorer == 'student':
+        def score_fn(images, paths):
+            return student_batch(model, images, profiler)
+
+    # sorted_images: copy(기본) / hardlink / symlink / manifest / none (--sorted-output)
+    sorter = SortedImageWriter(os.path.join(run_dir, 'sorted_images'), args.sorted_output, args.sort_threads,
+                               folders=('Predicted_OOD', 'Predicted_ID'))
+
+    # --profile: 단계별 시간/카운터를 run 폴더에 JSON + Prometheus 텍스트로 기록
+    profiler = StageProfiler(args.profile, run_dir, DEVICE, interval=args.profile_interval,
+                             prefix=f"part_{args.shard_index:03d}_" if sharded else '',
+                             torch_profile=args.torch_profile)
+
+    # 실시간 AUROC / AUPR / FPR@95TPR (고정 메모리 히스토그램, --exact-metrics 시 전체 점수 보관)
+    prefix = f"part_{args.shard_index:03d}_" if sharded else ''
+    live = live_metrics_from_args(args, os.path.join(run_dir, f'{prefix}live_metrics.json'), profiler)
+    live.resume_from(sink_dir)
+
+    # --pool-workers: 가중치를 한 번 공유 메모리에 올리고 worker N개가 같은 페이지를 읽기 전용으로 사용
+    # (checkpoint의 RNG 상태를 먼저 복원: worker별 dropout seed가 parent RNG에서 생성되므로 resume 시에도 이어짐)
+    checkpoint.restore_rng()
+    pool = None
+    if args.pool_workers > 1:
+        pool = SharedModelPool(model, pool_score, args.pool_workers, threads=args.pool_threads,
+                               args=(args.scorer, args.mc_mode, adaptive))
+
+    startup.report(profiler)
+    print(f"\n=== Starting Evaluation (Run {run_id}) ===")
+    process_dataloader(model, [(ID_LABEL, id_loader, id_stored), (OOD_LABEL, ood_loader, ood_stored)], sink,
+                       sorter, args.mc_mode, score_store, adaptive, checkpoint, profiler, score_fn, threshold,
+                       live, pool, duplicates)
+    if pool is not None:
+        # worker별 peak RSS / PSS / private 메모리 출력 (--profile 시 gauge로도 기록)
+        pool.report(profiler)
+    live.finish()
+    with profiler.stage('sorted_output_drain'):
+        sorter.close()
+    checkpoint.close()
+    profiler.finish()
+    if score_store is not None:
+        score_store.close()
+
+    if sharded:
+        print(f"\n>>> Shard {args.shard_index + 1}/{args.num_shards} saved to: {sink_dir}")
+        return
+
+    finish_run(run_dir, run_id, sink_dir, threshold, score_name, args.export_csv)
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,265 @@
+import torch
+from torchvision import datasets, transforms
+import os
+import sys
+import copy
+import json
+import time
+import inspect
+import argparse
+import importlib.util
+import numpy as np
+from torch.utils.data import DataLoader, Subset
+from model import get_animal_model, get_backbone, mc_dropout_head, predictive_entropy, ExportedBackbone
+
+# src/Animals-10/common 공유 모듈 경로 추가
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import DEFAULT_CACHE_DIR, load_cached_dataset, normalize_batch
+from common.weights import load_checkpoint_model
+
+# --- [설정] ---
+MODEL_PATH = '/app/models/Animals-10/classifier/animals10_resnet18.pth'
+EXPORT_DIR = '/app/models/Animals-10/classifier/export'
+ID_DATA_DIR = '/app/data/animals'
+OOD_DATA_DIR = '/app/data/pokemon'
+
+NUM_CLASSES = 10
+NUM_MC_SAMPLES = 30
+IMAGE_SIZE = 224
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+
+CALIB_SIZE = 512  # INT8 calibration에 사용할 Animals-10 이미지 수
+EVAL_SIZE = 1000  # 정확도 / 엔트로피 drift 비교에 사용할 이미지 수 (ID, OOD 각각)
+BATCH_SIZE = 32
+BENCH_ITERS = 10
+SEED = 0
+
+transform = transforms.Compose([
+    transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=NORM_MEAN, std=NORM_STD)
+])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export the ResNet18 backbone as INT8 (FX static quantization) / TorchScript / ONNX "
+                    "and compare it against FP32")
+    parser.add_argument('--model', type=str, default=MODEL_PATH)
+    parser.add_argument('--output-dir', type=str, default=EXPORT_DIR)
+    parser.add_argument('--formats', nargs='+', choices=['int8', 'torchscript', 'onnx'],
+                        default=['int8', 'torchscript', 'onnx'])
+    parser.add_argument('--calib-size', type=int, default=CALIB_SIZE)
+    parser.add_argument('--eval-size', type=int, default=EVAL_SIZE)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--bench-iters', type=int, default=BENCH_ITERS)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads for calibration / benchmark")
+    parser.add_argument('--cache-dir', nargs='?', const=DEFAULT_CACHE_DIR, default=None,
+                        help=f"Read images from the preprocessed uint8 tensor cache (default: {DEFAULT_CACHE_DIR})")
+    return parser.parse_args()
+
+
+def load_fp32_model(model_path):
+    model = load_checkpoint_model(lambda: get_animal_model(num_classes=NUM_CLASSES, pretrained=False),
+                                  model_path, 'cpu')
+    return model.eval()
+
+
+def load_split(root, cache_dir):
+    if cache_dir:
+        return load_cached_dataset(root, IMAGE_SIZE, cache_dir=cache_dir, return_paths=False)
+    return datasets.ImageFolder(root, transform=transform)
+
+
+def random_subsets(dataset, sizes, seed=SEED):
+    """고정 seed로 섞은 뒤 겹치지 않는 부분집합들로 분할"""
+    order = torch.randperm(len(dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+    subsets, start = [], 0
+    for size in sizes:
+        subsets.append(Subset(dataset, order[start:start + size]))
+        start += size
+    return subsets
+
+
+def iterate_images(dataset, batch_size):
+    """정규화된 float 배치 [B, 3, 224, 224]와 라벨을 반환 (tensor cache의 uint8 배치도 처리)"""
+    for images, labels in DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0):
+        if images.dtype == torch.uint8:
+            images = normalize_batch(images, NORM_MEAN, NORM_STD)
+        yield images, labels
+
+
+# --- 산출물 생성 ---
+def export_int8(backbone, calib_set, batch_size, path):
+    """FX graph mode static quantization (calibration 후 INT8 변환) -> TorchScript 저장"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = torch.backends.quantized.engine
+    example = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    prepared = prepare_fx(copy.deepcopy(backbone).eval(), get_default_qconfig_mapping(engine), (example,))
+    print(f">>> INT8 calibration on {len(calib_set)} images (engine: {engine})...")
+    with torch.no_grad():
+        for images, _ in iterate_images(calib_set, batch_size):
+            prepared(images)
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(quantized, example).eval())
+    torch.jit.save(traced, path)
+    print(f"    Saved INT8 backbone: {path}")
+
+
+def export_torchscript(backbone, path):
+    example = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(copy.deepcopy(backbone).eval(), example).eval())
+    torch.jit.save(traced, path)
+    print(f"    Saved TorchScript FP32 backbone: {path}")
+
+
+def export_onnx(backbone, path):
+    if importlib.util.find_spec('onnx') is None:
+        print("    Skipped ONNX export (onnx is not installed: pip install onnx)")
+        return False
+    example = torch.randn(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+    kwargs = {}
+    # 최신 torch는 dynamo exporter가 기본값 -> 기존 TorchScript 기반 exporter 사용
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(copy.deepcopy(backbone).eval(), example, path, input_names=['images'],
+                      output_names=['features'], dynamic_axes={'images': {0: 'batch'}, 'features': {0: 'batch'}},
+                      opset_version=17, **kwargs)
+    print(f"    Saved ONNX FP32 backbone: {path}")
+    return True
+
+
+# --- FP32 대비 비교 ---
+def collect_features(backbone, dataset, batch_size):
+    features, labels = [], []
+    with torch.no_grad():
+        for images, batch_labels in iterate_images(dataset, batch_size):
+            features.append(backbone(images))
+            labels.append(batch_labels)
+    return torch.cat(features), torch.cat(labels)
+
+
+def head_scores(head, features, seed=SEED):
+    """모든 변형에 같은 Dropout mask를 쓰도록 seed 고정 -> 차이는 backbone(양자화)에서만 발생"""
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        mean_probs = mc_dropout_head(head, features, NUM_MC_SAMPLES).mean(dim=0)
+    return predictive_entropy(mean_probs), mean_probs.argmax(dim=1)
+
+
+def ks_statistic(a, b):
+    """두 표본의 Kolmogorov-Smirnov 통계량 (경험적 CDF 최대 차이)"""
+    a, b = np.sort(a), np.sort(b)
+    grid = np.concatenate([a, b])
+    cdf_a = np.searchsorted(a, grid, side='right') / len(a)
+    cdf_b = np.searchsorted(b, grid, side='right') / len(b)
+    return float(np.max(np.abs(cdf_a - cdf_b)))
+
+
+def backbone_throughput(backbone, batch_size, iters):
+    images = torch.randn(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+    with torch.no_grad():
+        backbone(images)  # warm-up
+        start = time.perf_counter()
+        for _ in range(iters):
+            backbone(images)
+    return batch_size * iters / (time.perf_counter() - start)
+
+
+def compare(variants, head, id_set, ood_set, batch_size, bench_iters):
+    reference = None
+    report = {}
+    for name, backbone in variants.items():
+        print(f">>> Evaluating {name}...")
+        id_features, id_labels = collect_features(backbone, id_set, batch_size)
+        ood_features, _ = collect_features(backbone, ood_set, batch_size) if len(ood_set) else (None, None)
+        id_entropy, id_pred = head_scores(head, id_features)
+        entry = {
+            'accuracy': float((id_pred == id_labels).float().mean()),
+            'id_mean_entropy': float(id_entropy.mean()),
+            'images_per_sec': backbone_throughput(backbone, batch_size, bench_iters),
+        }
+        ood_entropy = None
+        if ood_features is not None:
+            ood_entropy, _ = head_scores(head, ood_features)
+            entry['ood_mean_entropy'] = float(ood_entropy.mean())
+
+        if reference is None:
+            reference = {'id_entropy': id_entropy, 'id_pred': id_pred, 'ood_entropy': ood_entropy,
+                         'images_per_sec': entry['images_per_sec']}
+        else:
+            entry['speedup_vs_fp32'] = entry['images_per_sec'] / reference['images_per_sec']
+            entry['prediction_agreement'] = float((id_pred == reference['id_pred']).float().mean())
+            entry['id_entropy_mean_abs_diff'] = float((id_entropy - reference['id_entropy']).abs().mean())
+            entry['id_entropy_max_abs_diff'] = float((id_entropy - reference['id_entropy']).abs().max())
+            entry['id_entropy_ks'] = ks_statistic(id_entropy.numpy(), reference['id_entropy'].numpy())
+            if ood_entropy is not None:
+                entry['ood_entropy_mean_abs_diff'] = float((ood_entropy - reference['ood_entropy']).abs().mean())
+                entry['ood_entropy_ks'] = ks_statistic(ood_entropy.numpy(), reference['ood_entropy'].numpy())
+        report[name] = entry
+    return report
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # export / 양자화는 CPU 배포용이므로 CPU에서 수행
+    model = load_fp32_model(args.model)
+    backbone = get_backbone(model)
+
+    id_dataset = load_split(ID_DATA_DIR, args.cache_dir)
+    calib_set, id_eval_set = random_subsets(id_dataset, [args.calib_size, args.eval_size])
+    ood_eval_set = Subset([], [])
+    if os.path.isdir(OOD_DATA_DIR):
+        ood_eval_set, = random_subsets(load_split(OOD_DATA_DIR, args.cache_dir), [args.eval_size])
+
+    print(f">>> Exporting to {args.output_dir}")
+    artifacts = {}
+    if 'int8' in args.formats:
+        artifacts['int8'] = os.path.join(args.output_dir, 'backbone_int8.pt')
+        export_int8(backbone, calib_set, args.batch_size, artifacts['int8'])
+    if 'torchscript' in args.formats:
+        artifacts['torchscript'] = os.path.join(args.output_dir, 'backbone_fp32.pt')
+        export_torchscript(backbone, artifacts['torchscript'])
+    if 'onnx' in args.formats:
+        path = os.path.join(args.output_dir, 'backbone_fp32.onnx')
+        if export_onnx(backbone, path):
+            artifacts['onnx'] = path
+
+    # 저장된 파일을 evaluate_ood.py / detect_ood.py와 같은 방식(--backbone)으로 다시 로드해서 비교
+    variants = {'fp32_eager': backbone}
+    for name, path in artifacts.items():
+        try:
+            variants[name] = ExportedBackbone(path)
+        except ImportError as e:
+            print(f"    Skipped {name} comparison ({e})")
+
+    report = compare(variants, model.fc, id_eval_set, ood_eval_set, args.batch_size, args.bench_iters)
+    report_path = os.path.join(args.output_dir, 'export_report.json')
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({'model': args.model, 'artifacts': artifacts, 'engine': torch.backends.quantized.engine,
+                   'calib_size': len(calib_set), 'eval_size': {'id': len(id_eval_set), 'ood': len(ood_eval_set)},
+                   'threads': torch.get_num_threads(), 'variants': report}, f, indent=2)
+
+    print("\n" + "=" * 86)
+    print(f"{'variant':<12} {'acc':>7} {'agree':>7} {'ID H':>7} {'OOD H':>7} {'|dH| ID':>8} {'KS ID':>7} "
+          f"{'img/s':>8} {'speedup':>8}")
+    for name, r in report.items():
+        print(f"{name:<12} {r['accuracy']:7.4f} {r.get('prediction_agreement', 1.0):7.4f} "
+              f"{r['id_mean_entropy']:7.4f} {r.get('ood_mean_entropy', float('nan')):7.4f} "
+              f"{r.get('id_entropy_mean_abs_diff', 0.0):8.5f} {r.get('id_entropy_ks', 0.0):7.4f} "
+              f"{r['images_per_sec']:8.1f} {r.get('speedup_vs_fp32', 1.0):7.2f}x")
+    print("=" * 86)
+    print(f"Report saved to: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import torch
+import torch.nn.functional as F
+from torchvision import datasets, transforms
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+from torch.utils.data import DataLoader, Subset, random_split
+from model import get_animal_model, get_backbone
+from train import SPLIT_SEED
+
+# src/Animals-10/common 공유 모듈 경로 추가
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import DEFAULT_CACHE_DIR, file_checksum, load_cached_dataset, normalize_batch
+from common.weights import load_checkpoint_model
+
+# --- [설정] ---
+MODEL_PATH = '/app/models/Animals-10/classifier/animals10_resnet18.pth'
+DATASET_PATH = '/app/data/animals'
+BANK_DIR = '/app/models/Animals-10/classifier/feature_bank'
+
+NUM_CLASSES = 10
+IMAGE_SIZE = 224
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+BATCH_SIZE = 64
+NUM_WORKERS = 4
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+KNN_K = 50  # k번째 최근접 이웃까지의 거리를 OOD 점수로 사용
+ID_TPR = 0.95  # 기본 임계값: ID(학습 이미지) 점수의 95% 분위수
+THRESHOLD_SAMPLE = 2000  # kNN 임계값 추정에 사용할 bank 샘플 수
+SEARCH_CHUNK = 32768  # exact kNN에서 한 번에 float32로 올리는 bank 행 수
+
+# IVF-PQ 인덱스 (선택)
+IVF_LISTS = 256  # coarse k-means 클러스터 수
+PQ_SUBVECTORS = 32  # 512차원 -> 16차원 x 32개 sub-vector, 각 8bit code
+PQ_CENTROIDS = 256
+NPROBE = 16  # 검색 시 살펴볼 클러스터 수
+KMEANS_ITERS = 20
+
+SCORERS = ('knn', 'mahalanobis')
+TRAIN_FRACTION = 0.8  # train.py와 같은 train / val 분할 (val 이미지는 bank에서 제외)
+
+transform = transforms.Compose([
+    transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=NORM_MEAN, std=NORM_STD)
+])
+
+
+# --- k-means / IVF-PQ ---
+def pairwise_sq_dist(a, b):
+    return (a.pow(2).sum(1, keepdim=True) - 2 * a @ b.T + b.pow(2).sum(1)).clamp(min=0)
+
+
+def assign(x, centroids, chunk=SEARCH_CHUNK):
+    return torch.cat([pairwise_sq_dist(x[i:i + chunk], centroids).argmin(dim=1) for i in range(0, len(x), chunk)])
+
+
+def kmeans(x, k, iters=KMEANS_ITERS, seed=0):
+    """Lloyd k-means (빈 클러스터는 임의의 점으로 다시 초기화)"""
+    g = torch.Generator().manual_seed(seed)
+    k = min(k, len(x))
+    centroids = x[torch.randperm(len(x), generator=g)[:k]].clone()
+    for _ in range(iters):
+        labels = assign(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, labels, x)
+        counts = torch.bincount(labels, minlength=k)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).to(x.dtype)
+        if empty.any():
+            centroids[empty] = x[torch.randint(len(x), (int(empty.sum()),), generator=g)]
+    return centroids
+
+
+class IVFPQIndex:
+    """
+    Inverted file + product quantization (residual 기준)
+    coarse [L, D] / codebooks [M, 256, D/M] / codes [N, M] uint8 (list 순서로 정렬) / ids [N] / offsets [L+1]
+    검색은 nprobe개 list의 code에 대해 lookup table로 근사 거리를 계산 -> bank 전체를 읽지 않음
+    """
+
+    def __init__(self, coarse, codebooks, codes, ids, offsets):
+        self.coarse = coarse
+        self.codebooks = codebooks
+        self.codes = codes
+        self.ids = ids
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, x, n_lists=IVF_LISTS, n_sub=PQ_SUBVECTORS, n_centroids=PQ_CENTROIDS):
+        coarse = kmeans(x, n_lists)
+        lists = assign(x, coarse)
+        residual = x - coarse[lists]
+        sub = residual.view(len(x), n_sub, -1)
+        codebooks = torch.stack([kmeans(sub[:, m], n_centroids, seed=m + 1) for m in range(n_sub)])
+        codes = torch.stack([assign(sub[:, m], codebooks[m]) for m in range(n_sub)], dim=1).to(torch.uint8)
+
+        order = torch.argsort(lists, stable=True)
+        offsets = torch.zeros(len(coarse) + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.bincount(lists, minlength=len(coarse)), 0)
+        return cls(coarse, codebooks, codes[order].numpy(), order.numpy(), offsets.numpy())
+
+    def save(self, bank_dir):
+        np.save(os.path.join(bank_dir, 'ivf_coarse.npy'), self.coarse.numpy())
+        np.save(os.path.join(bank_dir, 'pq_codebooks.npy'), self.codebooks.numpy())
+        np.save(os.path.join(bank_dir, 'pq_codes.npy'), self.codes)
+        np.save(os.path.join(bank_dir, 'ivf_ids.npy'), self.ids)
+        np.save(os.path.join(bank_dir, 'ivf_offsets.npy'), self.offsets)
+
+    @classmethod
+    def load(cls, bank_dir):
+        load = lambda name, **kw: np.load(os.path.join(bank_dir, name), **kw)
+        return cls(torch.from_numpy(load('ivf_coarse.npy')), torch.from_numpy(load('pq_codebooks.npy')),
+                   load('pq_codes.npy', mmap_mode='r'), load('ivf_ids.npy', mmap_mode='r'), load('ivf_offsets.npy'))
+
+    def search(self, queries, k, nprobe=NPROBE):
+        """(근사 제곱 거리 [Q, k], bank id [Q, k]); 후보가 k보다 적으면 inf / -1로 채움"""
+        n_sub = self.codebooks.shape[0]
+        probe = pairwise_sq_dist(queries, self.coarse).topk(min(nprobe, len(self.coarse)), largest=False).indices
+        best_d = torch.full((len(queries), k), float('inf'))
+        best_i = torch.full((len(queries), k), -1, dtype=torch.long)
+        sub_index = torch.arange(n_sub)
+        # list 단위로 처리: 해당 list를 probe한 query들을 한 번에 계산
+        for lst in torch.unique(probe).tolist():
+            start, stop = int(self.offsets[lst]), int(self.offsets[lst + 1])
+            if start == stop:
+                continue
+            q_idx = (probe == lst).any(dim=1).nonzero().squeeze(1)
+            residual = (queries[q_idx] - self.coarse[lst]).view(len(q_idx), n_sub, 1, -1)
+            tables = (residual - self.codebooks).pow(2).sum(-1)  # [Q_l, M, 256]
+            codes = torch.from_numpy(np.array(self.codes[start:stop], dtype=np.int64))  # [n, M]
+            dists = tables[:, sub_index, codes].sum(-1)  # [Q_l, n]
+            ids = torch.from_numpy(np.array(self.ids[start:stop], dtype=np.int64)).expand(len(q_idx), -1)
+            all_d = torch.cat([best_d[q_idx], dists], dim=1)
+            all_i = torch.cat([best_i[q_idx], ids], dim=1)
+            top = all_d.topk(k, largest=False)
+            best_d[q_idx], best_i[q_idx] = top.values, all_i.gather(1, top.indices)
+        return best_d, best_i
+
+
+# --- Feature bank ---
+class FeatureBank:
+    """
+    학습 이미지의 penultimate(512차원) feature bank
+      features.f16.npy  L2 정규화된 feature [N, 512] float16 (memory-mapped)
+      labels.npy        클래스 라벨 [N]
+      paths.json        이미지 경로 (bank에 들어있는 이미지를 scoring할 때 자기 자신은 이웃에서 제외)
+      stats.npz         클래스별 평균 + 공유 공분산의 역행렬 (Mahalanobis)
+      ivf_*/pq_*.npy    선택적 IVF-PQ 인덱스
+      meta.json         모델 checksum, 임계값 등
+    점수는 모두 클수록 OOD
+    model_path를 주면 bank를 만든 분류기 checkpoint와 같은지 확인 (다르면 ValueError)
+    """
+
+    def __init__(self, bank_dir, model_path=None):
+        self.bank_dir = bank_dir
+        meta_path = os.path.join(bank_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError(f"Feature bank not found at {bank_dir} (build it with feature_bank.py)")
+        with open(meta_path, encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if model_path is not None and self.meta.get('model_checksum') != file_checksum(model_path):
+            raise ValueError(f"Feature bank at {bank_dir} was built from a different classifier checkpoint than "
+                             f"{model_path}; rebuild the bank with feature_bank.py")
+        self.features = np.load(os.path.join(bank_dir, 'features.f16.npy'), mmap_mode='r')
+        with open(os.path.join(bank_dir, 'paths.json'), encoding='utf-8') as f:
+            self.path_index = {p: i for i, p in enumerate(json.load(f))}
+        stats = np.load(os.path.join(bank_dir, 'stats.npz'))
+        self.class_means = torch.from_numpy(stats['class_means'])
+        self.precision = torch.from_numpy(stats['precision'])
+        self.index = IVFPQIndex.load(bank_dir) if self.meta.get('index') == 'ivfpq' else None
+
+    @classmethod
+    def build(cls, bank_dir, features, labels, paths, model_path, index=None):
+        os.makedirs(bank_dir, exist_ok=True)
+        normalized = F.normalize(features, dim=1)
+        bank = np.lib.format.open_memmap(os.path.join(bank_dir, 'features.f16.npy'), mode='w+',
+                                         dtype=np.float16, shape=tuple(normalized.shape))
+        bank[:] = normalized.numpy().astype(np.float16)
+        bank.flush()
+        del bank
+        np.save(os.path.join(bank_dir, 'labels.npy'), labels.numpy().astype(np.int16))
+        with open(os.path.join(bank_dir, 'paths.json'), 'w', encoding='utf-8') as f:
+            json.dump(list(paths), f)
+
+        # class-conditional Gaussian + 공유(tied) 공분산
+        classes = torch.unique(labels)
+        class_means = torch.stack([features[labels == c].mean(dim=0) for c in classes])
+        centered = features - class_means[torch.searchsorted(classes, labels)]
+        covariance = centered.T.double() @ centered.double() / len(features)
+        precision = torch.linalg.pinv(covariance).float()
+        np.savez(os.path.join(bank_dir, 'stats.npz'), class_means=class_means.numpy(), precision=precision.numpy())
+
+        if index == 'ivfpq':
+            print(f">>> Building IVF-PQ index ({IVF_LISTS} lists, {PQ_SUBVECTORS}x8-bit codes)...")
+            IVFPQIndex.build(normalized).save(bank_dir)
+
+        meta = {'model_checksum': file_checksum(model_path), 'num_features': len(features),
+                'dim': features.shape[1], 'num_classes': len(classes), 'index': index}
+        with open(os.path.join(bank_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+
+        # 기본 임계값: bank 이미지 자신의 점수 분포에서 ID_TPR 분위수
+        built = cls(bank_dir)
+        g = torch.Generator().manual_seed(0)
+        sample = torch.randperm(len(features), generator=g)[:THRESHOLD_SAMPLE]
+        sample_paths = [paths[i] for i in sample.tolist()]
+        meta['thresholds'] = {
+            'knn': float(np.quantile(built.knn_scores(features[sample], paths=sample_paths).numpy(), ID_TPR)),
+            'mahalanobis': float(np.quantile(built.mahalanobis_scores(features).numpy(), ID_TPR)),
+        }
+        with open(os.path.join(bank_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        built.meta = meta
+        return built
+
+    def threshold(self, scorer):
+        return self.meta.get('thresholds', {}).get(scorer)
+
+    def _exact_search(self, queries, k):
+        best_d = torch.full((len(queries), k), float('inf'))
+        best_i = torch.full((len(queries), k), -1, dtype=torch.long)
+        for start in range(0, len(self.features), SEARCH_CHUNK):
+            chunk = torch.from_numpy(np.asarray(self.features[start:start + SEARCH_CHUNK], dtype=np.float32))
+            d = pairwise_sq_dist(queries, chunk)
+            ids = torch.arange(start, start + len(chunk)).expand(len(queries), -1)
+            all_d, all_i = torch.cat([best_d, d], dim=1), torch.cat([best_i, ids], dim=1)
+            top = all_d.topk(k, largest=False)
+            best_d, best_i = top.values, all_i.gather(1, top.indices)
+        return best_d, best_i
+
+    def knn_scores(self, features, k=KNN_K, paths=None, use_index=True):
+        """정규화된 feature 공간에서 k번째 최근접 이웃까지의 거리 [B]"""
+        queries = F.normalize(features.float().cpu(), dim=1)
+        k = max(1, min(k, len(self.features) - 1))
+        search = self.index.search if use_index and self.index is not None else self._exact_search
+        dists, ids = search(queries, k + 1)
+        if paths is not None:
+            # bank에 포함된 이미지는 자기 자신과의 거리(0)를 제외
+            self_ids = torch.tensor([self.path_index.get(p, -2) for p in paths]).unsqueeze(1)
+            dists = dists.masked_fill(ids == self_ids, float('inf')).sort(dim=1).values
+        return dists[:, k - 1].clamp(min=0).sqrt()
+
+    def mahalanobis_scores(self, features):
+        """가장 가까운 클래스 평균까지의 Mahalanobis 거리 (제곱) [B]"""
+        # float64: 전개식 f'Pf - 2f'Pm + m'Pm 의 상쇄 오차 방지
+        f, means, precision = features.double().cpu(), self.class_means.double(), self.precision.double()
+        fp = f @ precision
+        d = (fp * f).sum(1, keepdim=True) - 2 * fp @ means.T + ((means @ precision) * means).sum(1)
+        return d.min(dim=1).values.clamp(min=0).float()
+
+    def score(self, features, scorer, k=KNN_K, paths=None):
+        if scorer == 'knn':
+            return self.knn_scores(features, k, paths=paths)
+        if scorer == 'mahalanobis':
+            return self.mahalanobis_scores(features)
+        raise ValueError(f"Unknown feature bank scorer: {scorer}")
+
+
+# --- bank 생성 ---
+def extract_features(backbone, dataset):
+    features, labels = [], []
+    loader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=NUM_WORKERS)
+    with torch.no_grad():
+        for images, batch_labels in tqdm(loader):
+            images = images.to(DEVICE)
+            if images.dtype == torch.uint8:
+                images = normalize_batch(images, NORM_MEAN, NORM_STD)
+            features.append(backbone(images).float().cpu())
+            labels.append(batch_labels)
+    return torch.cat(features), torch.cat(labels)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the ResNet18 penultimate feature bank for kNN / Mahalanobis OOD")
+    parser.add_argument('--model', type=str, default=MODEL_PATH)
+    parser.add_argument('--data-dir', type=str, default=DATASET_PATH)
+    parser.add_argument('--output-dir', type=str, default=BANK_DIR)
+    parser.add_argument('--index', choices=['none', 'ivfpq'], default='none',
+                        help="Also build an IVF-PQ index for sublinear kNN search")
+    parser.add_argument('--cache-dir', nargs='?', const=DEFAULT_CACHE_DIR, default=None,
+                        help=f"Read images from the preprocessed uint8 tensor cache (default: {DEFAULT_CACHE_DIR})")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model = load_checkpoint_model(lambda: get_animal_model(num_classes=NUM_CLASSES, pretrained=False),
+                                  args.model, DEVICE)
+    model.eval()
+
+    if args.cache_dir:
+        dataset = load_cached_dataset(args.data_dir, IMAGE_SIZE, cache_dir=args.cache_dir, return_paths=False)
+    else:
+        dataset = datasets.ImageFolder(args.data_dir, transform=transform)
+    # train.py의 SPLIT_SEED 분할 중 학습 부분만 사용 (held-out val 이미지가 bank의 이웃이 되지 않도록)
+    train_size = int(TRAIN_FRACTION * len(dataset))
+    train_split, _ = random_split(dataset, [train_size, len(dataset) - train_size],
+                                  generator=torch.Generator().manual_seed(SPLIT_SEED))
+    paths = [dataset.samples[i][0] for i in train_split.indices]
+
+    print(f">>> Extracting features of {len(paths)} training images from {args.data_dir}")
+    features, labels = extract_features(get_backbone(model), Subset(dataset, train_split.indices))
+    bank = FeatureBank.build(args.output_dir, features, labels, paths, args.model,
+                             index=None if args.index == 'none' else args.index)
+    print(f">>> Feature bank saved to {args.output_dir}")
+    print(f"    {len(features)} x {features.shape[1]} float16, index: {bank.meta['index'] or 'exact'}")
+    print(f"    Default thresholds (ID TPR {ID_TPR:.0%}): {bank.meta['thresholds']}")
+
+
+if __name__ == "__main__":
+    main()
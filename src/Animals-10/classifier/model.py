@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision import models
 
 
@@ -20,4 +21,158 @@ def get_animal_model(num_classes=10, pretrained=True):
         nn.Linear(num_ftrs, num_classes)
     )
 
-    return model
\ No newline at end of file
+    return model
+
+
+def get_backbone(model):
+    """
+    fc(Dropout + Linear)를 제외한 결정적(deterministic) 특징 추출부
+    conv ~ avgpool 까지 실행하여 512차원 pooled feature를 반환 (가중치는 model과 공유)
+    attach_backbone()으로 export 산출물이 연결되어 있으면 그것을 반환
+    """
+    exported = model.__dict__.get('_exported_backbone')
+    if exported is not None:
+        return exported
+    return nn.Sequential(*list(model.children())[:-1], nn.Flatten(1))
+
+
+def mc_dropout_head(head, features, num_samples):
+    """
+    pooled feature [B, 512]에 Dropout mask S개를 한 번에 적용
+    [S, B, 512] -> Linear -> softmax 확률 [S, B, C]
+    """
+    dropout, linear = head[0], head[1]
+    x = features.unsqueeze(0).expand(num_samples, -1, -1)
+    x = F.dropout(x, p=dropout.p, training=True)
+    return F.softmax(linear(x), dim=-1)
+
+
+def analytic_head_moments(head, features):
+    """
+    head(Dropout + Linear) 출력 logit 분포의 평균 [B, C]과 공분산 [B, C, C]를 샘플링 없이 계산
+    mask m_j ~ Bernoulli(1 - p), logit = W (m * f) / (1 - p) + b 이므로
+        평균   = W f + b
+        공분산 = W diag(f^2 * p / (1 - p)) W^T
+    """
+    dropout, linear = head[0], head[1]
+    mean = linear(features)
+    scaled = features.pow(2) * (dropout.p / (1.0 - dropout.p))
+    cov = torch.einsum('cd,bd,ed->bce', linear.weight, scaled, linear.weight)
+    return mean, cov
+
+
+def unscented_softmax(mean, cov):
+    """
+    logit ~ N(mean, cov) 근사에서 E[softmax(logit)] [B, C]를 sigma point 2C개로 계산 (결정적)
+    sigma point = mean ± sqrt(C) * (cov의 고유벡터 * sqrt(고유값)), 가중치는 모두 1/(2C)
+    """
+    num_classes = mean.shape[-1]
+    eigvals, eigvecs = torch.linalg.eigh(cov.float())
+    offsets = (eigvecs * eigvals.clamp_min(0).sqrt().unsqueeze(-2)).transpose(-1, -2) * num_classes ** 0.5
+    points = torch.cat([mean.float().unsqueeze(1) + offsets, mean.float().unsqueeze(1) - offsets], dim=1)
+    return F.softmax(points, dim=-1).mean(dim=1)
+
+
+def analytic_probs(model, images):
+    """
+    MC Dropout 평균 확률 [B, C]의 해석적 근사 (moment propagation, 샘플링 없음)
+    backbone 1회 -> Dropout + Linear의 logit 평균 / 공분산 -> sigma point softmax 평균
+    같은 입력이면 실행마다 같은 값 (MC 노이즈 없음)
+    """
+    features = get_backbone(model)(images)
+    mean, cov = analytic_head_moments(model.fc, features)
+    return unscented_softmax(mean, cov)
+
+
+def mc_dropout_probs(model, images, num_samples, mode='head'):
+    """
+    MC Dropout 샘플링 결과 확률 [S, B, C]
+
+    mode='head': backbone은 이미지당 1회만 실행하고 Dropout 이후(head)만 S번 샘플링
+    mode='full': 기존 방식, 전체 ResNet18을 S번 반복 실행
+    Dropout은 head에만 있으므로 두 방식의 분포는 동일합니다.
+    mode='analytic': 샘플링 없이 해석적으로 근사한 평균 확률 [1, B, C] (num_samples는 무시)
+    export된 backbone이 연결된 모델은 항상 'head' 방식으로 실행합니다.
+    """
+    model.eval()
+    if mode == 'analytic':
+        return analytic_probs(model, images).unsqueeze(0)
+    if mode == 'head' or has_exported_backbone(model):
+        features = get_backbone(model)(images)
+        return mc_dropout_head(model.fc, features, num_samples)
+
+    # MC Dropout 활성화 (BatchNorm 등은 eval 유지)
+    for m in model.modules():
+        if m.__class__.__name__.startswith('Dropout'):
+            m.train()
+    try:
+        return torch.stack([F.softmax(model(images), dim=1) for _ in range(num_samples)])
+    finally:
+        model.eval()
+
+
+def mc_dropout_draw(model, images, mode='head'):
+    """
+    적응형(sequential) 샘플링용 draw 함수 생성: draw(active_mask, n) -> 확률 [n, A, C]
+    mode='head'이면 backbone feature를 한 번만 계산해 두고 head만 반복 샘플링
+    """
+    model.eval()
+    if mode == 'analytic':
+        raise ValueError("analytic mode does not sample; it cannot be used for adaptive sampling")
+    if mode == 'head' or has_exported_backbone(model):
+        features = get_backbone(model)(images)
+        return lambda active, n: mc_dropout_head(model.fc, features[active], n)
+    return lambda active, n: mc_dropout_probs(model, images[active], n, mode='full')
+
+
+def predictive_entropy(mean_probs, epsilon=1e-12):
+    """평균 확률 [B, C] -> 예측 엔트로피 [B]"""
+    return -torch.sum(mean_probs * torch.log(mean_probs + epsilon), dim=-1)
+
+
+class ExportedBackbone(nn.Module):
+    """
+    export.py가 만든 backbone 산출물 (TorchScript .pt: FP32 trace 또는 INT8 양자화 / ONNX .onnx)
+    입력 [B, 3, 224, 224] -> pooled feature [B, 512]
+    INT8 / ONNX 산출물은 CPU 전용이므로 CPU에서 실행한 뒤 결과를 입력 device로 되돌림
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.session = None
+        self.module = None
+        if path.endswith('.onnx'):
+            try:
+                import onnxruntime
+            except ImportError as e:
+                raise ImportError("ONNX backbone requires onnxruntime (pip install onnxruntime)") from e
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        else:
+            self.module = torch.jit.load(path, map_location='cpu')
+            self.module.eval()
+
+    def forward(self, images):
+        x = images.detach().float().cpu().contiguous()
+        if self.session is not None:
+            features = torch.from_numpy(self.session.run(None, {self.input_name: x.numpy()})[0])
+        else:
+            features = self.module(x)
+        return features.to(images.device)
+
+
+def attach_backbone(model, backbone):
+    """
+    model의 backbone(conv ~ avgpool)을 export 산출물로 교체
+    fc head(Dropout + Linear)는 원래 모델 그대로 사용하므로 MC Dropout은 계속 확률적으로 동작
+    (submodule로 등록하지 않으므로 state_dict에는 영향 없음)
+    """
+    if isinstance(backbone, str):
+        backbone = ExportedBackbone(backbone)
+    model.__dict__['_exported_backbone'] = backbone
+    return model
+
+
+def has_exported_backbone(model):
+    return model.__dict__.get('_exported_backbone') is not None
@@ -1,11 +1,18 @@
 import os
+import sys
+import argparse
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torchvision import datasets, transforms
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import random_split
 from model import get_animal_model
 
+# src/Animals-10/common 공유 모듈 경로 추가
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import load_cached_dataset, normalize_batch
+from common.train_engine import TrainEngine, add_train_args, checkpoint_path, train_loader
+
 # --- [설정] ---
 DATASET_PATH = '/app/data/animals'
 
@@ -14,8 +21,27 @@ MODEL_SAVE_PATH = '/app/models/Animals-10/classifier/animals10_resnet18.pth'
 
 BATCH_SIZE = 32
 NUM_EPOCHS = 10
+IMAGE_SIZE = 224
+NUM_WORKERS = 4  # --no-cache 경로의 DataLoader worker 수
+SPLIT_SEED = 42  # train / val 분할 고정 (--resume 시 같은 분할 유지)
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the Animals-10 ResNet18 classifier")
+    add_train_args(parser, epochs=NUM_EPOCHS, batch_size=BATCH_SIZE)
+    return parser.parse_args()
+
+
+def classification_loss(model, images, labels, criterion=nn.CrossEntropyLoss()):
+    return criterion(model(images), labels)
+
 
 def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
@@ -32,48 +58,44 @@ def main():
 
     # 전처리
     transform = transforms.Compose([
-        transforms.Resize((224, 224)),
+        transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)),
         transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        transforms.Normalize(mean=NORM_MEAN, std=NORM_STD)
     ])
 
-    # 데이터 로드
-    full_dataset = datasets.ImageFolder(root=DATASET_PATH, transform=transform)
+    # 데이터 로드 (기본: 디코딩된 uint8 캐시에서 배치 단위로 읽고 정규화, --no-cache: 매 epoch 디코딩)
+    if args.no_cache:
+        full_dataset = datasets.ImageFolder(root=DATASET_PATH, transform=transform)
+    else:
+        full_dataset = load_cached_dataset(DATASET_PATH, IMAGE_SIZE, cache_dir=args.cache_dir, return_paths=False)
     print(f"Classes: {full_dataset.classes}")
 
     train_size = int(0.8 * len(full_dataset))
     val_size = len(full_dataset) - train_size
-    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size])
-
-    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=4)
-    val_loader = DataLoader(val_dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=4)
-
-    # 모델 설정
-    model = get_animal_model(num_classes=len(full_dataset.classes), pretrained=True)
-    model = model.to(device)
-
-    criterion = nn.CrossEntropyLoss()
+    train_dataset, val_dataset = random_split(full_dataset, [train_size, val_size],
+                                              generator=torch.Generator().manual_seed(SPLIT_SEED))
+    loader = train_loader(train_dataset, args.batch_size, seed=args.seed, num_workers=NUM_WORKERS)
+
+    # 모델 설정 (이어서 학습할 checkpoint가 있으면 가중치는 거기서 복원하므로 pretrained 다운로드 생략)
+    ckpt_path = checkpoint_path(MODEL_SAVE_PATH)
+    resuming = args.resume and os.path.exists(ckpt_path)
+    model = get_animal_model(num_classes=len(full_dataset.classes), pretrained=not resuming)
     optimizer = optim.Adam(model.parameters(), lr=0.001)
 
+    # 공용 학습 엔진: bf16 autocast(지원 시) + channels_last, epoch마다 checkpoint 저장
+    engine = TrainEngine(model, optimizer, classification_loss, device, ckpt_path,
+                         normalize=lambda images: normalize_batch(images, NORM_MEAN, NORM_STD),
+                         precision=args.precision, channels_last=not args.no_channels_last,
+                         checkpoint_every=args.checkpoint_every, seed=args.seed,
+                         config={'batch_size': args.batch_size, 'image_size': IMAGE_SIZE, 'split_seed': SPLIT_SEED})
+    start_epoch = engine.resume() if args.resume else 0
+
     # 학습 루프
     print("Starting Training...")
-    for epoch in range(NUM_EPOCHS):
-        model.train()
-        running_loss = 0.0
-        for images, labels in train_loader:
-            images, labels = images.to(device), labels.to(device)
-
-            optimizer.zero_grad()
-            outputs = model(images)
-            loss = criterion(outputs, labels)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-
-        print(f"Epoch [{epoch + 1}/{NUM_EPOCHS}] Loss: {running_loss / len(train_loader):.4f}")
+    engine.fit(loader, args.epochs, start_epoch)
 
     # 저장
-    torch.save(model.state_dict(), MODEL_SAVE_PATH)
+    engine.save_model(MODEL_SAVE_PATH)
     print(f"Model saved to {MODEL_SAVE_PATH}")
 
 if __name__ == '__main__':
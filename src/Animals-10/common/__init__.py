@@ -0,0 +1,6 @@
+"""
+Shared utilities for the classifier and VAE pipelines.
+
+The method folders (classifier/, vae/) are run as plain scripts, so they add
+src/Animals-10 to sys.path before importing from this package.
+"""
@@ -0,0 +1,318 @@
+"""
+Batch size / thread / DataLoader worker autotuning for the evaluators.
+
+The best batch size, torch intra-op and inter-op thread counts and number of
+DataLoader workers depend on the machine: its core count, memory and GPU. The
+evaluators resolve them in this order:
+
+    explicit flag (--batch-size, --threads, --interop-threads, --num-workers)
+    > stored result for this host fingerprint and scorer key (--autotune-file)
+    > a fresh probe (first run on a new machine, or --autotune)
+
+The probe scores a short warmup slice of the real ID images:
+
+1. Compute. For each (intra-op, inter-op) thread pair, a spawned process loads
+   the scorer and times increasing batch sizes. A fresh process is needed
+   because torch allows the inter-op pool size to be set only once per
+   process. A batch size is rejected when the process's peak memory (RSS on
+   CPU, allocated device memory on CUDA) exceeds the memory cap. Larger sizes
+   stop once the throughput falls.
+2. Loading. With the chosen batch size, DataLoader worker counts are timed on
+   the same slice. The smallest count that keeps up with the compute rate
+   (with headroom) wins, which leaves the remaining cores to torch.
+
+The result is stored under the host fingerprint (CPU model, usable cores,
+memory, GPU, torch version). The next run on the same kind of machine
+reuses it without probing:
+
+    add_autotune_args(parser, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS)
+    ...
+    settings = resolve_settings(args, key, build_scorer, build_args, id_dataset, DEVICE)
+    loader = DataLoader(dataset, batch_size=settings['batch_size'], num_workers=settings['num_workers'])
+
+build_scorer(*build_args) runs in the probe processes and must be a module-level
+function returning score(batch). The batch is a stack of the dataset's images,
+moved to the device. Shard workers only reuse stored results and never probe, so
+that N shards do not probe the same machine at once.
+"""
+import hashlib
+import json
+import os
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from common.profiling import peak_rss_bytes
+
+# --- [Configuration] ---
+DEFAULT_TUNE_PATH = '/app/models/Animals-10/autotune.json'
+PROBE_IMAGES = 128  # warmup slice decoded once and reused for every compute configuration
+BATCH_SIZES = (8, 16, 32, 64, 128, 256)
+WORKER_COUNTS = (0, 1, 2, 4, 8, 16)
+INTEROP_THREADS = (1, 2)
+PROBE_SECONDS = 1.5  # timed per configuration, after one warmup call
+MIN_PROBE_CALLS = 2
+MEMORY_FRACTION = 0.5  # default cap: this fraction of physical (or device) memory
+LOADER_HEADROOM = 1.2  # loader must deliver this multiple of the compute rate
+DROP_TOLERANCE = 0.95  # stop growing the batch once throughput falls below this fraction of the best
+
+
+def add_autotune_args(parser, batch_size, num_workers):
+    group = parser.add_argument_group('autotuning')
+    group.add_argument('--batch-size', type=int, default=None,
+                       help=f"Images per batch (default: the tuned value for this machine, else {batch_size})")
+    group.add_argument('--num-workers', type=int, default=None,
+                       help=f"DataLoader decode processes (default: the tuned value, else {num_workers})")
+    group.add_argument('--interop-threads', type=int, default=None,
+                       help="torch inter-op threads (default: the tuned value, else torch's default)")
+    group.add_argument('--autotune', action='store_true',
+                       help="Probe batch size / threads / workers again and store the result for this machine")
+    group.add_argument('--no-autotune', action='store_true',
+                       help="Never probe; use the flags, a stored result or the built-in defaults")
+    group.add_argument('--autotune-file', type=str, default=DEFAULT_TUNE_PATH,
+                       help=f"Per-machine tuning results (default: {DEFAULT_TUNE_PATH})")
+    group.add_argument('--autotune-memory-mb', type=float, default=None,
+                       help=f"Memory cap for the probe (default: {MEMORY_FRACTION:.0%} of physical / device memory)")
+    group.set_defaults(default_batch_size=batch_size, default_num_workers=num_workers)
+    return group
+
+
+# --- Host fingerprint ---
+def usable_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+
+def physical_memory_bytes():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def host_fingerprint(device):
+    """(short hash, fields): identical instance types share a fingerprint, so their tuning is interchangeable."""
+    device = torch.device(device)
+    fields = {
+        'cpu': cpu_model(),
+        'cpus': usable_cpus(),
+        # rounded to GiB so small differences in reserved memory do not change the fingerprint
+        'memory_gib': round((physical_memory_bytes() or 0) / 2 ** 30),
+        'device': device.type,
+        'gpu': torch.cuda.get_device_name(device) if device.type == 'cuda' else None,
+        'torch': torch.__version__,
+    }
+    digest = hashlib.sha1(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return digest, fields
+
+
+# --- Stored results ---
+def load_tuning(path, fingerprint, key):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get(fingerprint, {}).get('results', {}).get(key)
+
+
+def save_tuning(path, fingerprint, host, key, result):
+    data = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+    entry = data.setdefault(fingerprint, {'host': host, 'results': {}})
+    entry['results'][key] = result
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+# --- Probes ---
+def _peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return peak_rss_bytes()
+
+
+def _batch(images, batch_size):
+    """batch_size images from the slice, repeating it when the slice is smaller."""
+    if len(images) >= batch_size:
+        return images[:batch_size]
+    repeats = -(-batch_size // len(images))
+    return images.repeat(repeats, *([1] * (images.dim() - 1)))[:batch_size]
+
+
+def _probe_compute(build, build_args, images, threads, interop_threads, batch_sizes, memory_cap, device):
+    """Runs in a spawned process: images/s and peak memory per batch size for one thread setting."""
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(interop_threads)
+    device = torch.device(device)
+    score = build(*build_args)
+    results = []
+    best = 0.0
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            batch = _batch(images, batch_size).to(device)
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            score(batch)  # warmup
+            calls, start = 0, time.perf_counter()
+            while calls < MIN_PROBE_CALLS or time.perf_counter() - start < PROBE_SECONDS:
+                score(batch)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                calls += 1
+            rate = calls * batch_size / (time.perf_counter() - start)
+            peak = _peak_memory(device)
+            fits = memory_cap is None or peak <= memory_cap
+            results.append({'batch_size': batch_size, 'threads': threads, 'interop_threads': interop_threads,
+                            'images_per_sec': rate, 'peak_memory_bytes': peak, 'fits': fits})
+            # peak memory only grows with the batch size, and past the best size throughput rarely recovers
+            if not fits or rate < best * DROP_TOLERANCE:
+                break
+            best = max(best, rate)
+    return results
+
+
+def _loader_rate(dataset, batch_size, num_workers):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    batches = iter(loader)
+    next(batches)  # worker start-up is paid once per run, not per batch
+    images, start = 0, time.perf_counter()
+    for batch in batches:
+        images += len(batch[0])
+    seconds = time.perf_counter() - start
+    return images / seconds if images and seconds > 0 else float('inf')
+
+
+def thread_candidates(cpus):
+    return sorted({max(1, cpus // d) for d in (1, 2, 4)}, reverse=True)
+
+
+def memory_cap_bytes(args, device):
+    if args.autotune_memory_mb is not None:
+        return int(args.autotune_memory_mb * 2 ** 20)
+    if device.type == 'cuda':
+        return int(torch.cuda.get_device_properties(device).total_memory * MEMORY_FRACTION)
+    total = physical_memory_bytes()
+    return int(total * MEMORY_FRACTION) if total else None
+
+
+def probe_slice(dataset, count):
+    """Subset of the first `count` items (a Subset's own indices are kept)."""
+    if isinstance(dataset, Subset):
+        return Subset(dataset.dataset, list(dataset.indices[:count]))
+    return Subset(dataset, list(range(min(count, len(dataset)))))
+
+
+def stack_images(dataset):
+    """First element of every item ((image, ...) tuples as the evaluators' datasets return)."""
+    return torch.stack([dataset[i][0] for i in range(len(dataset))])
+
+
+def autotune(build, build_args, dataset, device, memory_cap, probe_loader=True):
+    """Probes compute and loading on a slice of `dataset`; returns the chosen settings and all measurements."""
+    device = torch.device(device)
+    cpus = usable_cpus()
+    images = stack_images(probe_slice(dataset, PROBE_IMAGES))
+    print(f">>> [Autotune] Probing {len(images)} images: threads {thread_candidates(cpus)}, "
+          f"inter-op {[t for t in INTEROP_THREADS if t <= cpus]}, batch sizes {list(BATCH_SIZES)}")
+    measurements = []
+    context = get_context('spawn')
+    for threads in thread_candidates(cpus):
+        for interop_threads in [t for t in INTEROP_THREADS if t <= cpus]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs = pool.submit(_probe_compute, build, build_args, images, threads, interop_threads,
+                                   BATCH_SIZES, memory_cap, str(device)).result()
+            for run in runs:
+                print(f"    threads {threads:<3} inter-op {interop_threads} bs {run['batch_size']:<4} "
+                      f"{run['images_per_sec']:8.1f} img/s  peak {run['peak_memory_bytes'] / 2 ** 20:7.0f} MiB"
+                      f"{'' if run['fits'] else '  (over the memory cap)'}")
+            measurements += runs
+    fitting = [m for m in measurements if m['fits']]
+    if not fitting:
+        raise RuntimeError(f"No probed configuration fits the memory cap of {memory_cap / 2 ** 20:.0f} MiB")
+    best = max(fitting, key=lambda m: m['images_per_sec'])
+
+    num_workers, loader_rates = 0, {}
+    if probe_loader:
+        loader_data = probe_slice(dataset, max(PROBE_IMAGES, 4 * best['batch_size']))
+        for workers in [w for w in WORKER_COUNTS if w <= cpus]:
+            loader_rates[workers] = _loader_rate(loader_data, best['batch_size'], workers)
+            print(f"    workers {workers:<3} {loader_rates[workers]:8.1f} img/s")
+        keeping_up = [w for w, rate in loader_rates.items() if rate >= best['images_per_sec'] * LOADER_HEADROOM]
+        num_workers = min(keeping_up) if keeping_up else max(loader_rates, key=loader_rates.get)
+
+    return {
+        'batch_size': best['batch_size'],
+        'threads': best['threads'],
+        'interop_threads': best['interop_threads'],
+        'num_workers': num_workers,
+        'images_per_sec': best['images_per_sec'],
+        'memory_cap_bytes': memory_cap,
+        'compute': measurements,
+        'loader_images_per_sec': {str(w): r for w, r in loader_rates.items()},
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def apply_threads(threads, interop_threads):
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # only allowed before the first inter-op parallel work of the process
+            print(f">>> [Autotune] Inter-op threads already fixed at {torch.get_num_interop_threads()}")
+
+
+def resolve_settings(args, key, build, build_args, dataset, device, probe_loader=True, allow_probe=True):
+    """
+    Settings for one evaluation run: explicit flags, else the stored result for this
+    host + key, else a fresh probe (stored afterwards). Applies the thread counts.
+    allow_probe=False (e.g. shard workers sharing a machine) only reuses stored results.
+    """
+    device = torch.device(device)
+    fingerprint, host = host_fingerprint(device)
+    tuned = None if args.autotune else load_tuning(args.autotune_file, fingerprint, key)
+    explicit = all(v is not None for v in (args.batch_size, args.threads, args.num_workers, args.interop_threads))
+    source = 'flags' if explicit else 'stored' if tuned else 'default'
+    wants_probe = args.autotune or (tuned is None and not args.no_autotune and not explicit)
+    if wants_probe and allow_probe and len(dataset):
+        tuned = autotune(build, build_args, dataset, device, memory_cap_bytes(args, device), probe_loader)
+        save_tuning(args.autotune_file, fingerprint, host, key, tuned)
+        source = 'probed'
+    tuned = tuned or {}
+
+    def pick(flag, name, default):
+        return flag if flag is not None else tuned.get(name, default)
+
+    settings = {
+        'batch_size': pick(args.batch_size, 'batch_size', args.default_batch_size),
+        'num_workers': pick(args.num_workers, 'num_workers', args.default_num_workers),
+        'threads': pick(args.threads, 'threads', None),
+        'interop_threads': pick(args.interop_threads, 'interop_threads', None),
+    }
+    if args.threads is None and getattr(args, 'cpus', None):
+        # --cpus alone already sized the intra-op pool to the pinned CPU set (sharding.configure_worker)
+        settings['threads'] = None
+    apply_threads(settings['threads'], settings['interop_threads'])
+    print(f">>> [Autotune] {key} on host {fingerprint} ({source}): batch {settings['batch_size']}, "
+          f"workers {settings['num_workers']}, threads {torch.get_num_threads()}, "
+          f"inter-op {torch.get_num_interop_threads()}")
+    return settings
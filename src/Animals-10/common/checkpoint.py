@@ -0,0 +1,154 @@
+"""
+Resumable evaluation runs.
+
+An evaluator writes its results through the ResultSink opened by an
+EvalCheckpoint. Every `interval` batches the sink's buffered rows are written
+as a (fsync'd) chunk, the paths written since the previous checkpoint are
+appended to an fsync'd log (<sink_dir>.ckpt.done, one path per line), and a
+small checkpoint file is written atomically next to the sink directory
+(<sink_dir>.ckpt). The checkpoint holds:
+
+    chunks      number of sink chunks covered by the checkpoint
+    done_bytes  length of the path log covered by the checkpoint
+    rng         torch (and CUDA) RNG state, so MC draws continue where they stopped
+
+A checkpoint only writes the new paths, so its cost does not grow with the
+number of images already done. `--resume run_N` reopens the run directory,
+drops the sink chunks and log lines written after the last checkpoint,
+restores the RNG state, and only scores the images that are not in the log.
+Metrics are computed from the sink afterwards, so nothing else needs to be
+carried over.
+"""
+import os
+
+import torch
+from torch.utils.data import Subset
+
+from common.result_sink import ResultSink
+
+CHECKPOINT_EVERY = 20  # batches between checkpoints
+
+
+def add_checkpoint_args(parser):
+    group = parser.add_argument_group('checkpointing')
+    group.add_argument('--resume', type=str, default=None, metavar='RUN',
+                       help="Continue an interrupted run (run_N or a run directory path) from its last checkpoint")
+    group.add_argument('--checkpoint-every', type=int, default=CHECKPOINT_EVERY,
+                       help="Batches between checkpoints")
+    return group
+
+
+def resolve_run_dir(base_dir, run):
+    """'run_3', '3' or a path -> existing run directory."""
+    candidates = [run, os.path.join(base_dir, run), os.path.join(base_dir, f"run_{run}")]
+    for path in candidates:
+        if os.path.isdir(path):
+            return path
+    raise FileNotFoundError(f"Run directory not found: {run} (looked in {base_dir})")
+
+
+def _fsync_dir(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def exclude_paths(dataset, done):
+    """Subset of `dataset` (or of the Subset's base dataset) without the samples whose path is in `done`."""
+    if not done:
+        return dataset
+    if isinstance(dataset, Subset):
+        base, indices = dataset.dataset, list(dataset.indices)
+    else:
+        base, indices = dataset, list(range(len(dataset)))
+    return Subset(base, [i for i in indices if base.samples[i][0] not in done])
+
+
+class EvalCheckpoint:
+    """
+    ckpt = EvalCheckpoint(sink_dir, resume=args.resume is not None)
+    sink = ckpt.open_sink(schema)           # fresh sink, or the resumed one cut back to the checkpoint
+    dataset = exclude_paths(dataset, ckpt.done)
+    ckpt.restore_rng()                      # right before scoring
+    for batch ...: sink.append(...); ckpt.update(paths)
+    ckpt.close()
+    """
+
+    def __init__(self, sink_dir, interval=CHECKPOINT_EVERY, resume=False):
+        self.sink_dir = sink_dir
+        self.ckpt_path = os.path.normpath(sink_dir) + '.ckpt'
+        self.log_path = self.ckpt_path + '.done'
+        self.interval = max(1, interval)
+        self.done = set()
+        self.pending = []  # paths written since the last checkpoint
+        self.done_bytes = 0
+        self.chunks = None
+        self.rng = None
+        self.batches = 0
+        self.sink = None
+
+        if resume and os.path.exists(self.ckpt_path):
+            state = torch.load(self.ckpt_path, weights_only=False)
+            self.chunks = state['chunks']
+            self.rng = state['rng']
+            self.done_bytes = state['done_bytes']
+            with open(self.log_path, 'rb') as f:
+                self.done = set(f.read(self.done_bytes).decode('utf-8').splitlines())
+            print(f">>> [Checkpoint] Resuming: {len(self.done)} images already scored")
+        elif resume:
+            print(f">>> [Checkpoint] No checkpoint at {self.ckpt_path}, starting this run from the beginning")
+        # lines appended after the last checkpoint belong to rows that are dropped with their chunks
+        with open(self.log_path, 'ab') as f:
+            f.truncate(self.done_bytes)
+
+    def open_sink(self, schema):
+        # chunks=None (fresh run) clears anything left in sink_dir
+        self.sink = ResultSink(self.sink_dir, schema, keep_chunks=self.chunks)
+        self.save()
+        return self.sink
+
+    def restore_rng(self):
+        if self.rng is None:
+            return
+        torch.set_rng_state(self.rng['cpu'])
+        if self.rng.get('cuda') is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(self.rng['cuda'])
+
+    def update(self, paths):
+        """Marks `paths` as written; checkpoints every `interval` calls."""
+        new = [p for p in paths if p]
+        self.done.update(new)
+        self.pending.extend(new)
+        self.batches += 1
+        if self.batches % self.interval == 0:
+            self.save()
+
+    def save(self):
+        self.sink.flush()
+        if self.pending:
+            with open(self.log_path, 'ab') as f:
+                f.write(''.join(p + '\n' for p in self.pending).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+                self.done_bytes = f.tell()
+            self.pending = []
+        state = {
+            'chunks': self.sink.num_chunks,
+            'done_bytes': self.done_bytes,
+            'rng': {'cpu': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+        }
+        tmp_path = self.ckpt_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.ckpt_path)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.ckpt_path)))
+
+    def close(self):
+        self.save()
+        self.sink.close()
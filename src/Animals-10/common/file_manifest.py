@@ -0,0 +1,348 @@
+"""
+Persistent file manifest of an image tree, plus duplicate detection.
+
+Listing a tree with os.walk and stat'ing every file takes minutes on NFS. The
+manifest keeps the listing and one entry per image between runs:
+
+    <manifest_dir>/<tree name>-<root hash>.json
+        dirs   relative dir  -> mtime_ns, file names, sub-directory names
+        files  relative path -> size, mtime_ns, sha1 (file bytes), dhash (64-bit difference hash)
+
+Updating it stats each directory once. Adding, removing or renaming an entry
+changes its directory's mtime, so only directories with a new mtime are listed
+again, and only their files are stat'd. Only new or changed files are read to
+compute their hashes. Editing a file in place leaves its directory mtime alone;
+--rescan stats every file. A directory modified within MTIME_SLACK of a scan is
+listed again on the next run, because coarse NFS timestamps could otherwise
+hide a change made in the same tick.
+
+Duplicates:
+    exact  same SHA-1
+    near   dHash within --dedup-distance bits; re-encoded, resized or lightly
+           edited copies (near-uniform images only match exactly)
+
+split_duplicates() keeps one representative per cluster: the first in dataset
+order. fan_out() copies the representative's results to the other members when
+the rows are written.
+
+Build / inspect (run from src/Animals-10):
+    python -m common.file_manifest --root /app/data/pokemon --dedup near
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import Subset
+
+from common.tensor_cache import IMG_EXTENSIONS, NUM_DECODE_THREADS
+
+# --- [Configuration] ---
+DEFAULT_MANIFEST_DIR = '/app/data/_manifest'
+MANIFEST_VERSION = 1
+MTIME_SLACK_NS = 2 * 10 ** 9  # directories modified this close to a scan are listed again next time
+DHASH_SIZE = 8  # 8 x 8 = 64-bit difference hash
+FLAT_RANGE = 8  # grey-level range below which an image is treated as uniform (no reliable dHash)
+NEAR_DISTANCE = 4  # default --dedup-distance (differing dHash bits)
+
+FileStat = namedtuple('FileStat', ['st_size', 'st_mtime_ns'])
+
+
+def add_manifest_args(parser):
+    group = parser.add_argument_group('file manifest / duplicates')
+    group.add_argument('--manifest', nargs='?', const=DEFAULT_MANIFEST_DIR, default=None,
+                       help=f"List the image trees from the incremental file manifest instead of walking them "
+                            f"(default: {DEFAULT_MANIFEST_DIR})")
+    group.add_argument('--rescan', action='store_true',
+                       help="Stat every file while updating the manifest (catches files edited in place)")
+    group.add_argument('--dedup', choices=['exact', 'near'], default=None,
+                       help="Score one representative per duplicate cluster and copy its result to the other "
+                            "members (exact: same bytes, near: also perceptually near-identical); uses the manifest")
+    group.add_argument('--dedup-distance', type=int, default=NEAR_DISTANCE,
+                       help="Max. differing dHash bits for --dedup near")
+    return group
+
+
+def manifest_from_args(args, root_dir):
+    """FileManifest of root_dir when --manifest or --dedup is given, else None."""
+    if not (args.manifest or args.dedup):
+        return None
+    return FileManifest(root_dir, args.manifest or DEFAULT_MANIFEST_DIR, rescan=args.rescan)
+
+
+def manifest_path(manifest_dir, root_dir):
+    root_dir = os.path.abspath(root_dir)
+    root_hash = hashlib.sha1(root_dir.encode('utf-8')).hexdigest()[:8]
+    tree_name = os.path.basename(root_dir.rstrip(os.sep)) or 'root'
+    return os.path.join(manifest_dir, f"{tree_name}-{root_hash}.json")
+
+
+# --- Hashes ---
+def image_hashes(path, hash_size=DHASH_SIZE):
+    """(SHA-1 of the bytes, dHash as hex or None) from a single read of the file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    sha1 = hashlib.sha1(data).hexdigest()
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # JPEG: decode at a reduced scale, the hash only needs a (hash_size + 1) x hash_size thumbnail
+            img.draft('L', (hash_size * 8, hash_size * 8))
+            pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR),
+                                dtype=np.int16)
+    except Exception:
+        return sha1, None
+    if int(pixels.max()) - int(pixels.min()) < FLAT_RANGE:
+        # a uniform image has an all-zero dHash whatever its colour
+        return sha1, None
+    return sha1, np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+def _try_hashes(path):
+    try:
+        return image_hashes(path)
+    except OSError:
+        return None
+
+
+# --- Manifest ---
+class FileManifest:
+    """
+    manifest = FileManifest('/app/data/pokemon')     # loads and incrementally updates the manifest
+    manifest.samples, manifest.classes              # like tensor_cache.scan_images (sorted by path)
+    manifest.stat(path), manifest.sha1(path), manifest.dhash(path)
+    """
+
+    def __init__(self, root_dir, manifest_dir=DEFAULT_MANIFEST_DIR, rescan=False,
+                 num_threads=NUM_DECODE_THREADS, verbose=True):
+        if not os.path.isdir(root_dir):
+            raise FileNotFoundError(f"Image tree not found: {root_dir}")
+        self.root_dir = root_dir
+        self.path = manifest_path(manifest_dir, root_dir)
+        os.makedirs(manifest_dir, exist_ok=True)
+        self._update(rescan, num_threads, verbose)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {'dirs': {}, 'files': {}}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {'dirs': {}, 'files': {}}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {'dirs': {}, 'files': {}}
+        return manifest
+
+    def _full(self, rel):
+        return self.root_dir if rel == '.' else os.path.join(self.root_dir, rel)
+
+    def _update(self, rescan, num_threads, verbose):
+        start = time.perf_counter()
+        old = self._load()
+        old_dirs, old_files = old['dirs'], old['files']
+        scan_ns = time.time_ns()
+        dirs, files, to_hash = {}, {}, []
+        listed = 0
+        stack = ['.']
+        while stack:
+            rel = stack.pop()
+            mtime_ns = os.stat(self._full(rel)).st_mtime_ns
+            entry = old_dirs.get(rel)
+            settled = (entry is not None and entry['mtime_ns'] == mtime_ns
+                       and entry['scanned_ns'] - mtime_ns > MTIME_SLACK_NS)
+            if settled and not rescan:
+                # unchanged listing: reuse the file entries without touching the files
+                for name in entry['files']:
+                    file_rel = name if rel == '.' else os.path.join(rel, name)
+                    if file_rel in old_files:
+                        files[file_rel] = old_files[file_rel]
+            else:
+                listed += 1
+                names, subdirs = [], []
+                with os.scandir(self._full(rel)) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            subdirs.append(e.name)
+                        elif e.name.lower().endswith(IMG_EXTENSIONS):
+                            names.append(e.name)
+                entry = {'mtime_ns': mtime_ns, 'scanned_ns': scan_ns, 'files': sorted(names),
+                         'subdirs': sorted(subdirs)}
+                for name in entry['files']:
+                    file_rel = name if rel == '.' else os.path.join(rel, name)
+                    try:
+                        stat = os.stat(self._full(file_rel))
+                    except OSError:
+                        continue
+                    known = old_files.get(file_rel)
+                    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                        files[file_rel] = known
+                    else:
+                        files[file_rel] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                        to_hash.append(file_rel)
+            dirs[rel] = entry
+            stack.extend(name if rel == '.' else os.path.join(rel, name) for name in entry['subdirs'])
+
+        # one read per new / changed file: SHA-1 of the bytes and the dHash of a draft-decoded thumbnail
+        with ThreadPoolExecutor(max_workers=max(1, num_threads)) as pool:
+            for file_rel, hashes in zip(to_hash, pool.map(_try_hashes, [self._full(r) for r in to_hash])):
+                if hashes is None:
+                    del files[file_rel]  # vanished or unreadable since it was listed
+                    continue
+                files[file_rel]['sha1'], files[file_rel]['dhash'] = hashes
+
+        self.classes = dirs['.']['subdirs']
+        self.entries = {self._full(rel): entry for rel, entry in files.items()}
+        class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = sorted((path, class_to_idx.get(rel.split(os.sep)[0] if os.sep in rel else None, -1),
+                               os.path.basename(rel))
+                              for rel, path in ((rel, self._full(rel)) for rel in files))
+
+        manifest = {'version': MANIFEST_VERSION, 'root': os.path.abspath(self.root_dir), 'dirs': dirs, 'files': files}
+        # per-process temporary name: shards on one tree may update the same manifest at once
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
+        if verbose:
+            print(f">>> [Manifest] {self.root_dir}: {len(files)} images, {listed}/{len(dirs)} directories listed, "
+                  f"{len(to_hash)} hashed ({time.perf_counter() - start:.2f} s)")
+
+    def __len__(self):
+        return len(self.samples)
+
+    def stat(self, path):
+        entry = self.entries[path]
+        return FileStat(entry['size'], entry['mtime_ns'])
+
+    def sha1(self, path):
+        return self.entries[path]['sha1']
+
+    def dhash(self, path):
+        return self.entries[path].get('dhash')
+
+    def hashes(self):
+        """path -> SHA-1 of every image (ScoreStore.seed_hashes)."""
+        return {path: entry['sha1'] for path, entry in self.entries.items()}
+
+
+# --- Duplicates ---
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def duplicate_groups(paths, manifest, mode='exact', distance=NEAR_DISTANCE):
+    """
+    {representative path: [member paths]} for the clusters among `paths` with more than one image.
+    The representative is the cluster's first path in the given order; paths missing from the manifest
+    (e.g. failed to read) are left alone.
+    """
+    known = [i for i, p in enumerate(paths) if p in manifest.entries]
+    parent = list(range(len(paths)))
+
+    def union(i, j):
+        a, b = _find(parent, i), _find(parent, j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    first = {}
+    for i in known:
+        union(i, first.setdefault(manifest.sha1(paths[i]), i))
+
+    if mode == 'near':
+        by_hash = {}
+        for i in known:
+            value = manifest.dhash(paths[i])
+            if value is not None:
+                union(i, by_hash.setdefault(int(value, 16), i))
+        # pigeonhole: two 64-bit hashes within `distance` bits agree exactly on one of distance + 1 bands
+        hashes = list(by_hash.items())
+        bands = distance + 1
+        width = -(-DHASH_SIZE * DHASH_SIZE // bands)
+        for band in range(bands):
+            mask = (1 << width) - 1
+            buckets = {}
+            for value, i in hashes:
+                buckets.setdefault((value >> (band * width)) & mask, []).append((value, i))
+            for bucket in buckets.values():
+                for a in range(len(bucket)):
+                    for b in range(a + 1, len(bucket)):
+                        if bin(bucket[a][0] ^ bucket[b][0]).count('1') <= distance:
+                            union(bucket[a][1], bucket[b][1])
+
+    groups = {}
+    for i in known:
+        root = _find(parent, i)
+        if root != i:
+            groups.setdefault(paths[root], []).append(paths[i])
+    return groups
+
+
+def split_duplicates(dataset, manifest, mode, distance=NEAR_DISTANCE):
+    """(Subset with one representative per duplicate cluster, {representative path: [member paths]})"""
+    if not mode or manifest is None:
+        return dataset, {}
+    if isinstance(dataset, Subset):
+        base, indices = dataset.dataset, list(dataset.indices)
+    else:
+        base, indices = dataset, list(range(len(dataset)))
+    paths = [base.samples[i][0] for i in indices]
+    groups = duplicate_groups(paths, manifest, mode, distance)
+    members = {p for group in groups.values() for p in group}
+    kept = [i for i, p in zip(indices, paths) if p not in members]
+    print(f">>> [Dedup] {len(paths)} images, {len(groups)} duplicate clusters: scoring {len(kept)} "
+          f"({len(members)} results copied from their cluster's representative)")
+    return Subset(base, kept), groups
+
+
+def fan_out(groups, paths, *columns):
+    """
+    Adds a row per cluster member after its representative's row, with the representative's values.
+    Returns (paths, *columns) with the same column types (numpy arrays or lists).
+    """
+    if not groups:
+        return (paths,) + columns
+    take, out_paths = [], []
+    for i, path in enumerate(paths):
+        take.append(i)
+        out_paths.append(path)
+        for member in groups.get(path, ()):
+            take.append(i)
+            out_paths.append(member)
+    take = np.array(take, dtype=np.int64)
+    return (out_paths,) + tuple(c[take] if isinstance(c, np.ndarray) else [c[i] for i in take] for c in columns)
+
+
+def write_groups(path, groups):
+    """Saves the clusters of a run ({representative: [members]}) next to its results."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(groups, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build / update file manifests and report duplicate images")
+    parser.add_argument('--root', type=str, nargs='+', required=True, help="Image tree(s)")
+    parser.add_argument('--manifest-dir', type=str, default=DEFAULT_MANIFEST_DIR)
+    parser.add_argument('--rescan', action='store_true', help="Stat every file")
+    parser.add_argument('--dedup', choices=['exact', 'near'], default='exact')
+    parser.add_argument('--dedup-distance', type=int, default=NEAR_DISTANCE)
+    parser.add_argument('--threads', type=int, default=NUM_DECODE_THREADS)
+    args = parser.parse_args()
+
+    for root_dir in args.root:
+        manifest = FileManifest(root_dir, args.manifest_dir, rescan=args.rescan, num_threads=args.threads)
+        groups = duplicate_groups([path for path, _, _ in manifest.samples], manifest, args.dedup,
+                                  args.dedup_distance)
+        duplicates = sum(len(members) for members in groups.values())
+        print(f">>> [Manifest] {manifest.path}: {duplicates} of {len(manifest)} images "
+              f"({duplicates / max(len(manifest), 1):.1%}) duplicate another one ({args.dedup})")
@@ -0,0 +1,280 @@
+"""
+Opt-in per-stage instrumentation for the evaluation loops.
+
+    profiler = StageProfiler(enabled=args.profile, run_dir=run_dir, device=DEVICE)
+    for images, paths, names in profiler.iterate(loader):      # times the data-loading wait
+        with profiler.stage('h2d'):
+            images = images.to(DEVICE)
+        ...
+        profiler.count('images', len(paths))
+        profiler.gauge('queue_depth', sorter.pending(), queue='sorted_output')
+        profiler.step()                                         # periodic export + torch.profiler window
+    profiler.finish()
+
+StartupTimer measures the cold start of an entry point, from process start
+(interpreter + imports) through weight loading and model construction:
+
+    startup = StartupTimer()                                   # right after the module imports
+    model = load_model(factory, MODEL_PATH, DEVICE, startup)   # common.weights: 'weights' / 'model' phases
+    startup.report(profiler)                                   # once, before the first batch
+
+Exports, when enabled:
+    <run_dir>/<prefix>profile_summary.json   at the end (stage totals, counters, peak RSS)
+    <run_dir>/<prefix>metrics.prom           Prometheus text format, rewritten every --profile-interval s
+    <run_dir>/<prefix>torch_trace.json       Chrome trace of the optional --torch-profile window
+
+A disabled profiler only costs a few attribute lookups per call.
+"""
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+EXPORT_INTERVAL = 10.0  # seconds between metrics.prom rewrites
+METRIC_PREFIX = 'ood_eval'
+
+
+def add_profiling_args(parser):
+    group = parser.add_argument_group('profiling')
+    group.add_argument('--profile', action='store_true',
+                       help="Record per-stage timers / counters and export them to the run directory")
+    group.add_argument('--profile-interval', type=float, default=EXPORT_INTERVAL,
+                       help="Seconds between Prometheus text file updates")
+    group.add_argument('--torch-profile', type=str, default=None, metavar='SKIP:STEPS',
+                       help="Also record a torch.profiler trace of STEPS batches after SKIP batches, e.g. 10:5")
+    return group
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def memory_breakdown():
+    """
+    Current RSS split into shared / private pages plus PSS (shared pages divided by their sharers), in bytes,
+    from /proc/self/smaps_rollup. PSS is the fair per-process share when several processes map the same
+    weights; RSS counts those pages in full for each of them. Empty dict where the file does not exist.
+    """
+    fields = {'Rss': 'rss_bytes', 'Pss': 'pss_bytes', 'Shared_Clean': 'shared_clean', 'Shared_Dirty': 'shared_dirty',
+              'Private_Clean': 'private_clean', 'Private_Dirty': 'private_dirty'}
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup', encoding='ascii') as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in fields:
+                    values[fields[name]] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return {}
+    return {'rss_bytes': values.get('rss_bytes', 0), 'pss_bytes': values.get('pss_bytes', 0),
+            'shared_bytes': values.get('shared_clean', 0) + values.get('shared_dirty', 0),
+            'private_bytes': values.get('private_clean', 0) + values.get('private_dirty', 0)}
+
+
+class StageProfiler:
+    def __init__(self, enabled=False, run_dir=None, device=None, prefix='', interval=EXPORT_INTERVAL,
+                 torch_profile=None):
+        self.enabled = enabled
+        self.run_dir = run_dir
+        self.prefix = prefix
+        self.interval = interval
+        self.sync_cuda = device is not None and torch.device(device).type == 'cuda'
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start_time = time.perf_counter()
+        self.last_export = self.start_time
+        self.steps = 0
+        self._torch_prof = None
+
+        if enabled and torch_profile:
+            skip, steps = (int(v) for v in torch_profile.split(':'))
+            self._torch_prof = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU] +
+                           ([torch.profiler.ProfilerActivity.CUDA] if self.sync_cuda else []),
+                schedule=torch.profiler.schedule(wait=max(0, skip - 1), warmup=min(1, skip), active=steps, repeat=1),
+                on_trace_ready=self._save_trace, record_shapes=True)
+            self._torch_prof.start()
+
+    def _path(self, name):
+        return os.path.join(self.run_dir, f"{self.prefix}{name}")
+
+    def _add(self, name, elapsed):
+        self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self._add(name, time.perf_counter() - start)
+
+    def stage(self, name):
+        return self._timed(name) if self.enabled else nullcontext()
+
+    def iterate(self, iterable, name='data_wait'):
+        """Yields from iterable, timing how long each next() blocks."""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._add(name, time.perf_counter() - start)
+            yield item
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value, **labels):
+        if self.enabled:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def step(self):
+        """Call once per batch."""
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self._torch_prof is not None:
+            self._torch_prof.step()
+        now = time.perf_counter()
+        if self.run_dir and now - self.last_export >= self.interval:
+            self.write_prometheus()
+            self.last_export = now
+
+    def _save_trace(self, prof):
+        path = self._path('torch_trace.json')
+        prof.export_chrome_trace(path)
+        print(f">>> [Profile] torch.profiler trace saved to {path}")
+
+    def summary(self):
+        wall = time.perf_counter() - self.start_time
+        images = self.counters.get('images', 0)
+        return {
+            'wall_seconds': wall,
+            'batches': self.steps,
+            'images_per_sec': images / wall if wall > 0 else 0.0,
+            'peak_rss_bytes': peak_rss_bytes(),
+            'stages': {name: {'seconds': sec, 'calls': self.calls[name],
+                              'fraction_of_wall': sec / wall if wall > 0 else 0.0}
+                       for name, sec in sorted(self.seconds.items(), key=lambda kv: -kv[1])},
+            'counters': dict(self.counters),
+            'gauges': {name + ''.join(f'[{k}={v}]' for k, v in labels): value
+                       for (name, labels), value in self.gauges.items()},
+        }
+
+    def write_prometheus(self):
+        summary = self.summary()
+        p = METRIC_PREFIX
+        lines = [f"# TYPE {p}_stage_seconds_total counter"]
+        lines += [f'{p}_stage_seconds_total{{stage="{n}"}} {s:.6f}' for n, s in self.seconds.items()]
+        lines += [f"# TYPE {p}_stage_calls_total counter"]
+        lines += [f'{p}_stage_calls_total{{stage="{n}"}} {c}' for n, c in self.calls.items()]
+        for name, value in self.counters.items():
+            lines += [f"# TYPE {p}_{name}_total counter", f"{p}_{name}_total {value}"]
+        for (name, labels), value in self.gauges.items():
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines += [f"{p}_{name}{{{label_str}}} {value}" if label_str else f"{p}_{name} {value}"]
+        lines += [f"# TYPE {p}_peak_rss_bytes gauge", f"{p}_peak_rss_bytes {summary['peak_rss_bytes']}",
+                  f"# TYPE {p}_images_per_second gauge", f"{p}_images_per_second {summary['images_per_sec']:.3f}",
+                  f"# TYPE {p}_wall_seconds gauge", f"{p}_wall_seconds {summary['wall_seconds']:.3f}"]
+        # atomic replace so a scraper never reads a half-written file
+        path = self._path('metrics.prom')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def finish(self):
+        """Stops the torch.profiler window and writes the final exports. Returns the summary (or None)."""
+        if not self.enabled:
+            return None
+        if self._torch_prof is not None:
+            self._torch_prof.stop()
+            self._torch_prof = None
+        summary = self.summary()
+        if self.run_dir:
+            self.write_prometheus()
+            with open(self._path('profile_summary.json'), 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+        print(f">>> [Profile] {summary['images_per_sec']:.1f} img/s, peak RSS "
+              f"{summary['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+        for name, stage in summary['stages'].items():
+            print(f"    {name:<20} {stage['seconds']:9.3f} s  {stage['fraction_of_wall']:6.1%}  ({stage['calls']} calls)")
+        return summary
+
+
+NULL_PROFILER = StageProfiler(enabled=False)
+
+
+def process_start_time():
+    """Wall-clock (time.time()) start of this process, from /proc on Linux; None elsewhere."""
+    try:
+        with open('/proc/self/stat', encoding='ascii') as f:
+            # field 22 (starttime, clock ticks after boot); the command name in field 2 may contain spaces
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', encoding='ascii') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return time.time() - (uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+class StartupTimer:
+    def __init__(self):
+        now = time.time()
+        started = process_start_time()
+        self.start = started if started is not None and started <= now else now
+        self.phases = {'imports': now - self.start}
+        self.notes = {}
+        self.reported = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def note(self, name, text):
+        self.notes[name] = text
+
+    def total(self):
+        return time.time() - self.start
+
+    def summary(self):
+        return {'startup_seconds': self.total(), 'phases': dict(self.phases), 'notes': dict(self.notes)}
+
+    def report(self, profiler=None, file=None):
+        """Prints the startup breakdown (once, to stdout or `file`) and records it as profiler gauges."""
+        if self.reported:
+            return
+        self.reported = True
+        total = self.total()
+        parts = [f"{name} {sec:.2f} s" + (f" ({self.notes[name]})" if name in self.notes else "")
+                 for name, sec in self.phases.items()]
+        # lazy imports, dataset scans, ... between the timed phases
+        other = total - sum(self.phases.values())
+        if other >= 0.01:
+            parts.append(f"other {other:.2f} s")
+        print(f">>> [Startup] Ready after {total:.2f} s: " + ", ".join(parts), file=file, flush=True)
+        if profiler is not None:
+            profiler.gauge('startup_seconds', total)
+            for name, sec in self.phases.items():
+                profiler.gauge('startup_phase_seconds', sec, phase=name)
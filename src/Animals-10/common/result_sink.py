@@ -0,0 +1,205 @@
+"""
+Columnar, chunked per-image result files.
+
+The evaluators append whole batches of typed columns to a ResultSink instead
+of formatting one CSV row per image. Rows are buffered in preallocated NumPy
+arrays and written as numbered chunks:
+
+    <sink_dir>/schema.json            column name -> dtype ('str' = UTF-8 text)
+    <sink_dir>/chunk_000000.npz       one array per column, CHUNK_ROWS rows at most
+    <sink_dir>/chunk_000001.npz       ...
+
+Each chunk is written to a temporary file, fsync'd and renamed, so a chunk on
+disk is always complete. flush() also writes a short chunk for the rows
+buffered so far (used by EvalCheckpoint). A sink opened with keep_chunks=N
+drops every chunk after the first N, which is how a resumed run discards rows
+written after its last checkpoint.
+
+Readers never need the whole file in memory: iter_chunks() streams chunks and
+loads only the requested columns (each column is a separate .npz member),
+read_columns() concatenates a few numeric columns for metrics, and
+histograms() bins a column chunk by chunk. export_csv() writes a CSV on demand.
+
+    python -m common.result_sink <sink_dir> [out.csv]     # raw CSV export, run from src/Animals-10
+"""
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+CHUNK_ROWS = 65536
+SCHEMA_FILE = 'schema.json'
+STR = 'str'
+
+
+def add_result_args(parser):
+    group = parser.add_argument_group('result output')
+    group.add_argument('--export-csv', action='store_true',
+                       help="Also export the columnar per-image results as a CSV report at the end of the run")
+    return group
+
+
+def _fsync_dir(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def chunk_files(sink_dir):
+    return sorted(f for f in os.listdir(sink_dir) if f.startswith('chunk_') and f.endswith('.npz'))
+
+
+def load_schema(sink_dir):
+    with open(os.path.join(sink_dir, SCHEMA_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+class ResultSink:
+    """
+    sink = ResultSink(out_dir, {'path': 'str', 'label': 'int8', 'score': 'float32'})
+    sink.append(path=paths, label=np.zeros(n, np.int8), score=scores)   # one call per batch
+    sink.close()
+    """
+
+    def __init__(self, sink_dir, schema, chunk_rows=CHUNK_ROWS, keep_chunks=None):
+        self.sink_dir = sink_dir
+        self.schema = dict(schema)
+        self.chunk_rows = max(1, chunk_rows)
+        os.makedirs(sink_dir, exist_ok=True)
+
+        existing = chunk_files(sink_dir)
+        keep = existing[:keep_chunks] if keep_chunks is not None else []
+        for name in existing[len(keep):]:
+            os.remove(os.path.join(sink_dir, name))
+        self.num_chunks = len(keep)
+        self.rows = sum(self._chunk_len(name) for name in keep)
+
+        with open(os.path.join(sink_dir, SCHEMA_FILE), 'w', encoding='utf-8') as f:
+            json.dump(self.schema, f)
+        self._buffers = {name: [] if dtype == STR else np.empty(self.chunk_rows, dtype=dtype)
+                         for name, dtype in self.schema.items()}
+        self._fill = 0
+
+    def _chunk_len(self, name):
+        with np.load(os.path.join(self.sink_dir, name)) as chunk:
+            return len(chunk[next(iter(self.schema))])
+
+    def append(self, **columns):
+        """Appends one batch; every schema column must be given with the same length."""
+        missing = set(self.schema) - set(columns)
+        if missing:
+            raise ValueError(f"Missing result columns: {sorted(missing)}")
+        n = len(columns[next(iter(self.schema))])
+        start = 0
+        while start < n:
+            take = min(n - start, self.chunk_rows - self._fill)
+            for name, dtype in self.schema.items():
+                values = columns[name][start:start + take]
+                if dtype == STR:
+                    self._buffers[name].extend(values)
+                else:
+                    self._buffers[name][self._fill:self._fill + take] = values
+            self._fill += take
+            start += take
+            if self._fill == self.chunk_rows:
+                self.flush()
+        self.rows += n
+
+    def flush(self):
+        """Writes the buffered rows (if any) as the next chunk."""
+        if self._fill == 0:
+            return
+        arrays = {}
+        for name, dtype in self.schema.items():
+            if dtype == STR:
+                arrays[name] = np.array([s.encode('utf-8') for s in self._buffers[name]], dtype=np.bytes_)
+                self._buffers[name] = []
+            else:
+                arrays[name] = self._buffers[name][:self._fill]
+        path = os.path.join(self.sink_dir, f"chunk_{self.num_chunks:06d}.npz")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        _fsync_dir(self.sink_dir)
+        self.num_chunks += 1
+        self._fill = 0
+
+    def close(self):
+        self.flush()
+
+
+# --- Reading ---
+def iter_chunks(sink_dir, columns=None):
+    """Yields {column: array} per chunk, loading only `columns` (default: all); text comes back as str arrays."""
+    schema = load_schema(sink_dir)
+    columns = list(schema) if columns is None else columns
+    for name in chunk_files(sink_dir):
+        with np.load(os.path.join(sink_dir, name)) as chunk:
+            yield {c: np.char.decode(chunk[c], 'utf-8') if schema[c] == STR else chunk[c] for c in columns}
+
+
+def read_columns(sink_dir, columns):
+    """Concatenated arrays of a few columns (meant for numeric columns: labels, scores, ...)."""
+    parts = {c: [] for c in columns}
+    for chunk in iter_chunks(sink_dir, columns):
+        for c in columns:
+            parts[c].append(chunk[c])
+    schema = load_schema(sink_dir)
+    return {c: np.concatenate(parts[c]) if parts[c] else np.empty(0, dtype=object if schema[c] == STR else schema[c])
+            for c in columns}
+
+
+def histograms(sink_dir, column, by, bins=50):
+    """
+    Per-group histograms of `column`, grouped by the values of column `by`, in two
+    streaming passes (range, then counts). Returns (bin_edges, {group: counts}).
+    """
+    low, high = np.inf, -np.inf
+    for chunk in iter_chunks(sink_dir, [column]):
+        if len(chunk[column]):
+            low = min(low, float(chunk[column].min()))
+            high = max(high, float(chunk[column].max()))
+    if low > high:
+        return np.linspace(0.0, 1.0, bins + 1), {}
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    edges = np.linspace(low, high, bins + 1)
+    counts = {}
+    for chunk in iter_chunks(sink_dir, [column, by]):
+        for group in np.unique(chunk[by]):
+            values = chunk[column][chunk[by] == group]
+            counts[group.item()] = counts.get(group.item(), 0) + np.histogram(values, bins=edges)[0]
+    return edges, counts
+
+
+def export_csv(sink_dir, out_csv, header=None, row_columns=None):
+    """
+    Streams the sink into a CSV. row_columns(chunk) -> list of per-CSV-column sequences
+    (default: the raw columns in schema order, header = column names).
+    """
+    schema = load_schema(sink_dir)
+    header = header or list(schema)
+    rows = 0
+    with open(out_csv, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for chunk in iter_chunks(sink_dir):
+            columns = row_columns(chunk) if row_columns else [chunk[c].tolist() for c in schema]
+            writer.writerows(zip(*columns))
+            rows += len(columns[0])
+    print(f">>> Exported {rows} rows to {out_csv}")
+    return out_csv
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: python -m common.result_sink <sink_dir> [out.csv]")
+    export_csv(sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else os.path.normpath(sys.argv[1]) + '.csv')
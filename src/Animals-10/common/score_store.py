@@ -0,0 +1,135 @@
+"""
+Persistent, content-addressed store of per-image OOD scores.
+
+Scores are keyed by (model weights hash, scoring config hash, image content
+hash), so a re-evaluation with the same checkpoint only needs to score images
+that are new or whose bytes changed. Everything lives in one SQLite file:
+
+    scores       (model_hash, config_hash, content_hash) -> JSON values
+    file_hashes  path -> (size, mtime_ns, sha1)   so unchanged files are not re-read
+    model_hashes path -> (size, mtime_ns, sha256)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    model_hash   TEXT NOT NULL,
+    config_hash  TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    vals         TEXT NOT NULL,
+    PRIMARY KEY (model_hash, config_hash, content_hash)
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS model_hashes (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256   TEXT NOT NULL
+);
+"""
+
+
+def _hash_file(path, algorithm, chunk_size=1 << 20):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ScoreStore:
+    """
+    store = ScoreStore(db_path, MODEL_PATH, {'scorer': 'mc_entropy', 'samples': 30})
+    hits, misses = store.partition(paths)     # hits: {index: values}, misses: [index, ...]
+    ... score the misses ...
+    store.put(path, values)                   # path must come from a previous partition()
+    store.commit()
+    """
+
+    def __init__(self, db_path, model_path, config):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # timeout: several evaluators (e.g. shards) may share the same store
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.db_path = db_path
+        self.config = config
+        self.config_hash = config_hash(config)
+        self.model_hash = self._model_hash(model_path)
+        self._content_hashes = {}
+
+    def _model_hash(self, model_path):
+        stat = os.stat(model_path)
+        row = self.conn.execute("SELECT size, mtime_ns, sha256 FROM model_hashes WHERE path = ?",
+                                (model_path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = _hash_file(model_path, 'sha256')
+        self.conn.execute("INSERT OR REPLACE INTO model_hashes VALUES (?, ?, ?, ?)",
+                          (model_path, stat.st_size, stat.st_mtime_ns, digest))
+        self.conn.commit()
+        return digest
+
+    def seed_hashes(self, hashes):
+        """Known content hashes (path -> SHA-1, e.g. from a file manifest): those files are not stat'd or read."""
+        self._content_hashes.update(hashes)
+
+    def content_hash(self, path):
+        """SHA-1 of the file bytes, re-read only when size / mtime changed."""
+        digest = self._content_hashes.get(path)
+        if digest is not None:
+            return digest
+        stat = os.stat(path)
+        row = self.conn.execute("SELECT size, mtime_ns, sha1 FROM file_hashes WHERE path = ?",
+                                (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            digest = row[2]
+        else:
+            digest = _hash_file(path, 'sha1')
+            self.conn.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns, digest))
+        self._content_hashes[path] = digest
+        return digest
+
+    def partition(self, paths):
+        """Splits paths into already-scored (index -> values) and to-score indices."""
+        hits, misses = {}, []
+        for i, path in enumerate(paths):
+            try:
+                digest = self.content_hash(path)
+            except OSError:
+                misses.append(i)
+                continue
+            row = self.conn.execute(
+                "SELECT vals FROM scores WHERE model_hash = ? AND config_hash = ? AND content_hash = ?",
+                (self.model_hash, self.config_hash, digest)).fetchone()
+            if row:
+                hits[i] = json.loads(row[0])
+            else:
+                misses.append(i)
+        self.conn.commit()
+        return hits, misses
+
+    def put(self, path, values):
+        digest = self.content_hash(path)
+        self.conn.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                          (self.model_hash, self.config_hash, digest, json.dumps(values)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
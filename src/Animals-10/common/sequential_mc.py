@@ -0,0 +1,166 @@
+"""
+Adaptive (sequential) MC sampling with per-image early stopping.
+
+Samples are drawn in chunks. After each chunk, every still-active image gets a
+running score estimate and a standard error. An image stops once
+min_samples have been drawn and the interval score +/- z * stderr lies
+entirely on one side of the decision threshold. Otherwise it stops at
+max_samples. Clearly-ID and clearly-OOD images therefore use only a few
+draws, and only borderline images pay for the full budget.
+
+The model-specific part is a `draw(active, n)` callable that returns n MC
+draws for the images selected by the boolean mask `active`, plus an
+accumulator that turns running sums into (score, stderr):
+
+    EntropyAccumulator  - classifier: predictive entropy of the mean softmax
+    ElboAccumulator     - BayesianVAE: E[-ELBO] + alpha * latent variance
+"""
+import argparse
+
+import torch
+
+# --- [Defaults] ---
+MIN_SAMPLES = 8
+MAX_SAMPLES = 30
+CHUNK_SIZE = 4
+CONFIDENCE_Z = 2.576  # two-sided 99% normal interval
+
+
+def _positive_int(value):
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def add_adaptive_args(parser, max_samples=MAX_SAMPLES):
+    """Shared command-line options for the adaptive sampling mode."""
+    group = parser.add_argument_group('adaptive MC sampling')
+    group.add_argument('--adaptive', action='store_true',
+                       help="Draw MC samples in chunks and stop per image once the decision is clear")
+    group.add_argument('--min-samples', type=_positive_int, default=MIN_SAMPLES)
+    group.add_argument('--max-samples', type=_positive_int, default=max_samples)
+    group.add_argument('--chunk-size', type=_positive_int, default=CHUNK_SIZE)
+    group.add_argument('--confidence-z', type=float, default=CONFIDENCE_Z,
+                       help="Stop when |score - threshold| > z * stderr")
+    return group
+
+
+def adaptive_config(args):
+    """Keyword arguments for sequential_mc() taken from parsed add_adaptive_args() options."""
+    if args.min_samples > args.max_samples:
+        raise ValueError(f"--min-samples ({args.min_samples}) must not exceed --max-samples ({args.max_samples})")
+    return {'min_samples': args.min_samples, 'max_samples': args.max_samples,
+            'chunk_size': args.chunk_size, 'z': args.confidence_z}
+
+
+def sequential_mc(draw, accumulator, threshold, min_samples=MIN_SAMPLES, max_samples=MAX_SAMPLES,
+                  chunk_size=CHUNK_SIZE, z=CONFIDENCE_Z):
+    """
+    Returns (score [B], n_samples [B]) and leaves the final sums in `accumulator`.
+    """
+    batch_size = accumulator.batch_size
+    device = accumulator.device
+    active = torch.ones(batch_size, dtype=torch.bool, device=device)
+
+    while bool(active.any()):
+        drawn = int(accumulator.n[active].max().item())
+        n = min(chunk_size, max_samples - drawn)
+        # the first chunk already covers min_samples, so the first decision needs no extra round
+        if drawn == 0:
+            n = min(max(n, min_samples), max_samples)
+        accumulator.update(active, draw(active, n))
+
+        score, stderr = accumulator.estimate()
+        decided = (score - threshold).abs() > z * stderr
+        done = (accumulator.n >= max_samples) | ((accumulator.n >= min_samples) & decided)
+        active &= ~done
+
+    score, _ = accumulator.estimate()
+    return score, accumulator.n.clone()
+
+
+class EntropyAccumulator:
+    """
+    Running sums of MC softmax draws p_s [B, C].
+
+    score  = H(mean_s p_s)
+    stderr = delta method: the gradient g = -(log p_mean + 1) projects each draw to g . p_s,
+             so stderr = std_s(g . p_s) / sqrt(n)
+    """
+
+    def __init__(self, batch_size, num_classes, device, epsilon=1e-12):
+        self.batch_size = batch_size
+        self.device = device
+        self.epsilon = epsilon
+        self.n = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.sum_p = torch.zeros(batch_size, num_classes, device=device)
+        self.sum_pp = torch.zeros(batch_size, num_classes, num_classes, device=device)
+
+    def update(self, active, probs):
+        """probs: [n, A, C] draws for the A active images."""
+        self.n[active] += probs.shape[0]
+        self.sum_p[active] += probs.sum(dim=0)
+        self.sum_pp[active] += torch.einsum('sac,sad->acd', probs, probs)
+
+    def mean_probs(self):
+        return self.sum_p / self.n.clamp(min=1).unsqueeze(1)
+
+    def estimate(self):
+        n = self.n.clamp(min=1).float()
+        mean = self.mean_probs()
+        log_mean = torch.log(mean + self.epsilon)
+        score = -torch.sum(mean * log_mean, dim=1)
+
+        g = -(log_mean + 1.0)
+        cov = self.sum_pp / n.view(-1, 1, 1) - mean.unsqueeze(2) * mean.unsqueeze(1)
+        var = torch.einsum('bc,bcd,bd->b', g, cov, g).clamp(min=0) * n / (n - 1).clamp(min=1)
+        return score, torch.sqrt(var / n)
+
+
+class ElboAccumulator:
+    """
+    Running sums of per-draw negative ELBO [B] and latent mean mu [B, D].
+
+    score  = mean(-ELBO) + alpha * sum_d var_d(mu)
+    stderr = sqrt(var(-ELBO) / n + alpha^2 * sum_d 2 var_d^2 / (n - 1))
+             (normal approximation for the sampling error of each variance estimate)
+    """
+
+    def __init__(self, batch_size, latent_dim, device, alpha):
+        self.batch_size = batch_size
+        self.device = device
+        self.alpha = alpha
+        self.n = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.sum_elbo = torch.zeros(batch_size, device=device, dtype=torch.float64)
+        self.sum_elbo2 = torch.zeros(batch_size, device=device, dtype=torch.float64)
+        self.sum_mu = torch.zeros(batch_size, latent_dim, device=device, dtype=torch.float64)
+        self.sum_mu2 = torch.zeros(batch_size, latent_dim, device=device, dtype=torch.float64)
+
+    def update(self, active, draws):
+        """draws: (elbo [n, A], mu [n, A, D]) for the A active images."""
+        elbo, mu = draws
+        elbo, mu = elbo.double(), mu.double()
+        self.n[active] += elbo.shape[0]
+        self.sum_elbo[active] += elbo.sum(dim=0)
+        self.sum_elbo2[active] += elbo.pow(2).sum(dim=0)
+        self.sum_mu[active] += mu.sum(dim=0)
+        self.sum_mu2[active] += mu.pow(2).sum(dim=0)
+
+    def components(self):
+        """(expected -ELBO [B], latent variance [B], -ELBO variance [B], per-dim mu variance [B, D])"""
+        n = self.n.clamp(min=1).double()
+        dof = (n - 1).clamp(min=1)
+        mean_elbo = self.sum_elbo / n
+        var_elbo = (self.sum_elbo2 - n * mean_elbo.pow(2)).clamp(min=0) / dof
+        mean_mu = self.sum_mu / n.unsqueeze(1)
+        var_mu = (self.sum_mu2 - n.unsqueeze(1) * mean_mu.pow(2)).clamp(min=0) / dof.unsqueeze(1)
+        return mean_elbo, var_mu.sum(dim=1), var_elbo, var_mu
+
+    def estimate(self):
+        n = self.n.clamp(min=1).double()
+        dof = (n - 1).clamp(min=1)
+        mean_elbo, latent_var, var_elbo, var_mu = self.components()
+        score = mean_elbo + self.alpha * latent_var
+        stderr = torch.sqrt(var_elbo / n + self.alpha ** 2 * 2 * var_mu.pow(2).sum(dim=1) / dof)
+        return score.float(), stderr.float()
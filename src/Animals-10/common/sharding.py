@@ -0,0 +1,156 @@
+"""
+Sharded evaluation helpers.
+
+An evaluation run can be split into N shards. Shard k scores a deterministic,
+contiguous slice of each (sorted) file list and writes its rows to the
+result sink <run_dir>/shards/part_<k>_of_<N>/. A merge step then links the
+parts' chunks, in shard order, into one run-level sink and produces the usual
+report. Shards can run as local
+worker processes (--workers N, each pinned to its own CPU set and torch
+thread count) or on several machines that share <run_dir> (--num-shards N
+--shard-index k --run-dir ... on each, then --merge <run_dir> once).
+"""
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+import torch
+
+from common.result_sink import ResultSink, chunk_files, load_schema
+
+SHARD_DIR_NAME = 'shards'
+
+
+def add_shard_args(parser):
+    group = parser.add_argument_group('sharded evaluation')
+    group.add_argument('--workers', type=int, default=1,
+                       help="Launch N local shard processes and merge their results")
+    group.add_argument('--num-shards', type=int, default=1, help="Total number of shards (multi-node mode)")
+    group.add_argument('--shard-index', type=int, default=0, help="Shard scored by this process")
+    group.add_argument('--run-dir', type=str, default=None,
+                       help="Existing / shared run directory to write into instead of a new run_N")
+    group.add_argument('--merge', type=str, default=None, metavar='RUN_DIR',
+                       help="Only merge the shard files of RUN_DIR into the final report")
+    group.add_argument('--threads', type=int, default=None, help="torch intra-op threads for this process")
+    group.add_argument('--cpus', type=str, default=None, help="Pin this process to a CPU list, e.g. 0-15,32-47")
+    return group
+
+
+def parse_cpu_list(spec):
+    cpus = set()
+    for part in spec.split(','):
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.update(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    return ','.join(str(c) for c in cpus)
+
+
+def configure_worker(threads=None, cpus=None):
+    """Pins the process to `cpus` (list spec) and sets torch's intra-op thread count."""
+    if cpus:
+        cpu_list = parse_cpu_list(cpus)
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpu_list)
+        if threads is None:
+            threads = len(cpu_list)
+    if threads:
+        torch.set_num_threads(threads)
+
+
+def shard_range(n, num_shards, shard_index):
+    """[start, stop) of the contiguous slice of n items owned by shard_index."""
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard index {shard_index} out of range for {num_shards} shards")
+    base, extra = divmod(n, num_shards)
+    start = shard_index * base + min(shard_index, extra)
+    return start, start + base + (1 if shard_index < extra else 0)
+
+
+def shard_indices(n, num_shards, shard_index):
+    return list(range(*shard_range(n, num_shards, shard_index)))
+
+
+def shard_sink_path(run_dir, num_shards, shard_index):
+    shard_dir = os.path.join(run_dir, SHARD_DIR_NAME)
+    os.makedirs(shard_dir, exist_ok=True)
+    return os.path.join(shard_dir, f"part_{shard_index:03d}_of_{num_shards:03d}")
+
+
+def run_id_from_dir(run_dir):
+    match = re.search(r'run_(\d+)$', os.path.normpath(run_dir))
+    return int(match.group(1)) if match else os.path.basename(os.path.normpath(run_dir))
+
+
+def launch_local_shards(script, argv, num_workers, run_dir, threads=None):
+    """
+    Runs `script` num_workers times in parallel, one shard each, splitting the
+    available CPUs into equal contiguous sets. Returns when all have finished.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    per_worker = max(1, len(cpus) // num_workers)
+    procs = []
+    for k in range(num_workers):
+        cmd = [sys.executable, script, *argv, '--num-shards', str(num_workers), '--shard-index', str(k),
+               '--run-dir', run_dir]
+        worker_cpus = cpus[k * per_worker:(k + 1) * per_worker]
+        if worker_cpus and len(cpus) >= num_workers:
+            cmd += ['--cpus', format_cpu_list(worker_cpus)]
+        cmd += ['--threads', str(threads or per_worker)]
+        procs.append(subprocess.Popen(cmd))
+    failed = [k for k, p in enumerate(procs) if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shard worker(s) {failed} failed")
+
+
+def strip_launcher_args(argv):
+    """Removes the options that launch_local_shards() sets itself from argv."""
+    drop_with_value = {'--workers', '--num-shards', '--shard-index', '--run-dir', '--threads', '--cpus', '--merge'}
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        key = arg.split('=', 1)[0]
+        if key in drop_with_value:
+            skip = '=' not in arg
+            continue
+        out.append(arg)
+    return out
+
+
+def merge_shard_sinks(run_dir, out_dir):
+    """
+    Links the chunks of all part sinks of run_dir (in shard order) into the sink out_dir.
+    Returns the number of chunks.
+    """
+    shard_dir = os.path.join(run_dir, SHARD_DIR_NAME)
+    parts = sorted(f for f in os.listdir(shard_dir)
+                   if re.fullmatch(r'part_\d+_of_\d+', f) and os.path.isdir(os.path.join(shard_dir, f)))
+    if not parts:
+        raise FileNotFoundError(f"No shard results found in {shard_dir}")
+    expected = int(re.search(r'_of_(\d+)$', parts[0]).group(1))
+    if len(parts) != expected:
+        raise RuntimeError(f"Expected {expected} shard results in {shard_dir}, found {len(parts)}")
+
+    # the sink's own init clears chunks left by an earlier merge
+    ResultSink(out_dir, load_schema(os.path.join(shard_dir, parts[0]))).close()
+    count = 0
+    for part in parts:
+        part_dir = os.path.join(shard_dir, part)
+        for name in chunk_files(part_dir):
+            src, dest = os.path.join(part_dir, name), os.path.join(out_dir, f"chunk_{count:06d}.npz")
+            try:
+                os.link(src, dest)
+            except OSError:
+                # different filesystem / no hardlink support
+                shutil.copy(src, dest)
+            count += 1
+    return count
@@ -0,0 +1,136 @@
+"""
+Materialization of the per-prediction "sorted_images" folders.
+
+Modes:
+    copy      shutil.copy (the original behaviour, default)
+    hardlink  os.link, falling back to a copy across filesystems (opt-in)
+    symlink   absolute symlink to the source image (opt-in)
+    manifest  no files, only <out_dir>/manifest.csv (folder, name, source path)
+    none      nothing at all (metric-only runs)
+
+File operations run on a small pool of background threads fed by a bounded
+queue, so the inference loop only blocks when the writers are far behind.
+"""
+import csv
+import errno
+import os
+import queue
+import shutil
+import threading
+
+SORTED_OUTPUT_MODES = ('copy', 'hardlink', 'symlink', 'manifest', 'none')
+DEFAULT_MODE = 'copy'  # hardlink / symlink outputs share inodes with / depend on the sources, so opt-in only
+WRITER_THREADS = 4
+MAX_PENDING = 1024
+
+
+def add_sorted_output_args(parser, default=DEFAULT_MODE):
+    group = parser.add_argument_group('sorted image output')
+    group.add_argument('--sorted-output', choices=SORTED_OUTPUT_MODES, default=default,
+                       help="How scored images are placed into sorted_images/ (default: copy; hardlink / symlink "
+                            "avoid the copy but alias the source files; none = metrics only)")
+    group.add_argument('--sort-threads', type=int, default=WRITER_THREADS,
+                       help="Background threads materializing sorted_images/")
+    return group
+
+
+def _materialize(mode, src, dest):
+    if mode == 'copy':
+        shutil.copy(src, dest)
+    elif mode == 'hardlink':
+        try:
+            os.link(src, dest)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return
+            # different filesystem / no hardlink support
+            shutil.copy(src, dest)
+    elif mode == 'symlink':
+        try:
+            os.symlink(os.path.abspath(src), dest)
+        except FileExistsError:
+            pass
+
+
+class SortedImageWriter:
+    """
+    writer = SortedImageWriter(os.path.join(run_dir, 'sorted_images'), mode='copy')
+    writer.submit(src_path, 'Predicted_OOD', dest_name)   # returns immediately
+    writer.close()                                        # waits for pending files
+    """
+
+    def __init__(self, out_dir, mode=DEFAULT_MODE, threads=WRITER_THREADS, max_pending=MAX_PENDING,
+                 folders=()):
+        if mode not in SORTED_OUTPUT_MODES:
+            raise ValueError(f"Unknown sorted output mode: {mode}")
+        self.out_dir = out_dir
+        self.mode = mode
+        self.errors = []
+        self.written = 0
+        self._manifest = None
+        self._threads = []
+
+        if mode == 'none':
+            return
+        os.makedirs(out_dir, exist_ok=True)
+        if mode == 'manifest':
+            # appended, so resumed runs keep the rows written before the interruption
+            path = os.path.join(out_dir, 'manifest.csv')
+            is_new = not os.path.exists(path)
+            self._manifest = open(path, 'a', newline='', encoding='utf-8')
+            self._manifest_writer = csv.writer(self._manifest)
+            if is_new:
+                self._manifest_writer.writerow(['Folder', 'Name', 'Source_Path'])
+            return
+
+        for folder in folders:
+            os.makedirs(os.path.join(out_dir, folder), exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        for i in range(max(1, threads)):
+            t = threading.Thread(target=self._run, name=f'sorted-writer-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, src, folder, name):
+        if self.mode == 'none':
+            return
+        if self._manifest is not None:
+            self._manifest_writer.writerow([folder, name, src])
+            self.written += 1
+            return
+        self._queue.put((src, os.path.join(self.out_dir, folder, name)))
+
+    def pending(self):
+        """Files queued but not yet written."""
+        return self._queue.qsize() if self._threads else 0
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            src, dest = item
+            try:
+                _materialize(self.mode, src, dest)
+                with self._lock:
+                    self.written += 1
+            except OSError as e:
+                with self._lock:
+                    self.errors.append((src, str(e)))
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        if self._manifest is not None:
+            self._manifest.close()
+            self._manifest = None
+        if self._threads:
+            for _ in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                t.join()
+            self._threads = []
+        if self.errors:
+            print(f">>> [Sorted Output] {len(self.errors)} file(s) could not be written, e.g. {self.errors[0]}")
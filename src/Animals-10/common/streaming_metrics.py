@@ -0,0 +1,302 @@
+"""
+Incremental OOD metrics (OOD = positive class, higher score = more OOD).
+
+    metrics = StreamingMetrics()                  # fixed memory: one histogram per class
+    metrics.update(scores, labels)                # per batch, labels 0 = ID / 1 = OOD
+    metrics.summary()                             # AUROC, AUPR, FPR@95TPR, best threshold, at any time
+
+The default mode keeps 2 x HIST_BINS counts on a shared grid. The grid starts
+at the range of the first batch and doubles its range whenever a score falls
+outside it: neighbouring bins are merged pairwise, so the counts stay exact at
+the coarser resolution and memory never grows. Scores inside one bin count as
+ties (half credit for AUROC), which bounds the error by the bin width.
+exact=True keeps every score instead and gives the same numbers as sklearn.
+
+EarlyStopper watches successive summaries and reports convergence once the
+chosen metric has moved less than a tolerance over `patience` checks, and
+interleave() mixes the ID and OOD batch streams so live metrics see both
+classes from the start. LiveMetrics ties these together for an evaluation
+loop:
+
+    live = live_metrics_from_args(args, os.path.join(run_dir, 'live_metrics.json'), profiler)
+    for source, batch in labelled_batches(loaders, live.interleaved):
+        ...
+        live.update(scores, label)
+        if live.step():                           # report every --metrics-every batches
+            break                                 # converged (--early-stop)
+"""
+import json
+import os
+
+import numpy as np
+
+from common.result_sink import iter_chunks
+
+HIST_BINS = 4096
+TARGET_TPR = 0.95
+METRICS_EVERY = 50  # batches between live metric reports
+EARLY_STOP_PATIENCE = 3
+EARLY_STOP_MIN_PER_CLASS = 1000
+
+
+def add_metrics_args(parser):
+    group = parser.add_argument_group('live metrics')
+    group.add_argument('--metrics-every', type=int, default=METRICS_EVERY,
+                       help="Batches between live AUROC / AUPR / FPR@95TPR reports (0 = off)")
+    group.add_argument('--exact-metrics', action='store_true',
+                       help="Keep every score for the live metrics instead of fixed-memory histograms")
+    group.add_argument('--early-stop', type=float, default=None, metavar='TOL',
+                       help="Stop once the live AUROC moved less than TOL over --early-stop-patience reports "
+                            "(ID and OOD batches are interleaved)")
+    group.add_argument('--early-stop-patience', type=int, default=EARLY_STOP_PATIENCE)
+    group.add_argument('--early-stop-min', type=int, default=EARLY_STOP_MIN_PER_CLASS,
+                       help="Images of each class required before stopping early")
+    return group
+
+
+def _curve(id_counts, ood_counts, thresholds):
+    """
+    Counts per score level (ascending) -> operating points for "OOD if score >= threshold",
+    from the strictest threshold down. Returns (thresholds, tp, fp) with a leading (inf, 0, 0).
+    """
+    tp = np.concatenate([[0], np.cumsum(ood_counts[::-1])])
+    fp = np.concatenate([[0], np.cumsum(id_counts[::-1])])
+    return np.concatenate([[np.inf], thresholds[::-1]]), tp, fp
+
+
+def _trapezoid(y, x):
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2.0))
+
+
+def curve_metrics(thresholds, tp, fp, target_tpr=TARGET_TPR):
+    n_ood, n_id = tp[-1], fp[-1]
+    if n_ood == 0 or n_id == 0:
+        return {}
+    tpr, fpr = tp / n_ood, fp / n_id
+    auroc = _trapezoid(tpr, fpr)
+
+    # precision-recall as in sklearn: points with at least one positive prediction, plus (recall 0, precision 1)
+    predicted = tp + fp
+    keep = predicted > 0
+    recall = np.concatenate([[0.0], tpr[keep]])
+    precision = np.concatenate([[1.0], tp[keep] / predicted[keep]])
+    aupr = _trapezoid(precision, recall)
+
+    reached = np.nonzero(tpr >= target_tpr)[0]
+    fpr_at_target = float(fpr[reached[0]]) if len(reached) else 1.0
+    best = 1 + int(np.argmax((tpr - fpr)[1:]))  # Youden's J over the finite thresholds
+    return {
+        'auroc': auroc,
+        'aupr': aupr,
+        f'fpr_at_{round(target_tpr * 100)}_tpr': fpr_at_target,
+        'best_threshold': float(thresholds[best]),
+        'best_tpr': float(tpr[best]),
+        'best_fpr': float(fpr[best]),
+    }
+
+
+class StreamingMetrics:
+    def __init__(self, bins=HIST_BINS, exact=False):
+        self.exact = exact
+        self.bins = bins + (bins % 2)  # range doubling merges bin pairs
+        self.counts = np.zeros((2, self.bins), dtype=np.int64)
+        self.low = None
+        self.width = None
+        # exact mode: growable typed buffers
+        self._scores = np.empty(0, dtype=np.float64)
+        self._labels = np.empty(0, dtype=np.int8)
+        self._size = 0
+
+    @property
+    def n_id(self):
+        return int(np.count_nonzero(self._labels[:self._size] == 0)) if self.exact else int(self.counts[0].sum())
+
+    @property
+    def n_ood(self):
+        return int(np.count_nonzero(self._labels[:self._size] == 1)) if self.exact else int(self.counts[1].sum())
+
+    def update(self, scores, labels):
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        labels = np.broadcast_to(np.asarray(labels, dtype=np.int8), scores.shape)
+        finite = np.isfinite(scores)
+        scores, labels = scores[finite], labels[finite]
+        if len(scores) == 0:
+            return
+        if self.exact:
+            self._append(scores, labels)
+        else:
+            self._add_to_histogram(scores, labels)
+
+    def _append(self, scores, labels):
+        needed = self._size + len(scores)
+        if needed > len(self._scores):
+            capacity = max(needed, 2 * len(self._scores), 1024)
+            self._scores = np.resize(self._scores, capacity)
+            self._labels = np.resize(self._labels, capacity)
+        self._scores[self._size:needed] = scores
+        self._labels[self._size:needed] = labels
+        self._size = needed
+
+    def _add_to_histogram(self, scores, labels):
+        lo, hi = float(scores.min()), float(scores.max())
+        if self.low is None:
+            span = hi - lo if hi > lo else max(abs(lo), 1.0) * 1e-3
+            self.low, self.width = lo, span / (self.bins - 1)
+        while lo < self.low:
+            self._double(downward=True)
+        while hi >= self.low + self.bins * self.width:
+            self._double(downward=False)
+        index = np.clip(((scores - self.low) / self.width).astype(np.int64), 0, self.bins - 1)
+        for label in (0, 1):
+            self.counts[label] += np.bincount(index[labels == label], minlength=self.bins)
+
+    def _double(self, downward):
+        merged = self.counts.reshape(2, self.bins // 2, 2).sum(axis=2)
+        empty = np.zeros_like(merged)
+        if downward:
+            self.counts = np.concatenate([empty, merged], axis=1)
+            self.low -= self.bins * self.width
+        else:
+            self.counts = np.concatenate([merged, empty], axis=1)
+        self.width *= 2.0
+
+    def curve(self):
+        """(thresholds, tp, fp), strictest threshold first."""
+        if self.exact:
+            values, inverse = np.unique(self._scores[:self._size], return_inverse=True)
+            labels = self._labels[:self._size]
+            id_counts = np.bincount(inverse[labels == 0], minlength=len(values))
+            ood_counts = np.bincount(inverse[labels == 1], minlength=len(values))
+            return _curve(id_counts, ood_counts, values)
+        if self.low is None:
+            return _curve(np.zeros(0), np.zeros(0), np.zeros(0))
+        edges = self.low + self.width * np.arange(self.bins)
+        return _curve(self.counts[0], self.counts[1], edges)
+
+    def summary(self):
+        summary = {'mode': 'exact' if self.exact else 'histogram', 'id_images': self.n_id,
+                   'ood_images': self.n_ood}
+        if not self.exact and self.width is not None:
+            summary['bin_width'] = self.width
+        summary.update(curve_metrics(*self.curve()))
+        return summary
+
+    def write(self, path):
+        """Atomically writes summary() as JSON (safe to poll while the run is going)."""
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+def format_summary(summary):
+    if 'auroc' not in summary:
+        return f"ID {summary['id_images']} / OOD {summary['ood_images']} images (need both classes)"
+    return (f"ID {summary['id_images']} / OOD {summary['ood_images']}: AUROC {summary['auroc']:.4f}, "
+            f"AUPR {summary['aupr']:.4f}, FPR@95TPR {summary['fpr_at_95_tpr']:.4f}, "
+            f"best threshold {summary['best_threshold']:.4g} (TPR {summary['best_tpr']:.3f}, "
+            f"FPR {summary['best_fpr']:.3f})")
+
+
+class EarlyStopper:
+    """Converged once `metric` stayed within `tolerance` over the last `patience` checks."""
+
+    def __init__(self, tolerance, patience=EARLY_STOP_PATIENCE, min_per_class=EARLY_STOP_MIN_PER_CLASS,
+                 metric='auroc'):
+        self.tolerance = tolerance
+        self.patience = max(1, patience)
+        self.min_per_class = min_per_class
+        self.metric = metric
+        self.history = []
+
+    def check(self, summary):
+        if self.metric not in summary or min(summary['id_images'], summary['ood_images']) < self.min_per_class:
+            return False
+        self.history.append(summary[self.metric])
+        recent = self.history[-(self.patience + 1):]
+        return len(recent) > self.patience and max(recent) - min(recent) < self.tolerance
+
+
+def interleave(iterables, lengths):
+    """
+    Yields (source index, item), always drawing from the source that has consumed the
+    smallest fraction of its length, so every prefix mixes the sources proportionally.
+    """
+    iterators = [iter(it) for it in iterables]
+    consumed = [0] * len(iterators)
+    active = [i for i, n in enumerate(lengths) if n > 0]
+    while active:
+        i = min(active, key=lambda k: consumed[k] / lengths[k])
+        try:
+            item = next(iterators[i])
+        except StopIteration:
+            active.remove(i)
+            continue
+        consumed[i] += 1
+        yield i, item
+
+
+def labelled_batches(loaders, interleaved=False):
+    """(loader index, batch) pairs: loader after loader, or interleaved by progress."""
+    if interleaved:
+        return interleave(loaders, [len(loader) for loader in loaders])
+    return ((i, batch) for i, loader in enumerate(loaders) for batch in loader)
+
+
+class LiveMetrics:
+    """Per-batch driver for the live report (printed, written to `path`, exported as profiler gauges)."""
+
+    def __init__(self, metrics, every=METRICS_EVERY, path=None, stopper=None, profiler=None):
+        self.metrics = metrics
+        self.every = every
+        self.path = path
+        self.stopper = stopper
+        self.profiler = profiler
+        self.batches = 0
+        self.stopped = False
+
+    @property
+    def interleaved(self):
+        return self.stopper is not None
+
+    def update(self, scores, labels):
+        self.metrics.update(scores, labels)
+
+    def resume_from(self, sink_dir):
+        """Counts the rows a resumed result sink already holds."""
+        for chunk in iter_chunks(sink_dir, ['label', 'score']):
+            self.metrics.update(chunk['score'], chunk['label'])
+
+    def step(self):
+        """Call once per batch. Returns True when the run should stop early."""
+        self.batches += 1
+        if self.every and self.batches % self.every == 0:
+            return self.report()
+        return False
+
+    def report(self):
+        summary = self.metrics.summary()
+        if self.path:
+            self.metrics.write(self.path)
+        print(f"\n>>> [Live Metrics] {format_summary(summary)}")
+        if self.profiler is not None:
+            for name in ('auroc', 'aupr', 'fpr_at_95_tpr'):
+                if name in summary:
+                    self.profiler.gauge(f'live_{name}', summary[name])
+        if self.stopper is not None and self.stopper.check(summary):
+            print(f">>> [Early Stop] AUROC changed less than {self.stopper.tolerance} over the last "
+                  f"{self.stopper.patience} reports, stopping")
+            self.stopped = True
+        return self.stopped
+
+
+    def finish(self):
+        """Leaves the final state in `path`, also for runs shorter than one report interval."""
+        if self.path:
+            self.metrics.write(self.path)
+
+
+def live_metrics_from_args(args, path=None, profiler=None):
+    stopper = None
+    if args.early_stop is not None:
+        stopper = EarlyStopper(args.early_stop, args.early_stop_patience, args.early_stop_min)
+    return LiveMetrics(StreamingMetrics(exact=args.exact_metrics), args.metrics_every, path, stopper, profiler)
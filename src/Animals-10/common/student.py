@@ -0,0 +1,99 @@
+"""
+Single-pass student for the two sampling-based OOD scores.
+
+The teachers are sampling-based: the ResNet18 MC Dropout entropy and the
+BayesianVAE expected negative ELBO + latent variance both average 30
+stochastic passes per image. UncertaintyStudent is a narrow deterministic CNN
+on 64x64 inputs. One forward pass regresses the teachers' 30-sample outputs:
+
+    entropy          classifier predictive entropy (classifier threshold applies)
+    vae_score        expected negative ELBO + LATENT_ALPHA * latent variance
+    elbo             expected negative ELBO
+    latent_variance  variance of the latent mean across the VAE draws
+    + class logits   distilled from the classifier's MC mean probabilities
+
+pipeline/distill.py trains it and writes the parity report against the teachers.
+The scoring entry points load it with:
+
+    student = load_checkpoint_model(UncertaintyStudent, STUDENT_PATH, DEVICE)
+    outputs = student_predict(student, normalize_batch(uint8_images))   # {name: [B]} + 'probs' [B, C]
+
+Inputs are [0, 1] images (normalize_batch without mean / std) at any resolution.
+Anything other than 64x64 is resized with antialiasing, which is close to the
+PIL bilinear resize the 64x64 tensor cache uses. The student standardizes
+its inputs and targets internally with buffers stored in its state_dict.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# --- [Configuration] ---
+STUDENT_SIZE = 64
+TARGETS = ('entropy', 'vae_score', 'elbo', 'latent_variance')
+NUM_CLASSES = 10
+WIDTH = 32
+INPUT_MEAN = [0.485, 0.456, 0.406]
+INPUT_STD = [0.229, 0.224, 0.225]
+KL_WEIGHT = 1.0  # class-distribution term relative to the score regression
+
+
+def _conv_block(in_channels, out_channels):
+    return nn.Sequential(
+        nn.Conv2d(in_channels, out_channels, 3, 2, 1, bias=False), nn.BatchNorm2d(out_channels), nn.ReLU(inplace=True),
+        nn.Conv2d(out_channels, out_channels, 3, 1, 1, bias=False), nn.BatchNorm2d(out_channels), nn.ReLU(inplace=True),
+    )
+
+
+class UncertaintyStudent(nn.Module):
+    def __init__(self, num_classes=NUM_CLASSES, width=WIDTH, num_targets=len(TARGETS)):
+        super().__init__()
+        self.num_targets = num_targets
+        # 64 -> 32 -> 16 -> 8 -> 4, then global average pooling
+        self.features = nn.Sequential(
+            _conv_block(3, width), _conv_block(width, width * 2),
+            _conv_block(width * 2, width * 4), _conv_block(width * 4, width * 8),
+            nn.AdaptiveAvgPool2d(1), nn.Flatten(1),
+        )
+        self.head = nn.Linear(width * 8, num_targets + num_classes)
+        self.register_buffer('input_mean', torch.tensor(INPUT_MEAN).view(1, 3, 1, 1))
+        self.register_buffer('input_std', torch.tensor(INPUT_STD).view(1, 3, 1, 1))
+        # per-target standardization, fitted on the teacher outputs before training
+        self.register_buffer('target_mean', torch.zeros(num_targets))
+        self.register_buffer('target_std', torch.ones(num_targets))
+
+    def set_target_stats(self, targets):
+        """targets: teacher outputs [N, num_targets]."""
+        self.target_mean.copy_(targets.mean(dim=0))
+        self.target_std.copy_(targets.std(dim=0).clamp_min(1e-6))
+
+    def forward(self, images):
+        """[0, 1] images [B, 3, H, W] -> (standardized targets [B, T], class logits [B, C])."""
+        if images.shape[-2:] != (STUDENT_SIZE, STUDENT_SIZE):
+            images = F.interpolate(images, size=(STUDENT_SIZE, STUDENT_SIZE), mode='bilinear',
+                                   align_corners=False, antialias=True)
+        x = self.head(self.features((images - self.input_mean) / self.input_std))
+        return x[:, :self.num_targets], x[:, self.num_targets:]
+
+
+def distillation_loss(model, images, targets, kl_weight=KL_WEIGHT):
+    """
+    targets: [B, T + C] = teacher scores followed by the teacher's MC mean class probabilities.
+    MSE on the standardized scores + KL(teacher || student) on the class distribution.
+    """
+    student = getattr(model, '_orig_mod', model)  # torch.compile wrapper -> module with the buffers
+    pred, logits = model(images)
+    scores, probs = targets[:, :student.num_targets], targets[:, student.num_targets:]
+    standardized = (scores - student.target_mean) / student.target_std
+    regression = F.mse_loss(pred.float(), standardized)
+    kl = F.kl_div(F.log_softmax(logits.float(), dim=1), probs, reduction='batchmean')
+    return regression + kl_weight * kl
+
+
+@torch.no_grad()
+def student_predict(model, images):
+    """[0, 1] images -> {target name: [B]} in teacher units, plus 'probs' [B, C]."""
+    pred, logits = model(images)
+    scores = pred.float() * model.target_std + model.target_mean
+    outputs = {name: scores[:, i] for i, name in enumerate(TARGETS[:model.num_targets])}
+    outputs['probs'] = F.softmax(logits.float(), dim=1)
+    return outputs
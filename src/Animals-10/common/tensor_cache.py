@@ -0,0 +1,320 @@
+"""
+Preprocessed tensor cache for the Animals-10 / Pokemon image trees.
+
+Decoding and resizing every JPEG/PNG on each run is the bottleneck on CPU
+nodes, so this module decodes each image once, resizes it to the target
+resolution (224 for the classifier, 64 for the VAE) and stores it as uint8
+in memory-mapped shard files:
+
+    <cache_dir>/<tree name>-<root hash>/<H>x<W>/
+        index.json          # path / label / filename / shard / row + manifest
+        shard_00000.npy     # uint8 [N, 3, H, W]
+        ...
+
+Each index entry also carries the source file size and mtime (and optionally
+a SHA-1 checksum), so rebuilding only decodes new or changed images and drops
+deleted ones. Given a common.file_manifest.FileManifest, the listing, sizes,
+mtimes and checksums come from the manifest instead of a walk + stat per file.
+Builds of one cache directory are serialized with a lock file, so shard
+processes started together (--workers N --cache-dir) never clobber each other.
+
+Build once (run from src/Animals-10):
+    python -m common.tensor_cache --root /app/data/animals --size 224 64
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: builds are not serialized
+    fcntl = None
+
+# --- [Configuration] ---
+DEFAULT_CACHE_DIR = '/app/data/_tensor_cache'
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+SHARD_SIZE = 4096  # images per shard file
+NUM_DECODE_THREADS = min(8, os.cpu_count() or 1)
+INDEX_VERSION = 1
+
+
+# --- Paths ---
+def cache_path(cache_dir, root_dir, size):
+    """Cache directory for one (image tree, resolution) pair."""
+    root_dir = os.path.abspath(root_dir)
+    root_hash = hashlib.sha1(root_dir.encode('utf-8')).hexdigest()[:8]
+    tree_name = os.path.basename(root_dir.rstrip(os.sep)) or 'root'
+    return os.path.join(cache_dir, f"{tree_name}-{root_hash}", f"{size}x{size}")
+
+
+def scan_images(root_dir, extensions=IMG_EXTENSIONS):
+    """
+    Walks root_dir and returns (samples, classes).
+    samples: sorted list of (path, label, filename); label is the index of the
+    top-level sub-directory (ImageFolder convention) or -1 for files directly in root
+    (scored by the path-returning evaluation datasets, skipped by the labelled view).
+    """
+    classes = sorted(e.name for e in os.scandir(root_dir) if e.is_dir())
+    class_to_idx = {c: i for i, c in enumerate(classes)}
+    samples = []
+    for root, _, files in os.walk(root_dir):
+        rel = os.path.relpath(root, root_dir)
+        top = rel.split(os.sep)[0] if rel != '.' else None
+        label = class_to_idx.get(top, -1)
+        for file in files:
+            if file.lower().endswith(extensions):
+                samples.append((os.path.join(root, file), label, file))
+    samples.sort()
+    return samples, classes
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def decode_resized(path, size):
+    """PIL decode + resize, identical to transforms.Resize((size, size)) before ToTensor."""
+    with Image.open(path) as img:
+        img = img.convert('RGB').resize((size, size), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)
+
+
+# --- Build ---
+def _load_index(path):
+    index_file = os.path.join(path, 'index.json')
+    if not os.path.exists(index_file):
+        return None
+    with open(index_file, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    if index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def _write_index(path, index):
+    index_file = os.path.join(path, 'index.json')
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+
+
+@contextmanager
+def _build_lock(path):
+    """
+    Exclusive lock on one cache directory. Shard processes (or nodes) starting at the same time take
+    turns: the first one decodes, the others then find the cache up to date.
+    """
+    with open(os.path.join(path, '.lock'), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build_cache(root_dir, size, cache_dir=DEFAULT_CACHE_DIR, checksum=False,
+                shard_size=SHARD_SIZE, num_threads=NUM_DECODE_THREADS, verbose=True, manifest=None):
+    """
+    Creates or incrementally updates the cache of root_dir at size x size.
+    Returns the cache directory.
+    """
+    path = cache_path(cache_dir, root_dir, size)
+    os.makedirs(path, exist_ok=True)
+    # shard names, stale-shard removal and the index assume one builder per directory
+    with _build_lock(path):
+        _update_cache(path, root_dir, size, checksum, shard_size, num_threads, verbose, manifest)
+    return path
+
+
+def _update_cache(path, root_dir, size, checksum, shard_size, num_threads, verbose, manifest):
+    if manifest is not None:
+        samples, classes = manifest.samples, manifest.classes
+        stat_file, checksum_file = manifest.stat, manifest.sha1
+    else:
+        samples, classes = scan_images(root_dir)
+        stat_file, checksum_file = os.stat, file_checksum
+    old_index = _load_index(path) or {'entries': [], 'shards': []}
+    old_entries = {e['path']: e for e in old_index['entries']}
+
+    entries, stale = [], []
+    for file_path, label, filename in samples:
+        stat = stat_file(file_path)
+        old = old_entries.get(file_path)
+        fresh = old is not None and old['size'] == stat.st_size and old['mtime_ns'] == stat.st_mtime_ns
+        if not fresh and checksum and old is not None and old.get('sha1'):
+            fresh = old['size'] == stat.st_size and checksum_file(file_path) == old['sha1']
+        entry = {'path': file_path, 'label': label, 'filename': filename,
+                 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if fresh:
+            sha1 = old.get('sha1') or (checksum_file(file_path) if checksum else None)
+            entry.update(shard=old['shard'], row=old['row'], sha1=sha1)
+        else:
+            stale.append(entry)
+        entries.append(entry)
+
+    if verbose:
+        print(f">>> [Cache] {root_dir} @ {size}x{size}: {len(entries) - len(stale)} cached, {len(stale)} to decode")
+
+    # Decode new / changed images into fresh shards
+    shards = list(old_index['shards'])
+    next_shard = max([int(s[6:11]) for s in shards], default=-1) + 1
+    failed = set()
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for start in range(0, len(stale), shard_size):
+            chunk = stale[start:start + shard_size]
+            shard_name = f"shard_{next_shard:05d}.npy"
+            next_shard += 1
+
+            arrays = list(pool.map(lambda e: _try_decode(e['path'], size), chunk))
+            ok = [(e, a) for e, a in zip(chunk, arrays) if a is not None]
+            failed.update(e['path'] for e, a in zip(chunk, arrays) if a is None)
+            if not ok:
+                continue
+
+            shard = np.lib.format.open_memmap(os.path.join(path, shard_name), mode='w+',
+                                              dtype=np.uint8, shape=(len(ok), 3, size, size))
+            for row, (entry, array) in enumerate(ok):
+                shard[row] = array
+                entry.update(shard=shard_name, row=row)
+                if checksum:
+                    entry['sha1'] = checksum_file(entry['path'])
+            shard.flush()
+            del shard
+            shards.append(shard_name)
+
+    entries = [e for e in entries if e['path'] not in failed]
+    if failed and verbose:
+        print(f">>> [Cache] Skipped {len(failed)} unreadable images")
+
+    # Drop shards no longer referenced by any entry
+    live = {e['shard'] for e in entries}
+    for shard_name in shards:
+        if shard_name not in live:
+            os.remove(os.path.join(path, shard_name))
+    shards = [s for s in shards if s in live]
+
+    _write_index(path, {'version': INDEX_VERSION, 'root': os.path.abspath(root_dir), 'size': size,
+                        'classes': classes, 'shards': shards, 'entries': entries})
+
+
+def _try_decode(path, size):
+    try:
+        return decode_resized(path, size)
+    except Exception:
+        return None
+
+
+# --- Dataset ---
+class CachedImageDataset(Dataset):
+    """
+    Reads cached uint8 images [3, H, W] straight from the memory-mapped shards.
+
+    return_paths=True  -> (image, path, filename)   like OODDataset / ImageFolderWithPaths
+    return_paths=False -> (image, label)            like datasets.ImageFolder (files directly in the
+                                                     root have no class and are skipped, label -1 in the index)
+    extensions / root_files narrow the view to the files an evaluator's own dataset would list
+    (e.g. OODDataset: .jpg / .jpeg / .png only; ImageFolderWithPaths: no root-level files), so
+    reading through the cache never changes which images are scored.
+    Normalization is left to normalize_batch() on the collated batch.
+    """
+
+    def __init__(self, path, return_paths=True, extensions=None, root_files=True):
+        index = _load_index(path)
+        if index is None:
+            raise FileNotFoundError(f"No tensor cache found at {path}")
+        self.path = path
+        self.return_paths = return_paths
+        self.classes = index['classes']
+        entries = index['entries']
+        if extensions is not None:
+            entries = [e for e in entries if e['filename'].lower().endswith(tuple(extensions))]
+        if not return_paths or not root_files:
+            # labelled view: a -1 label would reach CrossEntropyLoss, so root-level files are left out like ImageFolder
+            entries = [e for e in entries if e['label'] >= 0]
+        self.samples = [(e['path'], e['label'], e['filename']) for e in entries]
+        self.size = index['size']
+        self._locations = [(e['shard'], e['row']) for e in entries]
+        self._shards = {}
+        # vectorized locations for get_batch()
+        self._shard_names = list(index['shards'])
+        shard_ids = {name: i for i, name in enumerate(self._shard_names)}
+        self._shard_ids = np.array([shard_ids[s] for s, _ in self._locations], dtype=np.int64)
+        self._rows = np.array([r for _, r in self._locations], dtype=np.int64)
+
+    def _shard(self, name):
+        shard = self._shards.get(name)
+        if shard is None:
+            # copy-on-write mapping: pages are shared with the page cache, never written back
+            shard = np.load(os.path.join(self.path, name), mmap_mode='c')
+            self._shards[name] = shard
+        return shard
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        shard_name, row = self._locations[idx]
+        image = torch.from_numpy(self._shard(shard_name)[row])
+        path, label, filename = self.samples[idx]
+        if self.return_paths:
+            return image, path, filename
+        return image, label
+
+    def get_batch(self, indices):
+        """uint8 [len(indices), 3, H, W] for many samples at once: one sorted fancy-index read per shard."""
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices), 3, self.size, self.size), dtype=np.uint8)
+        shard_ids, rows = self._shard_ids[indices], self._rows[indices]
+        for shard_id in np.unique(shard_ids):
+            positions = np.nonzero(shard_ids == shard_id)[0]
+            order = np.argsort(rows[positions], kind='stable')
+            out[positions[order]] = self._shard(self._shard_names[shard_id])[rows[positions[order]]]
+        return torch.from_numpy(out)
+
+
+def load_cached_dataset(root_dir, size, cache_dir=DEFAULT_CACHE_DIR, return_paths=True, checksum=False,
+                        manifest=None, extensions=None, root_files=True):
+    """Brings the cache up to date with root_dir (incremental) and opens it (see CachedImageDataset for the view)."""
+    path = build_cache(root_dir, size, cache_dir=cache_dir, checksum=checksum, manifest=manifest)
+    return CachedImageDataset(path, return_paths=return_paths, extensions=extensions, root_files=root_files)
+
+
+def normalize_batch(images, mean=None, std=None):
+    """uint8 [B, 3, H, W] -> float in [0, 1] (ToTensor), then optional per-channel Normalize."""
+    images = images.float().div_(255.0)
+    if mean is not None:
+        mean = torch.as_tensor(mean, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        std = torch.as_tensor(std, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+        images = images.sub_(mean).div_(std)
+    return images
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build / update the preprocessed uint8 tensor cache")
+    parser.add_argument('--root', type=str, nargs='+', required=True, help="Image tree(s) to cache")
+    parser.add_argument('--size', type=int, nargs='+', default=[224, 64], help="Square resolution(s)")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--checksum', action='store_true', help="Also store / compare SHA-1 of source files")
+    parser.add_argument('--threads', type=int, default=NUM_DECODE_THREADS)
+    args = parser.parse_args()
+
+    for root_dir in args.root:
+        for size in args.size:
+            out = build_cache(root_dir, size, cache_dir=args.cache_dir, checksum=args.checksum,
+                              num_threads=args.threads)
+            print(f">>> [Cache] Ready: {out}")
@@ -0,0 +1,261 @@
+"""
+Shared, resumable training loop for classifier/train.py and vae/train.py.
+
+    engine = TrainEngine(model, optimizer, loss_fn, device, checkpoint_path(MODEL_SAVE_PATH),
+                         normalize=..., precision=args.precision, channels_last=not args.no_channels_last)
+    start_epoch = engine.resume() if args.resume else 0
+    engine.fit(train_loader(dataset, args), args.epochs, start_epoch)
+    engine.save_model(MODEL_SAVE_PATH)
+
+Data: by default the images come from the preprocessed uint8 tensor cache
+(common/tensor_cache.py), so nothing is decoded after the first run.
+CachedBatchLoader reads whole batches straight from the memory-mapped
+shards on a prefetch thread; normalization runs on the batch.
+--no-cache uses the old decode-per-epoch DataLoader.
+
+Speed: --precision auto trains under bf16 autocast when the device supports it
+(CUDA bf16, or CPUs with AVX512-BF16 / AMX through oneDNN), else fp32.
+The conv models and their inputs use channels_last memory format.
+
+Checkpoints: after every --checkpoint-every epochs the model, optimizer, RNG
+state and per-epoch history are written atomically to <model>.ckpt next to
+the final weights. --resume continues after the last completed epoch with the
+same per-epoch shuffle order, because each epoch's order is seeded with
+--seed + epoch. Raising --epochs and resuming extends a finished run.
+
+Every epoch logs loss, images/s, wall time and the fraction spent waiting on
+data.
+"""
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from common.tensor_cache import DEFAULT_CACHE_DIR, CachedImageDataset
+
+CHECKPOINT_SUFFIX = '.ckpt'
+PREFETCH_BATCHES = 2
+SEED = 0
+
+
+def add_train_args(parser, epochs, batch_size):
+    group = parser.add_argument_group('training')
+    group.add_argument('--epochs', type=int, default=epochs)
+    group.add_argument('--batch-size', type=int, default=batch_size)
+    group.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                       help=f"Preprocessed uint8 tensor cache to train from (default: {DEFAULT_CACHE_DIR})")
+    group.add_argument('--no-cache', action='store_true',
+                       help="Decode and resize every image each epoch instead of reading the tensor cache")
+    group.add_argument('--precision', choices=['auto', 'bf16', 'fp32'], default='auto',
+                       help="auto: bf16 autocast where the device supports it, else fp32")
+    group.add_argument('--no-channels-last', action='store_true', help="Keep the default NCHW memory format")
+    group.add_argument('--resume', action='store_true',
+                       help="Continue from the last epoch checkpoint (<model>.ckpt)")
+    group.add_argument('--checkpoint-every', type=int, default=1, help="Epochs between checkpoints")
+    group.add_argument('--seed', type=int, default=SEED, help="Seed of the per-epoch shuffle order")
+    group.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    return group
+
+
+def checkpoint_path(model_path):
+    return os.path.splitext(model_path)[0] + CHECKPOINT_SUFFIX
+
+
+def resolve_precision(precision, device):
+    if precision != 'auto':
+        return precision
+    if device.type == 'cuda':
+        return 'bf16' if torch.cuda.is_bf16_supported() else 'fp32'
+    try:
+        return 'bf16' if torch.ops.mkldnn._is_mkldnn_bf16_supported() else 'fp32'
+    except (AttributeError, RuntimeError):
+        return 'fp32'
+
+
+class CachedBatchLoader:
+    """
+    Shuffled uint8 batches from a CachedImageDataset (or a Subset of one), read with
+    get_batch() on a prefetch thread instead of per-image DataLoader workers.
+    Yields (images uint8 [B, 3, H, W], labels int64 [B]) like DataLoader over ImageFolder.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, seed=SEED, prefetch_batches=PREFETCH_BATCHES):
+        if isinstance(dataset, Subset):
+            self.indices = np.asarray(dataset.indices, dtype=np.int64)
+            dataset = dataset.dataset
+        else:
+            self.indices = np.arange(len(dataset), dtype=np.int64)
+        self.dataset = dataset
+        self.labels = np.array([label for _, label, _ in dataset.samples], dtype=np.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.prefetch_batches = max(1, prefetch_batches)
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def _load(self, batch):
+        return self.dataset.get_batch(batch), torch.from_numpy(self.labels[batch])
+
+    def __iter__(self):
+        order = self.indices
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(order)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-batches') as pool:
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                pending.append(pool.submit(self._load, batch))
+                if len(pending) > self.prefetch_batches:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def train_loader(dataset, batch_size, seed=SEED, num_workers=4, pin_memory=False):
+    """CachedBatchLoader for cached datasets, else a seeded, shuffling DataLoader."""
+    base = dataset.dataset if isinstance(dataset, Subset) else dataset
+    if isinstance(base, CachedImageDataset):
+        return CachedBatchLoader(dataset, batch_size, shuffle=True, seed=seed)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                      pin_memory=pin_memory, generator=torch.Generator().manual_seed(seed))
+
+
+def _save_atomic(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class TrainEngine:
+    """
+    loss_fn(model, images, labels) -> scalar loss; loss_reduction tells whether it is the
+    batch 'mean' or 'sum' (only used to log a per-image loss).
+    normalize(uint8 batch) -> float batch, applied to uint8 batches (cache / fast paths).
+    """
+
+    def __init__(self, model, optimizer, loss_fn, device, ckpt_path, normalize=None, loss_reduction='mean',
+                 precision='auto', channels_last=True, compile=False, checkpoint_every=1, seed=SEED, config=None):
+        self.device = torch.device(device)
+        self.module = model.to(self.device)
+        self.channels_last = channels_last
+        if channels_last:
+            self.module.to(memory_format=torch.channels_last)
+        # compiled wrapper for the forward pass, plain module for state_dict (no '_orig_mod.' keys)
+        self.model = torch.compile(self.module) if compile else self.module
+        self.optimizer = optimizer
+        self.loss_fn = loss_fn
+        self.normalize = normalize
+        self.loss_reduction = loss_reduction
+        self.precision = resolve_precision(precision, self.device)
+        self.ckpt_path = ckpt_path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.seed = seed
+        self.config = dict(config or {})
+        self.history = []
+        print(f">>> [Train] precision {self.precision}, channels_last {channels_last}, compile {compile}")
+
+    # --- Checkpoints ---
+    def save_checkpoint(self, epochs_done):
+        state = {
+            'epoch': epochs_done,
+            'model': self.module.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'rng': {'cpu': torch.get_rng_state(),
+                    'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+            'history': self.history,
+            'config': self.config,
+        }
+        _save_atomic(state, self.ckpt_path)
+
+    def resume(self):
+        """Restores the last checkpoint; returns the number of completed epochs (0 without one)."""
+        if not os.path.exists(self.ckpt_path):
+            print(f">>> [Train] No checkpoint at {self.ckpt_path}, starting from epoch 1")
+            return 0
+        state = torch.load(self.ckpt_path, map_location=self.device, weights_only=False)
+        changed = {k: (state['config'].get(k), v) for k, v in self.config.items() if state['config'].get(k) != v}
+        if changed:
+            print(f">>> [Train] Warning: settings differ from the checkpoint (saved, now): {changed}")
+        self.module.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        torch.set_rng_state(state['rng']['cpu'])
+        if state['rng'].get('cuda') is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        self.history = state['history']
+        print(f">>> [Train] Resuming after epoch {state['epoch']} from {self.ckpt_path}")
+        return state['epoch']
+
+    def save_model(self, path):
+        _save_atomic(self.module.state_dict(), path)
+
+    # --- Training ---
+    def train_epoch(self, loader):
+        self.model.train()
+        loss_total, images_seen, data_wait = 0.0, 0, 0.0
+        start = time.perf_counter()
+        batches = iter(loader)
+        while True:
+            wait_start = time.perf_counter()
+            batch = next(batches, None)
+            data_wait += time.perf_counter() - wait_start
+            if batch is None:
+                break
+            images, labels = batch
+            images = images.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            if images.dtype == torch.uint8 and self.normalize is not None:
+                images = self.normalize(images)
+            if self.channels_last:
+                images = images.contiguous(memory_format=torch.channels_last)
+
+            self.optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                                enabled=self.precision == 'bf16'):
+                loss = self.loss_fn(self.model, images, labels)
+            loss.backward()
+            self.optimizer.step()
+
+            loss_total += loss.item() * (1 if self.loss_reduction == 'sum' else len(images))
+            images_seen += len(images)
+        seconds = time.perf_counter() - start
+        return {'loss': loss_total / max(images_seen, 1), 'images': images_seen, 'seconds': seconds,
+                'images_per_sec': images_seen / seconds if seconds > 0 else 0.0,
+                'data_wait_fraction': data_wait / seconds if seconds > 0 else 0.0}
+
+    def fit(self, loader, epochs, start_epoch=0):
+        if start_epoch >= epochs:
+            print(f">>> [Train] Checkpoint already covers {start_epoch} epochs (--epochs {epochs})")
+            return self.history
+        for epoch in range(start_epoch, epochs):
+            # the shuffle order depends only on (seed, epoch), so a resumed run sees the same batches
+            if hasattr(loader, 'set_epoch'):
+                loader.set_epoch(epoch)
+            elif getattr(loader, 'generator', None) is not None:
+                loader.generator.manual_seed(self.seed + epoch)
+
+            stats = self.train_epoch(loader)
+            stats['epoch'] = epoch + 1
+            self.history.append(stats)
+            print(f"Epoch [{epoch + 1}/{epochs}] Loss: {stats['loss']:.4f} | {stats['images_per_sec']:.1f} img/s, "
+                  f"{stats['seconds']:.1f} s (data wait {stats['data_wait_fraction']:.0%})")
+            if (epoch + 1) % self.checkpoint_every == 0 or epoch + 1 == epochs:
+                self.save_checkpoint(epoch + 1)
+
+        total_images = sum(h['images'] for h in self.history)
+        total_seconds = sum(h['seconds'] for h in self.history)
+        if total_seconds > 0:
+            print(f">>> [Train] {len(self.history)} epochs, {total_images / total_seconds:.1f} img/s overall")
+        return self.history
@@ -0,0 +1,180 @@
+"""
+Fast model loading: memory-mapped weights and construction without weight init.
+
+Training saves plain `torch.save(state_dict)` pickles (VAE keys may carry the
+`_orig_mod.` prefix of torch.compile). Loading one unpickles every tensor into
+fresh memory, and the model it is loaded into was randomly initialized first.
+For short jobs both dominate the run time, so the entry points go through
+load_checkpoint_model() instead:
+
+    model = load_checkpoint_model(lambda: get_animal_model(num_classes=10, pretrained=False),
+                                  MODEL_PATH, DEVICE, startup)      # startup: optional StartupTimer
+
+1. The first load converts `<name>.pth` once into `<name>.safetensors` next to
+   it, with the keys already normalized. The file uses the safetensors layout
+   (8-byte header length, JSON header, raw little-endian tensor data), so the
+   `safetensors` package can read it, but no extra package is needed here. The
+   header records the size and mtime of the source checkpoint. A retrained
+   .pth therefore invalidates the conversion, and the next load redoes it.
+2. Later loads mmap the converted file. Tensors are views of the page cache,
+   so only the pages actually used are read, and processes loading the same
+   model share them.
+3. The model is constructed on the meta device (no allocation, no random init)
+   and the loaded tensors are assigned to it with load_state_dict(assign=True).
+
+    python -m common.weights <model.pth> [...]      # convert ahead of time (e.g. at deploy), run from src/Animals-10
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from contextlib import nullcontext
+
+import torch
+
+WEIGHTS_SUFFIX = '.safetensors'
+COMPILE_PREFIX = '_orig_mod.'  # added to parameter names by torch.compile
+SOURCE_KEY = 'source_stamp'
+
+DTYPES = {
+    torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+    torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8',
+    torch.uint8: 'U8', torch.bool: 'BOOL',
+}
+DTYPE_NAMES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def normalize_keys(state_dict):
+    return {k.replace(COMPILE_PREFIX, ""): v for k, v in state_dict.items()}
+
+
+def converted_path(model_path):
+    return os.path.splitext(model_path)[0] + WEIGHTS_SUFFIX
+
+
+def source_stamp(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def save_weights(state_dict, path, metadata=None):
+    """Writes tensors in the safetensors layout (atomically)."""
+    header, tensors, offset = {}, [], 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if tensor.dtype not in DTYPES:
+            raise TypeError(f"Unsupported dtype for {name}: {tensor.dtype}")
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + nbytes]}
+        tensors.append(tensor)
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = {k: str(v) for k, v in metadata.items()}
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 8)  # keep the data 8-byte aligned
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors:
+            if tensor.numel():
+                f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_metadata(path):
+    with open(path, 'rb') as f:
+        (length,) = struct.unpack('<Q', f.read(8))
+        return json.loads(f.read(length)).get('__metadata__', {})
+
+
+def load_weights(path):
+    """{name: tensor} backed by a private (copy-on-write) mmap of the file."""
+    with open(path, 'rb') as f:
+        (length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + length
+    tensors = {}
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        dtype = DTYPE_NAMES[info['dtype']]
+        start, end = info['data_offsets']
+        if start == end:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        count = (end - start) // torch.empty(0, dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=count,
+                                         offset=data_start + start).reshape(info['shape'])
+    return tensors
+
+
+def convert(model_path, out_path=None):
+    """Pickled state_dict -> normalized, memory-mappable weights file. Returns (state_dict, out_path)."""
+    state_dict = normalize_keys(torch.load(model_path, map_location='cpu', weights_only=True))
+    out_path = out_path or converted_path(model_path)
+    save_weights(state_dict, out_path, {SOURCE_KEY: source_stamp(model_path)})
+    return state_dict, out_path
+
+
+def load_state_dict(model_path, auto_convert=True):
+    """
+    State dict for a .pth checkpoint (or a converted weights file) with normalized keys.
+    Returns (state_dict, how) with how = 'mmap' | 'converted' | 'pickle'.
+    """
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file not found at {model_path}")
+    if model_path.endswith(WEIGHTS_SUFFIX):
+        return load_weights(model_path), 'mmap'
+
+    fast_path = converted_path(model_path)
+    if os.path.exists(fast_path):
+        try:
+            if read_metadata(fast_path).get(SOURCE_KEY) == source_stamp(model_path):
+                return load_weights(fast_path), 'mmap'
+        except (OSError, ValueError, KeyError):
+            pass  # unreadable / partial conversion: redo it
+    if auto_convert:
+        try:
+            state_dict, _ = convert(model_path, fast_path)
+            return state_dict, 'converted'
+        except OSError as e:
+            print(f">>> [Weights] Could not write {fast_path} ({e}), loading the pickle")
+    return normalize_keys(torch.load(model_path, map_location='cpu', weights_only=True)), 'pickle'
+
+
+def build_model(factory, state_dict, device):
+    """
+    factory() constructed on the meta device, then given the loaded tensors.
+    Falls back to a normal construction + copy if the module has state outside its state_dict.
+    """
+    with torch.device('meta'):
+        model = factory()
+    model.load_state_dict(state_dict, assign=True)
+    if any(t.is_meta for t in model.parameters()) or any(t.is_meta for t in model.buffers()):
+        model = factory()
+        model.load_state_dict(state_dict)
+    return model.to(device)
+
+
+def load_checkpoint_model(factory, model_path, device, startup=None, auto_convert=True):
+    """load_state_dict() + build_model(), timed as the 'weights' / 'model' startup phases."""
+    with startup.phase('weights') if startup else nullcontext():
+        state_dict, how = load_state_dict(model_path, auto_convert)
+    if startup:
+        startup.note('weights', how)
+    with startup.phase('model') if startup else nullcontext():
+        return build_model(factory, state_dict, device)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: python -m common.weights <model.pth> [...]")
+    for path in sys.argv[1:]:
+        _, out = convert(path)
+        print(f">>> Converted {path} -> {out}")
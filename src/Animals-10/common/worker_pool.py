@@ -0,0 +1,198 @@
+"""
+Multi-process CPU scoring over one shared copy of the model weights.
+
+Running N copies of an evaluator (or N sharding workers) loads the model N
+times, and each process also grows its own allocator arenas. Packing more
+scoring processes onto a node is limited by that memory. SharedModelPool
+instead keeps one copy of the weights:
+
+- The parent loads the model once and moves its parameters and buffers into
+  shared memory (Module.share_memory()).
+- Spawned workers receive the model through torch.multiprocessing, which
+  passes shared-memory handles, not copies. They attach to the same pages,
+  run it under no_grad() in eval mode and never write to it.
+- Workers pull batches from one shared task queue, so a slow batch does not
+  stall the others. The batch tensors travel through shared memory as well.
+- Results come back in submission order.
+
+    pool = SharedModelPool(model, score_batch_fn, num_workers=4, args=(mode,))
+    for meta, outputs in pool.map((meta, images) for ...):    # outputs: tuple of CPU tensors
+        ...
+    stats = pool.report(profiler)                             # stops the workers, prints per-worker memory
+
+score_fn(model, images, *args) -> tensor or tuple of tensors. It must be a
+module-level function, because spawned workers import it by name.
+
+When a worker exits it reports its peak RSS (ru_maxrss) and its final
+RSS / PSS / private memory (common.profiling.memory_breakdown). The shared
+weights appear in every worker's RSS but only once in the sum of the PSS.
+"""
+import os
+import queue
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+
+from common.profiling import memory_breakdown, peak_rss_bytes
+
+# --- [Configuration] ---
+PENDING_PER_WORKER = 2  # batches queued ahead per worker (bounds the shared-memory batches in flight)
+POLL_SECONDS = 1.0  # result wait before checking that the workers are still alive
+
+
+def add_pool_args(parser):
+    group = parser.add_argument_group('shared-memory worker pool')
+    group.add_argument('--pool-workers', type=int, default=0,
+                       help="Score on N CPU worker processes that share one copy of the model weights")
+    group.add_argument('--pool-threads', type=int, default=None,
+                       help="torch intra-op threads per pool worker (default: usable CPUs / N)")
+    return group
+
+
+def _usable_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+
+def _worker(index, model, score_fn, args, threads, seed, tasks, results):
+    torch.set_num_threads(threads)
+    torch.manual_seed(seed + index)
+    model.eval()
+    batches = images = 0
+    start = time.perf_counter()
+    try:
+        with torch.no_grad():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                seq, inputs = task
+                outputs = score_fn(model, inputs, *args)
+                outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+                results.put(('batch', seq, tuple(o.detach().cpu() for o in outputs)))
+                batches += 1
+                images += len(inputs)
+    except Exception:
+        results.put(('error', index, traceback.format_exc()))
+        return
+    results.put(('stats', index, {'worker': index, 'pid': os.getpid(), 'threads': threads, 'batches': batches,
+                                  'images': images, 'seconds': time.perf_counter() - start,
+                                  'peak_rss_bytes': peak_rss_bytes(), **memory_breakdown()}))
+
+
+class SharedModelPool:
+    def __init__(self, model, score_fn, num_workers, args=(), threads=None):
+        if any(t.device.type != 'cpu' for t in model.parameters()):
+            raise ValueError("SharedModelPool scores on CPU; move the model to the CPU first")
+        model.eval()
+        for param in model.parameters():
+            param.requires_grad_(False)
+        # one copy in shared memory; the workers map these pages instead of loading their own
+        model.share_memory()
+        self.shared_bytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+        self.num_workers = num_workers
+        self.threads = threads or max(1, _usable_cpus() // num_workers)
+        # per-worker dropout seeds drawn from the parent's RNG (a seeded run stays reproducible)
+        seed = int(torch.randint(2 ** 62, (1,)).item())
+        context = mp.get_context('spawn')
+        self.tasks = context.Queue(maxsize=num_workers * PENDING_PER_WORKER)
+        self.results = context.Queue()
+        self.workers = [context.Process(target=_worker, name=f'score-worker-{i}', daemon=True,
+                                        args=(i, model, score_fn, tuple(args), self.threads, seed, self.tasks,
+                                              self.results))
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.stats = {}
+        self.closed = False
+        print(f">>> [Pool] {num_workers} workers x {self.threads} threads sharing "
+              f"{self.shared_bytes / 2 ** 20:.1f} MiB of weights")
+
+    def _check_alive(self):
+        dead = [w.name for w in self.workers if w.exitcode not in (None, 0)]
+        if dead:
+            raise RuntimeError(f"Pool worker(s) {dead} exited unexpectedly")
+
+    def _put(self, task):
+        while True:
+            try:
+                self.tasks.put(task, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                self._check_alive()
+
+    def _receive(self):
+        """Next ('batch', seq, outputs) or ('stats', worker, stats) message; raises on a failed or dead worker."""
+        while True:
+            try:
+                kind, key, value = self.results.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                self._check_alive()
+                continue
+            if kind == 'error':
+                raise RuntimeError(f"Pool worker {key} failed:\n{value}")
+            if kind == 'stats':
+                self.stats[key] = value
+            return kind, key, value
+
+    def map(self, items):
+        """items: iterable of (meta, images). Yields (meta, outputs) in input order."""
+        pending, done = {}, {}
+        next_seq = submitted = 0
+        items = iter(items)
+        exhausted = False
+        while True:
+            # keep the task queue filled without blocking on a full queue
+            while not exhausted and submitted - next_seq < self.num_workers * PENDING_PER_WORKER:
+                item = next(items, None)
+                if item is None:
+                    exhausted = True
+                    break
+                meta, images = item
+                pending[submitted] = meta
+                self._put((submitted, images))
+                submitted += 1
+            if next_seq == submitted:
+                return
+            while next_seq not in done:
+                kind, seq, outputs = self._receive()
+                if kind == 'batch':
+                    done[seq] = outputs
+            yield pending.pop(next_seq), done.pop(next_seq)
+            next_seq += 1
+
+    def close(self):
+        """Stops the workers (queued batches are still scored) and returns their stats, ordered by worker."""
+        if self.closed:
+            return [self.stats[i] for i in sorted(self.stats)]
+        self.closed = True
+        try:
+            for _ in self.workers:
+                self._put(None)
+            while len(self.stats) < self.num_workers:
+                self._receive()  # results of batches abandoned by an early stop are dropped
+        except RuntimeError as e:
+            print(f">>> [Pool] {e}")
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        return [self.stats[i] for i in sorted(self.stats)]
+
+    def report(self, profiler=None):
+        """Closes the pool, prints one line per worker and records the memory as profiler gauges; returns the stats."""
+        stats = self.close()
+        print(f">>> [Pool] {len(stats)} workers, shared weights {self.shared_bytes / 2 ** 20:.1f} MiB")
+        for s in stats:
+            line = (f"    worker {s['worker']}: {s['images']} images in {s['batches']} batches, "
+                    f"peak RSS {s['peak_rss_bytes'] / 2 ** 20:.0f} MiB")
+            if 'pss_bytes' in s:
+                line += (f" (at exit: PSS {s['pss_bytes'] / 2 ** 20:.0f} MiB, "
+                         f"private {s['private_bytes'] / 2 ** 20:.0f} MiB)")
+            print(line)
+            if profiler is not None:
+                for name in ('peak_rss_bytes', 'pss_bytes', 'private_bytes'):
+                    if name in s:
+                        profiler.gauge(f'pool_worker_{name}', s[name], worker=s['worker'])
+        return stats
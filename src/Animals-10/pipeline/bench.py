@@ -0,0 +1,258 @@
+"""
+Scoring throughput / latency benchmark on synthetic inputs (no dataset needed).
+
+Times the BayesianVAE score, the ResNet18 MC Dropout entropy and the
+distilled single-pass student (common/student.py) over a grid of batch sizes,
+MC sample counts, torch thread counts and dtypes, plus image decode + resize
+on synthetic JPEGs (full decode and --fast-decode draft mode), and writes
+everything to one JSON file.
+
+    cd /app/src/Animals-10/pipeline
+    python bench.py --output bench_cpu.json
+    python bench.py --models vae --batch-sizes 1 64 --dtypes float32 bfloat16
+    python bench.py --baseline bench_cpu.json          # exits 1 on a regression
+
+Model weights are random: throughput does not depend on the trained values.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from scorers import LATENT_ALPHA, decode_image, load_method_module
+from common.fast_decode import decode_draft
+from common.student import STUDENT_SIZE, UncertaintyStudent, student_predict
+
+# --- [Configuration] ---
+BATCH_SIZES = [1, 16, 64]
+NUM_SAMPLES = [30]
+DTYPES = ['float32']
+WARMUP_ITERS = 3
+MEASURE_ITERS = 20
+DECODE_IMAGES = 64
+DECODE_SOURCE_SIZE = 512  # synthetic JPEG edge length, roughly the Animals-10 median
+REGRESSION_TOLERANCE = 0.10  # fraction of images/sec allowed to drop vs the baseline
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+DTYPE_MAP = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
+
+def host_info():
+    return {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'cpu_count': os.cpu_count(),
+        'device': str(DEVICE),
+        'cuda_device': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+
+def latency_stats(times, batch_size):
+    ms = np.asarray(times) * 1000.0
+    return {
+        'images_per_sec': batch_size * len(times) / float(np.sum(times)),
+        'latency_ms_mean': float(ms.mean()),
+        'latency_ms_p50': float(np.percentile(ms, 50)),
+        'latency_ms_p95': float(np.percentile(ms, 95)),
+        'latency_ms_p99': float(np.percentile(ms, 99)),
+    }
+
+
+def time_calls(fn, warmup, iters):
+    for _ in range(warmup):
+        fn()
+    if DEVICE.type == 'cuda':
+        torch.cuda.synchronize()
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        if DEVICE.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def build_models(names):
+    models = {}
+    if 'classifier' in names:
+        module = load_method_module('classifier')
+        models['classifier'] = (module, module.get_animal_model(num_classes=10, pretrained=False).to(DEVICE).eval())
+    if 'vae' in names:
+        module = load_method_module('vae')
+        models['vae'] = (module, module.BayesianVAE().to(DEVICE).eval())
+    if 'student' in names:
+        models['student'] = (None, UncertaintyStudent().to(DEVICE).eval())
+    return models
+
+
+def scoring_fn(name, module, model, images, samples, mc_mode):
+    if name == 'classifier':
+        def run():
+            probs = module.mc_dropout_probs(model, images, samples, mode=mc_mode)
+            return module.predictive_entropy(probs.mean(dim=0))
+    elif name == 'vae' and mc_mode == 'analytic':
+        def run():
+            return module.analytic_scores(model, images, alpha=LATENT_ALPHA)
+    elif name == 'vae':
+        def run():
+            return module.bayesian_scores(model, images, samples=samples, alpha=LATENT_ALPHA)
+    else:
+        def run():
+            return student_predict(model, images)
+    return run
+
+
+def bench_scoring(args, models):
+    results = []
+    image_sizes = {'classifier': 224, 'vae': 64, 'student': STUDENT_SIZE}
+    grid = itertools.product(models.items(), args.threads, args.dtypes, args.batch_sizes, args.samples)
+    for (name, (module, model)), threads, dtype, batch_size, samples in grid:
+        torch.set_num_threads(threads)
+        size = image_sizes[name]
+        images = torch.rand(batch_size, 3, size, size, device=DEVICE)
+        if name == 'classifier':
+            mc_modes = args.mc_modes
+        elif name == 'vae':
+            mc_modes = [None] + (['analytic'] if 'analytic' in args.mc_modes else [])
+        else:
+            mc_modes = [None]
+        for mc_mode in mc_modes:
+            run = scoring_fn(name, module, model, images, samples, mc_mode)
+            autocast = torch.autocast(DEVICE.type, dtype=DTYPE_MAP[dtype], enabled=dtype != 'float32')
+            with torch.no_grad(), autocast:
+                times = time_calls(run, args.warmup, args.iters)
+            entry = {'benchmark': 'score', 'model': name, 'batch_size': batch_size, 'samples': samples,
+                     'threads': threads, 'dtype': dtype, 'mc_mode': mc_mode, **latency_stats(times, batch_size)}
+            results.append(entry)
+            print(f"  {name:<10} mode={mc_mode or '-':<8} bs={batch_size:<4} S={samples:<3} thr={threads:<3} "
+                  f"{dtype:<8} {entry['images_per_sec']:9.1f} img/s  p50 {entry['latency_ms_p50']:8.2f} ms  "
+                  f"p99 {entry['latency_ms_p99']:8.2f} ms")
+    return results
+
+
+def synthetic_jpegs(count, size, seed=0):
+    rng = np.random.default_rng(seed)
+    blobs = []
+    for _ in range(count):
+        # smooth random image: compresses like a photo rather than like noise
+        small = rng.integers(0, 256, size=(size // 16, size // 16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize((size, size), Image.BILINEAR)
+        buf = io.BytesIO()
+        img.save(buf, format='JPEG', quality=90)
+        blobs.append(buf.getvalue())
+    return blobs
+
+
+def bench_decode(args):
+    blobs = synthetic_jpegs(args.decode_images, args.decode_source_size)
+    results = []
+    cases = [('full', [224]), ('full', [64]), ('full', [224, 64]), ('draft', [224]), ('draft', [64])]
+    for method, sizes in cases:
+        times = []
+        for blob in blobs:
+            start = time.perf_counter()
+            if method == 'draft':
+                decode_draft(io.BytesIO(blob), sizes[0])
+            else:
+                decode_image(io.BytesIO(blob), sizes)
+            times.append(time.perf_counter() - start)
+        entry = {'benchmark': 'decode', 'method': method, 'sizes': sizes, 'source_size': args.decode_source_size,
+                 **latency_stats(times, 1)}
+        results.append(entry)
+        print(f"  decode {method:<5} {args.decode_source_size}px -> {sizes}: {entry['images_per_sec']:9.1f} img/s  "
+              f"p50 {entry['latency_ms_p50']:6.2f} ms  p99 {entry['latency_ms_p99']:6.2f} ms")
+    return results
+
+
+def result_key(entry):
+    if entry['benchmark'] == 'decode':
+        return ('decode', entry.get('method', 'full'), tuple(entry['sizes']), entry['source_size'])
+    return ('score', entry['model'], entry['mc_mode'], entry['batch_size'], entry['samples'], entry['threads'],
+            entry['dtype'])
+
+
+def compare_to_baseline(results, baseline_path, tolerance):
+    """Prints the per-entry speed ratio vs the baseline. Returns the regressed entries."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result_key(e): e for e in json.load(f)['results']}
+    regressions = []
+    print(f"\n>>> Comparison with {baseline_path} (tolerance {tolerance:.0%})")
+    for entry in results:
+        base = baseline.get(result_key(entry))
+        if base is None:
+            continue
+        ratio = entry['images_per_sec'] / base['images_per_sec']
+        entry['baseline_images_per_sec'] = base['images_per_sec']
+        entry['speedup_vs_baseline'] = ratio
+        flag = ''
+        if ratio < 1.0 - tolerance:
+            regressions.append(entry)
+            flag = '  <-- REGRESSION'
+        print(f"  {result_key(entry)}: {ratio:5.2f}x{flag}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic throughput / latency benchmark for the OOD scorers")
+    parser.add_argument('--models', nargs='+', choices=['classifier', 'vae', 'student'],
+                        default=['classifier', 'vae'])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=BATCH_SIZES)
+    parser.add_argument('--samples', nargs='+', type=int, default=NUM_SAMPLES, help="MC sample counts")
+    parser.add_argument('--threads', nargs='+', type=int, default=[torch.get_num_threads()],
+                        help="torch intra-op thread counts")
+    parser.add_argument('--dtypes', nargs='+', choices=list(DTYPE_MAP), default=DTYPES,
+                        help="Autocast dtypes (float32 = autocast off)")
+    parser.add_argument('--mc-modes', nargs='+', choices=['head', 'full', 'analytic'], default=['head'],
+                        help="Classifier MC Dropout modes; 'analytic' also adds the VAE's sampling-free scoring")
+    parser.add_argument('--warmup', type=int, default=WARMUP_ITERS)
+    parser.add_argument('--iters', type=int, default=MEASURE_ITERS)
+    parser.add_argument('--decode-images', type=int, default=DECODE_IMAGES)
+    parser.add_argument('--decode-source-size', type=int, default=DECODE_SOURCE_SIZE)
+    parser.add_argument('--skip-decode', action='store_true')
+    parser.add_argument('--output', type=str, default=None, help="JSON result file (default: bench_<host>_<time>.json)")
+    parser.add_argument('--baseline', type=str, default=None, help="Earlier JSON result to compare against")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(0)
+    print(f">>> [Bench] device={DEVICE}, torch={torch.__version__}, cpus={os.cpu_count()}")
+
+    print(">>> Scoring")
+    results = bench_scoring(args, build_models(args.models))
+    if not args.skip_decode:
+        print(">>> Decode")
+        results += bench_decode(args)
+
+    regressions = []
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+
+    output = args.output or f"bench_{platform.node()}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({'host': host_info(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+                   'results': results}, f, indent=2)
+    print(f">>> Saved results to {output}")
+
+    if regressions:
+        print(f">>> {len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+"""
+Cascaded VAE -> classifier OOD detection over the full ID / OOD image trees.
+
+Every image is decoded once and both model inputs (64x64 and 224x224) are
+resized from that same buffer (scorers.decode_image). The cheap BayesianVAE
+score runs on every image; only images whose score lands inside the
+uncertain band go on to the ResNet18 MC Dropout stage:
+
+    VAE score <  low    -> ID   (decided by the VAE)
+    VAE score >  high   -> OOD  (decided by the VAE)
+    low <= score <= high -> ID / OOD from the classifier entropy
+
+The band edges are calibrated on a seeded, labelled sample of both trees so
+that the VAE-only decisions misclassify at most --max-vae-error of each
+class, and stored in a band file together with the checksums of both models
+and the entropy threshold (a change to either triggers recalibration).
+Calibration images are left out of the fused report. --mc-mode analytic
+scores both stages without sampling; the VAE scores shift slightly, so the
+band records whether it was fitted on them.
+
+    cd /app/src/Animals-10/pipeline
+    python cascade.py                              # calibrates on first use, then scores everything
+    python cascade.py --calibrate --max-vae-error 0.02
+    python cascade.py --band-low 310 --band-high 420
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from scorers import (CLASSIFIER_MODEL_PATH, ENTROPY_THRESHOLD, VAE_MODEL_PATH, ClassifierScorer, VAEScorer,
+                     decode_image)
+from common.profiling import StageProfiler, StartupTimer, add_profiling_args
+from common.streaming_metrics import StreamingMetrics
+from common.tensor_cache import file_checksum, scan_images
+
+# --- [Configuration] ---
+ID_DATA_DIR = '/app/data/animals'
+OOD_DATA_DIR = '/app/data/pokemon'
+BASE_RESULT_DIR = '/app/results/Animals-10/cascade'
+BAND_PATH = '/app/models/Animals-10/cascade_band.json'
+CALIBRATION_SIZE = 500  # images per tree
+MAX_VAE_ERROR = 0.01  # fraction of each class the VAE may decide wrongly on its own
+BATCH_SIZE = 64
+NUM_WORKERS = 4
+SEED = 0
+
+
+def get_next_run_dir(base_dir):
+    os.makedirs(base_dir, exist_ok=True)
+    i = 1
+    while True:
+        run_dir = os.path.join(base_dir, f"run_{i}")
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+            print(f">>> [System] Created new result directory: {run_dir}")
+            return run_dir, i
+        i += 1
+
+
+class DecodedImageDataset(Dataset):
+    """
+    (path, label) samples -> ({size: uint8 [3, size, size]}, label, path), one decode per image.
+    An unreadable file yields zero images and an empty path (dropped by decoded_rows), like OODDataset.
+    """
+
+    def __init__(self, samples, sizes):
+        self.samples = samples
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        path, label = self.samples[idx]
+        try:
+            return decode_image(path, self.sizes), label, path
+        except Exception:
+            return {size: torch.zeros(3, size, size, dtype=torch.uint8) for size in self.sizes}, label, ""
+
+
+def list_samples():
+    """Sorted (path, label) pairs of both trees: 0 = ID animal, 1 = OOD pokemon."""
+    samples = []
+    for root, label in ((ID_DATA_DIR, 0), (OOD_DATA_DIR, 1)):
+        samples += [(path, label) for path, _, _ in scan_images(root)[0]]
+    return samples
+
+
+def make_loader(samples, sizes, args):
+    return DataLoader(DecodedImageDataset(samples, sizes), batch_size=args.batch_size, shuffle=False,
+                      num_workers=args.num_workers)
+
+
+def decoded_rows(tensors, labels, paths):
+    """Drops the rows of files that failed to decode; returns (tensors, labels list, paths, failed count)."""
+    keep = [i for i, path in enumerate(paths) if path]
+    if len(keep) < len(paths):
+        tensors = {size: batch[keep] for size, batch in tensors.items()}
+    labels = labels.tolist()
+    return tensors, [labels[i] for i in keep], [paths[i] for i in keep], len(paths) - len(keep)
+
+
+def calibration_sample(samples, size, seed):
+    """Seeded random subset of `size` images per label."""
+    rng = np.random.default_rng(seed)
+    chosen = []
+    for label in (0, 1):
+        pool = [s for s in samples if s[1] == label]
+        picks = rng.choice(len(pool), size=min(size, len(pool)), replace=False)
+        chosen += [pool[i] for i in sorted(picks)]
+    return chosen
+
+
+def band_edges(id_scores, ood_scores, max_error):
+    """
+    low:  at most max_error of the OOD images score below it (would be passed as ID)
+    high: at most max_error of the ID images score above it (would be flagged as OOD)
+    """
+    low = float(np.quantile(ood_scores, max_error))
+    high = float(np.quantile(id_scores, 1.0 - max_error))
+    if low > high:
+        # the VAE alone separates the sample: collapse the band to a single threshold
+        low = high = (low + high) / 2.0
+    return low, high
+
+
+def cascade_batch(tensors, vae, classifier, band, profiler):
+    """
+    Scores one decoded batch. Returns a result dict per image; the classifier only
+    sees the images whose VAE score is inside [low, high].
+    """
+    low, high = band
+    with profiler.stage('vae'):
+        vae_results = vae.score(tensors[vae.image_size])
+    uncertain = [i for i, r in enumerate(vae_results) if low <= r['score'] <= high]
+    for r in vae_results:
+        r['stage'] = 'vae'
+        r['prediction'] = "OOD" if r['score'] > high else "ID"
+    if uncertain:
+        with profiler.stage('classifier'):
+            cls_results = classifier.score(tensors[classifier.image_size][uncertain])
+        for i, c in zip(uncertain, cls_results):
+            vae_results[i].update(stage='classifier', entropy=c['entropy'], pred_class=c['pred_class'],
+                                  confidence=c['confidence'], prediction=c['prediction'])
+    profiler.count('escalated', len(uncertain))
+    return vae_results
+
+
+def decision_metrics(labels, predictions, vae_scores, stages):
+    labels = np.asarray(labels)
+    flagged = np.asarray([p == "OOD" for p in predictions])
+    escalated = np.asarray([s == 'classifier' for s in stages])
+    n_id, n_ood = int((labels == 0).sum()), int((labels == 1).sum())
+    metrics = {
+        'images': len(labels),
+        'id_images': n_id,
+        'ood_images': n_ood,
+        'accuracy': float((flagged == (labels == 1)).mean()) if len(labels) else 0.0,
+        'tpr': float(flagged[labels == 1].mean()) if n_ood else 0.0,  # OOD detected
+        'fpr': float(flagged[labels == 0].mean()) if n_id else 0.0,  # false alarms on ID
+        'escalation_rate': float(escalated.mean()) if len(labels) else 0.0,
+    }
+    if n_id and n_ood:
+        sweep = StreamingMetrics(exact=True)
+        sweep.update(vae_scores, labels)
+        metrics['vae_auroc'] = sweep.summary()['auroc']
+    return metrics
+
+
+def calibrate(samples, vae, classifier, args):
+    """Fits the band on a labelled sample, then measures the cascade on that same sample."""
+    chosen = calibration_sample(samples, args.calibration_size, args.seed)
+    print(f">>> [Calibrate] Scoring {len(chosen)} labelled images with the VAE")
+    scores, decoded = [], []
+    # pass 1: VAE only, so only the 64x64 input is produced
+    for tensors, batch_labels, paths in tqdm(make_loader(chosen, [vae.image_size], args)):
+        tensors, batch_labels, paths, _ = decoded_rows(tensors, batch_labels, paths)
+        if paths:
+            scores += [r['score'] for r in vae.score(tensors[vae.image_size])]
+            decoded += zip(paths, batch_labels)
+    if len(decoded) < len(chosen):
+        print(f">>> [Calibrate] Skipped {len(chosen) - len(decoded)} unreadable images")
+    chosen = decoded
+    scores = np.asarray(scores)
+    labels = np.asarray([label for _, label in chosen])
+    low, high = band_edges(scores[labels == 0], scores[labels == 1], args.max_vae_error)
+
+    # pass 2: classifier on the in-band images only
+    in_band = [i for i, s in enumerate(scores) if low <= s <= high]
+    predictions = ["OOD" if s > high else "ID" for s in scores]
+    stages = ['vae'] * len(chosen)
+    if in_band:
+        print(f">>> [Calibrate] Scoring {len(in_band)} in-band images with the classifier")
+        position = {chosen[i][0]: i for i in in_band}
+        loader = make_loader([chosen[i] for i in in_band], [classifier.image_size], args)
+        for tensors, batch_labels, paths in tqdm(loader):
+            tensors, _, paths, _ = decoded_rows(tensors, batch_labels, paths)
+            if not paths:
+                continue
+            for path, r in zip(paths, classifier.score(tensors[classifier.image_size])):
+                predictions[position[path]] = r['prediction']
+                stages[position[path]] = 'classifier'
+
+    band = {
+        'low': low, 'high': high,
+        'max_vae_error': args.max_vae_error,
+        'entropy_threshold': args.entropy_threshold,
+        'vae_model': file_checksum(args.vae_model),
+        'classifier_model': file_checksum(args.classifier_model),
+        'vae_analytic': args.mc_mode == 'analytic',
+        'calibration': decision_metrics(labels, predictions, scores, stages),
+        'calibration_paths': [path for path, _ in chosen],
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.band)), exist_ok=True)
+    with open(args.band, 'w', encoding='utf-8') as f:
+        json.dump(band, f, indent=2)
+    cal = band['calibration']
+    print(f">>> [Calibrate] band = [{low:.4f}, {high:.4f}], escalation {cal['escalation_rate']:.1%}, "
+          f"accuracy {cal['accuracy']:.4f} (saved to {args.band})")
+    return band
+
+
+def load_band(args):
+    """Stored band, or None when it is missing or was calibrated for other models or settings."""
+    if not os.path.exists(args.band):
+        return None
+    with open(args.band, encoding='utf-8') as f:
+        band = json.load(f)
+    if (band.get('vae_model') != file_checksum(args.vae_model) or
+            band.get('classifier_model') != file_checksum(args.classifier_model)):
+        print(f">>> [Calibrate] {args.band} was calibrated for different model weights")
+        return None
+    if band.get('vae_analytic', False) != (args.mc_mode == 'analytic'):
+        print(f">>> [Calibrate] {args.band} was calibrated for a different VAE scoring mode")
+        return None
+    if band.get('entropy_threshold') != args.entropy_threshold:
+        print(f">>> [Calibrate] {args.band} was calibrated for a different classifier entropy threshold")
+        return None
+    return band
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cascaded VAE -> classifier OOD detection with shared decoding")
+    parser.add_argument('--vae-model', type=str, default=VAE_MODEL_PATH)
+    parser.add_argument('--classifier-model', type=str, default=CLASSIFIER_MODEL_PATH)
+    parser.add_argument('--entropy-threshold', type=float, default=ENTROPY_THRESHOLD,
+                        help="Classifier entropy above which an in-band image is OOD")
+    parser.add_argument('--mc-mode', choices=['head', 'full', 'analytic'], default='head',
+                        help="analytic: sampling-free moment propagation for both the VAE and the classifier")
+    parser.add_argument('--band', type=str, default=BAND_PATH, help="Calibrated band file (read / written)")
+    parser.add_argument('--calibrate', action='store_true', help="Recalibrate the band even if the file is valid")
+    parser.add_argument('--calibration-size', type=int, default=CALIBRATION_SIZE,
+                        help="Labelled images per tree used for calibration")
+    parser.add_argument('--max-vae-error', type=float, default=MAX_VAE_ERROR,
+                        help="Fraction of each class the VAE may misclassify without the classifier")
+    parser.add_argument('--band-low', type=float, default=None, help="Manual band (skips calibration)")
+    parser.add_argument('--band-high', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--num-workers', type=int, default=NUM_WORKERS, help="DataLoader decode processes")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads for inference")
+    add_profiling_args(parser)
+    args = parser.parse_args()
+    if (args.band_low is None) != (args.band_high is None):
+        parser.error("--band-low and --band-high must be given together")
+    if args.band_low is not None and args.band_low > args.band_high:
+        parser.error("--band-low must not exceed --band-high")
+    return args
+
+
+def main():
+    args = parse_args()
+    startup = StartupTimer()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    vae = VAEScorer(args.vae_model, analytic=args.mc_mode == 'analytic', startup=startup)
+    classifier = ClassifierScorer(args.classifier_model, threshold=args.entropy_threshold, mc_mode=args.mc_mode,
+                                  startup=startup)
+    startup.report()
+    samples = list_samples()
+
+    if args.band_low is not None:
+        low, high, held_out = args.band_low, args.band_high, set()
+    else:
+        band = None if args.calibrate else load_band(args)
+        if band is None:
+            band = calibrate(samples, vae, classifier, args)
+        low, high, held_out = band['low'], band['high'], set(band['calibration_paths'])
+
+    # Calibration images are not reported: their band was fitted on them
+    samples = [s for s in samples if s[0] not in held_out]
+    run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
+    csv_path = os.path.join(run_dir, f'cascade_report_run_{run_id}.csv')
+    profiler = StageProfiler(args.profile, run_dir, vae.device, interval=args.profile_interval,
+                             torch_profile=args.torch_profile)
+
+    print(f">>> [Cascade] {len(samples)} images, band = [{low:.4f}, {high:.4f}]")
+    labels, predictions, vae_scores, stages = [], [], [], []
+    failed = 0
+    start = time.perf_counter()
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Filename', 'Type', 'Path', 'VAE_Score', 'Stage', 'Entropy', 'Pred_Class', 'Confidence',
+                         'Prediction'])
+        loader = make_loader(samples, sorted({vae.image_size, classifier.image_size}), args)
+        for tensors, batch_labels, paths in profiler.iterate(tqdm(loader)):
+            tensors, batch_labels, paths, skipped = decoded_rows(tensors, batch_labels, paths)
+            failed += skipped
+            profiler.count('decode_errors', skipped)
+            if not paths:
+                profiler.step()
+                continue
+            results = cascade_batch(tensors, vae, classifier, (low, high), profiler)
+            with profiler.stage('csv_write'):
+                for path, label, r in zip(paths, batch_labels, results):
+                    escalated = r['stage'] == 'classifier'
+                    writer.writerow([os.path.basename(path), 'OOD_Pokemon' if label else 'ID_Animal', path,
+                                     f"{r['score']:.4f}", r['stage'],
+                                     f"{r['entropy']:.4f}" if escalated else '',
+                                     r['pred_class'] if escalated else '',
+                                     f"{r['confidence']:.4f}" if escalated else '', r['prediction']])
+            labels += batch_labels
+            predictions += [r['prediction'] for r in results]
+            vae_scores += [r['score'] for r in results]
+            stages += [r['stage'] for r in results]
+            profiler.count('images', len(results))
+            profiler.step()
+    elapsed = time.perf_counter() - start
+    profiler.finish()
+
+    summary = decision_metrics(labels, predictions, vae_scores, stages)
+    summary.update(band_low=low, band_high=high, seconds=elapsed,
+                   images_per_sec=len(labels) / elapsed if elapsed > 0 else 0.0,
+                   classifier_calls_saved=len(labels) - stages.count('classifier'), unreadable_images=failed)
+    summary_path = os.path.join(run_dir, f'cascade_summary_run_{run_id}.json')
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"==========================================")
+    print(f" Run ID:                 {run_id}")
+    print(f" Total Images Scanned:   {summary['images']}")
+    if failed:
+        print(f" Unreadable (skipped):   {failed}")
+    print(f" Sent to Classifier:     {summary['escalation_rate']:.1%}")
+    print(f" Accuracy:               {summary['accuracy']:.4f}")
+    print(f" OOD Detection (TPR):    {summary['tpr']:.4f}")
+    print(f" False Alarms (FPR):     {summary['fpr']:.4f}")
+    if 'vae_auroc' in summary:
+        print(f" VAE AUROC:              {summary['vae_auroc']:.5f}")
+    print(f" Throughput:             {summary['images_per_sec']:.1f} img/s")
+    print(f" Saved Results to:       {run_dir}")
+    print(f"==========================================")
+
+
+if __name__ == "__main__":
+    main()
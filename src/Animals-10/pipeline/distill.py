@@ -0,0 +1,382 @@
+"""
+Distills the two sampling-based OOD scores into the single-pass student of common/student.py.
+
+1. Teacher targets. The ResNet18 MC Dropout entropy and mean class
+   probabilities, plus the BayesianVAE ELBO, latent variance and score
+   (NUM_MC_SAMPLES draws each), are computed for every Animals-10 training image
+   and for --augment-copies augmented copies of it: crop, flip,
+   brightness / contrast. The augmentation parameters are seeded from
+   (--seed, path, copy), so each copy can be rebuilt exactly from the tensor
+   cache. The targets are stored in <cache_dir>/distill/targets-<key>.npz, where
+   the key covers both teacher checksums. Later runs compute only images that
+   are new to the file.
+2. Training through the shared TrainEngine (bf16 autocast where supported,
+   per-epoch checkpoints, --resume). Batches come from the 64x64 cache, with
+   the augmented copies rebuilt on the fly.
+3. Parity report. This runs on a held-out Animals-10 split (fixed per path,
+   never trained on) plus the whole Pokemon tree. For the classifier entropy
+   and the VAE score it reports teacher vs student AUROC, rank correlation
+   and per-image latency. It is saved as <student>_parity.json next to the
+   student weights.
+
+    cd /app/src/Animals-10/pipeline
+    python distill.py                                  # targets (cached) -> training -> parity report
+    python distill.py --epochs 60 --augment-copies 5
+    python distill.py --report-only                    # re-check an existing student
+
+Scoring with the student: serve.py / stream.py --models student,
+classifier/evaluate_ood.py --scorer student, vae/evaluate_ood.py --student.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import time
+import zlib
+
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from tqdm import tqdm
+
+from bench import latency_stats, time_calls
+from scorers import (CLASSES, CLASSIFIER_MODEL_PATH, DEVICE, ENTROPY_THRESHOLD, LATENT_ALPHA, NUM_MC_SAMPLES,
+                     STUDENT_MODEL_PATH, VAE_MODEL_PATH, ClassifierScorer, VAEScorer)
+from common.streaming_metrics import StreamingMetrics
+from common.student import TARGETS, UncertaintyStudent, distillation_loss, student_predict
+from common.tensor_cache import file_checksum, load_cached_dataset, normalize_batch
+from common.train_engine import CachedBatchLoader, TrainEngine, add_train_args, checkpoint_path
+from common.weights import load_checkpoint_model
+
+# --- [Configuration] ---
+ID_DATA_DIR = '/app/data/animals'
+OOD_DATA_DIR = '/app/data/pokemon'
+EPOCHS = 30
+BATCH_SIZE = 128
+LEARNING_RATE = 1e-3
+WEIGHT_DECAY = 1e-4
+AUGMENT_COPIES = 3  # augmented copies per training image, besides the original
+HOLDOUT_FRACTION = 0.1  # Animals-10 images kept out of training for the parity report
+TEACHER_BATCH_SIZE = 64
+SAVE_EVERY = 4096  # teacher targets computed between saves of the target file
+PARITY_TOLERANCE = 0.01  # max |AUROC(student) - AUROC(teacher)| for a pass
+LATENCY_BATCH_SIZES = [1, 64]
+LATENCY_WARMUP = 3
+LATENCY_ITERS = 20
+
+
+# --- Items: (dataset index, augmented copy) ---
+def path_hash(path):
+    return zlib.crc32(path.encode('utf-8'))
+
+
+def is_held_out(path, fraction):
+    """Fixed per path, so the split does not move when images are added to the tree."""
+    return path_hash(path) % 10000 < fraction * 10000
+
+
+def augment_params(seed, path, copy):
+    """Seeded parameters of augmented copy `copy` (>= 1) of an image; copy 0 is the image itself."""
+    if copy == 0:
+        return None
+    rng = np.random.default_rng([seed, path_hash(path), copy])
+    scale = rng.uniform(0.6, 1.0)
+    ratio = math.exp(rng.uniform(math.log(3 / 4), math.log(4 / 3)))
+    h, w = min(1.0, math.sqrt(scale / ratio)), min(1.0, math.sqrt(scale * ratio))
+    return {'box': (rng.uniform(0.0, 1.0 - h), rng.uniform(0.0, 1.0 - w), h, w), 'flip': bool(rng.random() < 0.5),
+            'brightness': rng.uniform(0.8, 1.2), 'contrast': rng.uniform(0.8, 1.2)}
+
+
+def augment(images, params):
+    """
+    uint8 [B, 3, S, S] -> augmented uint8 batch of the same size. The crop box is relative,
+    so the 224 (classifier) and 64 (VAE / student) versions of a copy show the same content.
+    """
+    if all(p is None for p in params):
+        return images
+    size = images.shape[-1]
+    out = images.clone()
+    for i, p in enumerate(params):
+        if p is None:
+            continue
+        top, left, h, w = p['box']
+        img = TF.resized_crop(images[i], round(top * size), round(left * size), max(1, round(h * size)),
+                              max(1, round(w * size)), [size, size], antialias=True)
+        if p['flip']:
+            img = TF.hflip(img)
+        out[i] = TF.adjust_contrast(TF.adjust_brightness(img, p['brightness']), p['contrast'])
+    return out
+
+
+class DistillBatchLoader(CachedBatchLoader):
+    """Shuffled (uint8 [B, 3, 64, 64], teacher targets [B, T + C]) batches over (image, copy) items."""
+
+    def __init__(self, dataset, item_index, item_params, targets, batch_size, seed):
+        super().__init__(dataset, batch_size, shuffle=True, seed=seed)
+        self.indices = np.arange(len(item_index), dtype=np.int64)
+        self.item_index = item_index
+        self.item_params = item_params
+        self.targets = targets
+
+    def _load(self, batch):
+        images = self.dataset.get_batch(self.item_index[batch])
+        return augment(images, [self.item_params[i] for i in batch]), torch.from_numpy(self.targets[batch])
+
+
+# --- Teacher targets ---
+def target_file(args):
+    key = json.dumps({'classifier': file_checksum(args.classifier_model), 'vae': file_checksum(args.vae_model),
+                      'samples': NUM_MC_SAMPLES, 'alpha': LATENT_ALPHA, 'seed': args.seed}, sort_keys=True)
+    return os.path.join(args.cache_dir, 'distill', f"targets-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]}.npz")
+
+
+class TeacherTargets:
+    """Teacher outputs per (path, copy), computed once and kept in an .npz file."""
+
+    def __init__(self, path, args):
+        self.path = path
+        self.args = args
+        self.teachers = None
+        self.rows = {}
+        self.values = np.zeros((0, len(TARGETS) + len(CLASSES)), dtype=np.float32)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                self.values = data['values']
+                self.rows = {(p, int(c)): i for i, (p, c) in enumerate(zip(data['paths'].tolist(),
+                                                                          data['copies'].tolist()))}
+            print(f">>> [Distill] {len(self.rows)} cached teacher targets in {path}")
+
+    def teacher_models(self):
+        if self.teachers is None:
+            print(">>> [Distill] Loading the teacher models")
+            self.teachers = (ClassifierScorer(self.args.classifier_model), VAEScorer(self.args.vae_model))
+        return self.teachers
+
+    def _compute(self, big, small, big_indices, small_indices, copies, paths):
+        classifier, vae = self.teacher_models()
+        out = np.empty((len(paths), self.values.shape[1]), dtype=np.float32)
+        batch_size = self.args.teacher_batch_size
+        for start in tqdm(range(0, len(paths), batch_size), desc='teacher targets'):
+            end = start + batch_size
+            params = [augment_params(self.args.seed, path, copy) for path, copy in zip(paths[start:end],
+                                                                                        copies[start:end])]
+            entropy, probs = classifier.score_tensors(augment(big.get_batch(big_indices[start:end]), params))
+            elbo, latent_var, score = vae.score_tensors(augment(small.get_batch(small_indices[start:end]), params))
+            # column order follows common.student.TARGETS, then the class probabilities
+            out[start:end] = torch.cat([torch.stack([entropy, score, elbo, latent_var], dim=1), probs],
+                                       dim=1).float().cpu().numpy()
+        return out
+
+    def get(self, big, small, indices, copies):
+        """
+        [N, T + C] targets for big / small (224 / 64 cached datasets of one tree) items
+        (indices into small, copies); missing ones are computed and saved.
+        """
+        paths = [small.samples[i][0] for i in indices]
+        big_index = {p: i for i, (p, _, _) in enumerate(big.samples)}
+        missing = [i for i, (p, c) in enumerate(zip(paths, copies)) if (p, int(c)) not in self.rows]
+        if missing:
+            print(f">>> [Distill] Computing teacher targets for {len(missing)} items ({NUM_MC_SAMPLES} samples each)")
+        # saved every SAVE_EVERY items, so an interrupted run keeps what it has computed
+        for start in range(0, len(missing), SAVE_EVERY):
+            chunk = missing[start:start + SAVE_EVERY]
+            values = self._compute(big, small, np.array([big_index[paths[i]] for i in chunk], dtype=np.int64),
+                                   indices[chunk], copies[chunk], [paths[i] for i in chunk])
+            for i, row in zip(chunk, range(len(self.values), len(self.values) + len(chunk))):
+                self.rows[(paths[i], int(copies[i]))] = row
+            self.values = np.concatenate([self.values, values])
+            self._save()
+        return self.values[[self.rows[(p, int(c))] for p, c in zip(paths, copies)]]
+
+    def _save(self):
+        keys = sorted(self.rows, key=self.rows.get)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp.npz'
+        np.savez(tmp_path, paths=np.array([p for p, _ in keys]), copies=np.array([c for _, c in keys]),
+                 values=self.values)
+        os.replace(tmp_path, self.path)
+
+
+# --- Parity report ---
+def spearman(a, b):
+    rank_a, rank_b = np.argsort(np.argsort(a)), np.argsort(np.argsort(b))
+    return float(np.corrcoef(rank_a, rank_b)[0, 1]) if len(a) > 1 else float('nan')
+
+
+def auroc(scores, labels):
+    metrics = StreamingMetrics(exact=True)
+    metrics.update(scores, labels)
+    return metrics.summary()['auroc']
+
+
+@torch.no_grad()
+def student_outputs(student, dataset, indices, batch_size):
+    student.eval()
+    outputs = []
+    for start in range(0, len(indices), batch_size):
+        images = normalize_batch(dataset.get_batch(indices[start:start + batch_size]).to(DEVICE))
+        pred = student_predict(student, images)
+        outputs.append(torch.stack([pred[name] for name in TARGETS], dim=1).cpu().numpy())
+    return np.concatenate(outputs) if outputs else np.zeros((0, len(TARGETS)), dtype=np.float32)
+
+
+@torch.no_grad()
+def latency(student, teachers, batch_size):
+    """Per-image latency (ms) of both MC teachers together vs the student, on random inputs."""
+    classifier, vae = teachers
+    big = torch.randint(0, 256, (batch_size, 3, classifier.image_size, classifier.image_size), dtype=torch.uint8)
+    small = torch.randint(0, 256, (batch_size, 3, vae.image_size, vae.image_size), dtype=torch.uint8)
+    teacher_times = time_calls(lambda: (classifier.score_tensors(big), vae.score_tensors(small)),
+                               LATENCY_WARMUP, LATENCY_ITERS)
+    student_times = time_calls(lambda: student_predict(student, normalize_batch(small.to(DEVICE))),
+                               LATENCY_WARMUP, LATENCY_ITERS)
+    teacher, student_stats = latency_stats(teacher_times, batch_size), latency_stats(student_times, batch_size)
+    return {'batch_size': batch_size,
+            'teacher_ms_per_image': 1000.0 / teacher['images_per_sec'],
+            'student_ms_per_image': 1000.0 / student_stats['images_per_sec'],
+            'speedup': student_stats['images_per_sec'] / teacher['images_per_sec']}
+
+
+def parity_report(student, targets, eval_sets, args):
+    """eval_sets: [(big, small, indices, label)]; writes <student>_parity.json and prints the summary."""
+    teacher_values, student_values, labels = [], [], []
+    for big, small, indices, label in eval_sets:
+        if not len(indices):
+            continue
+        teacher_values.append(targets.get(big, small, indices, np.zeros(len(indices), dtype=np.int64)))
+        student_values.append(student_outputs(student, small, indices, args.batch_size))
+        labels.append(np.full(len(indices), label))
+    teacher_values = np.concatenate(teacher_values)[:, :len(TARGETS)]
+    student_values = np.concatenate(student_values)
+    labels = np.concatenate(labels)
+    has_both = bool((labels == 0).any() and (labels == 1).any())
+
+    scores = {}
+    for name in TARGETS:
+        col = TARGETS.index(name)
+        t, s = teacher_values[:, col], student_values[:, col]
+        entry = {'spearman': spearman(t, s), 'mae': float(np.abs(t - s).mean()),
+                 'teacher_mean': float(t.mean()), 'student_mean': float(s.mean())}
+        if has_both and name in ('entropy', 'vae_score'):
+            entry.update(teacher_auroc=auroc(t, labels), student_auroc=auroc(s, labels))
+            entry['auroc_delta'] = entry['student_auroc'] - entry['teacher_auroc']
+        scores[name] = entry
+    entropy_col = TARGETS.index('entropy')
+    agreement = float(((teacher_values[:, entropy_col] > ENTROPY_THRESHOLD) ==
+                       (student_values[:, entropy_col] > ENTROPY_THRESHOLD)).mean())
+
+    teachers = targets.teacher_models()
+    latencies = [latency(student, teachers, b) for b in LATENCY_BATCH_SIZES]
+    deltas = [abs(e['auroc_delta']) for e in scores.values() if 'auroc_delta' in e]
+    report = {
+        'student': args.student,
+        'student_checksum': file_checksum(args.student) if os.path.exists(args.student) else None,
+        'classifier_model': file_checksum(args.classifier_model),
+        'vae_model': file_checksum(args.vae_model),
+        'id_images': int((labels == 0).sum()),
+        'ood_images': int((labels == 1).sum()),
+        'scores': scores,
+        'entropy_decision_agreement': agreement,
+        'latency': latencies,
+        'parity_tolerance': args.parity_tolerance,
+        'parity': bool(deltas) and max(deltas) <= args.parity_tolerance,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    report_path = os.path.splitext(args.student)[0] + '_parity.json'
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"==========================================")
+    print(f" Student vs MC teachers: {report['id_images']} held-out ID, {report['ood_images']} OOD images")
+    for name, label in (('entropy', 'Classifier entropy'), ('vae_score', 'VAE score')):
+        e = scores[name]
+        if 'auroc_delta' in e:
+            print(f" {label + ' AUROC:':<31}teacher {e['teacher_auroc']:.4f}  student {e['student_auroc']:.4f}  "
+                  f"(delta {e['auroc_delta']:+.4f})")
+        print(f" {label + ' rank corr.:':<31}{e['spearman']:.4f}")
+    print(f" {'Entropy decision agreement:':<31}{agreement:.1%} (threshold {ENTROPY_THRESHOLD})")
+    for lat in latencies:
+        name = f"Latency, batch {lat['batch_size']}:"
+        print(f" {name:<31}teacher {lat['teacher_ms_per_image']:.2f} ms/img  "
+              f"student {lat['student_ms_per_image']:.3f} ms/img  ({lat['speedup']:.0f}x)")
+    if deltas:
+        print(f" {'AUROC parity:':<31}{'PASS' if report['parity'] else 'FAIL'} "
+              f"(|delta| <= {args.parity_tolerance})")
+    print(f" {'Saved report to:':<31}{report_path}")
+    print(f"==========================================")
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Distill the MC Dropout / BayesianVAE scores into a single-pass student")
+    parser.add_argument('--student', type=str, default=STUDENT_MODEL_PATH, help="Student weights (written / read)")
+    parser.add_argument('--classifier-model', type=str, default=CLASSIFIER_MODEL_PATH)
+    parser.add_argument('--vae-model', type=str, default=VAE_MODEL_PATH)
+    parser.add_argument('--augment-copies', type=int, default=AUGMENT_COPIES,
+                        help="Augmented copies of every training image, besides the original")
+    parser.add_argument('--holdout-fraction', type=float, default=HOLDOUT_FRACTION,
+                        help="Animals-10 images kept out of training for the parity report")
+    parser.add_argument('--lr', type=float, default=LEARNING_RATE)
+    parser.add_argument('--teacher-batch-size', type=int, default=TEACHER_BATCH_SIZE)
+    parser.add_argument('--parity-tolerance', type=float, default=PARITY_TOLERANCE,
+                        help="Largest AUROC difference to the teacher that still counts as parity")
+    parser.add_argument('--report-only', action='store_true', help="Skip training, report on the existing student")
+    add_train_args(parser, epochs=EPOCHS, batch_size=BATCH_SIZE)
+    args = parser.parse_args()
+    if args.no_cache:
+        parser.error("distillation reads the tensor cache (the augmented copies are rebuilt from it)")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    id_big = load_cached_dataset(ID_DATA_DIR, ClassifierScorer.image_size, cache_dir=args.cache_dir)
+    id_small = load_cached_dataset(ID_DATA_DIR, VAEScorer.image_size, cache_dir=args.cache_dir)
+    held_out = np.array([is_held_out(p, args.holdout_fraction) for p, _, _ in id_small.samples], dtype=bool)
+    targets = TeacherTargets(target_file(args), args)
+
+    if args.report_only:
+        student = load_checkpoint_model(UncertaintyStudent, args.student, DEVICE)
+    else:
+        train_indices = np.nonzero(~held_out)[0]
+        item_index = np.repeat(train_indices, args.augment_copies + 1)
+        item_copy = np.tile(np.arange(args.augment_copies + 1), len(train_indices))
+        item_targets = targets.get(id_big, id_small, item_index, item_copy)
+        item_params = [augment_params(args.seed, id_small.samples[i][0], c) for i, c in zip(item_index, item_copy)]
+        print(f">>> [Distill] {len(train_indices)} training images x {args.augment_copies + 1} copies, "
+              f"{int(held_out.sum())} held out")
+
+        os.makedirs(os.path.dirname(os.path.abspath(args.student)), exist_ok=True)
+        student = UncertaintyStudent(num_classes=len(CLASSES))
+        student.set_target_stats(torch.from_numpy(item_targets[:, :len(TARGETS)]))
+        optimizer = torch.optim.AdamW(student.parameters(), lr=args.lr, weight_decay=WEIGHT_DECAY)
+        config = {'lr': args.lr, 'batch_size': args.batch_size, 'augment_copies': args.augment_copies,
+                  'holdout_fraction': args.holdout_fraction, 'targets': os.path.basename(targets.path)}
+        engine = TrainEngine(student, optimizer, distillation_loss, DEVICE, checkpoint_path(args.student),
+                             normalize=normalize_batch, precision=args.precision,
+                             channels_last=not args.no_channels_last, checkpoint_every=args.checkpoint_every,
+                             seed=args.seed, config=config)
+        start_epoch = engine.resume() if args.resume else 0
+        loader = DistillBatchLoader(id_small, item_index, item_params, item_targets.astype(np.float32),
+                                    args.batch_size, args.seed)
+        print(">>> [Distill] Training the student...")
+        engine.fit(loader, args.epochs, start_epoch)
+        engine.save_model(args.student)
+        print(f">>> [Distill] Student saved to {args.student}")
+
+    eval_sets = [(id_big, id_small, np.nonzero(held_out)[0], 0)]
+    if os.path.isdir(OOD_DATA_DIR):
+        ood_big = load_cached_dataset(OOD_DATA_DIR, ClassifierScorer.image_size, cache_dir=args.cache_dir)
+        ood_small = load_cached_dataset(OOD_DATA_DIR, VAEScorer.image_size, cache_dir=args.cache_dir)
+        eval_sets.append((ood_big, ood_small, np.arange(len(ood_small)), 1))
+    parity_report(student, targets, eval_sets, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Warm, batch-oriented wrappers around the two OOD detectors (and their
+distilled single-pass student), shared by the long-running pipeline entry
+points (server, stream screening, ...).
+
+classifier/model.py and vae/model.py are both named `model`, so they are
+loaded here under distinct module names instead of through sys.path.
+"""
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import torch
+from PIL import Image
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+from common.student import STUDENT_SIZE, UncertaintyStudent, student_predict  # noqa: E402
+from common.tensor_cache import normalize_batch  # noqa: E402
+from common.weights import load_checkpoint_model  # noqa: E402
+
+# --- [Configuration] ---
+CLASSIFIER_MODEL_PATH = '/app/models/Animals-10/classifier/animals10_resnet18.pth'
+VAE_MODEL_PATH = '/app/models/Animals-10/vae/vae_final.pth'
+STUDENT_MODEL_PATH = '/app/models/Animals-10/student/uncertainty_student.pth'
+
+CLASSES = ['butterfly', 'cat', 'chicken', 'cow', 'dog',
+           'elephant', 'horse', 'sheep', 'spider', 'squirrel']
+NUM_MC_SAMPLES = 30
+ENTROPY_THRESHOLD = 0.6
+LATENT_ALPHA = 100.0
+NORM_MEAN = [0.485, 0.456, 0.406]
+NORM_STD = [0.229, 0.224, 0.225]
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def load_method_module(method, name='model'):
+    """Imports src/Animals-10/<method>/<name>.py as module '<method>_<name>'."""
+    module_name = f"{method}_{name}"
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SRC_DIR, method, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def decode_image(source, sizes):
+    """
+    Decodes an image (path or file object) once and returns {size: uint8 [3, size, size]}.
+    Each resize matches transforms.Resize((size, size)) on the same decoded buffer.
+    """
+    with Image.open(source) as img:
+        img = img.convert('RGB')
+        decoded = {}
+        for size in sizes:
+            array = np.asarray(img.resize((size, size), Image.BILINEAR), dtype=np.uint8)
+            decoded[size] = torch.from_numpy(np.ascontiguousarray(array.transpose(2, 0, 1)))
+        return decoded
+
+
+class ClassifierScorer:
+    """
+    ResNet18 + MC Dropout entropy, scored on uint8 [B, 3, 224, 224] batches.
+    mc_mode 'analytic' replaces the sampling with the deterministic moment-propagation approximation.
+    """
+    name = 'classifier'
+    image_size = 224
+
+    def __init__(self, model_path=CLASSIFIER_MODEL_PATH, device=DEVICE, num_samples=NUM_MC_SAMPLES,
+                 threshold=ENTROPY_THRESHOLD, mc_mode='head', startup=None):
+        self.module = load_method_module('classifier')
+        self.model = load_checkpoint_model(
+            lambda: self.module.get_animal_model(num_classes=len(CLASSES), pretrained=False),
+            model_path, device, startup)
+        self.model.eval()
+        self.device = device
+        self.num_samples = num_samples
+        self.threshold = threshold
+        self.mc_mode = mc_mode
+
+    @torch.no_grad()
+    def score_tensors(self, images):
+        """uint8 batch -> (entropy [B], MC mean probabilities [B, C])."""
+        images = normalize_batch(images.to(self.device), NORM_MEAN, NORM_STD)
+        mean_probs = self.module.mc_dropout_probs(self.model, images, self.num_samples, mode=self.mc_mode).mean(dim=0)
+        return self.module.predictive_entropy(mean_probs), mean_probs
+
+    def score(self, images):
+        entropy, mean_probs = self.score_tensors(images)
+        entropy = entropy.cpu().tolist()
+        confidence, pred = mean_probs.max(dim=1)
+        results = []
+        for e, c, p in zip(entropy, confidence.cpu().tolist(), pred.cpu().tolist()):
+            results.append({'entropy': e, 'pred_class': CLASSES[p], 'confidence': c,
+                            'prediction': "OOD" if e > self.threshold else "ID"})
+        return results
+
+
+class VAEScorer:
+    """BayesianVAE negative ELBO + latent variance score on uint8 [B, 3, 64, 64] batches."""
+    name = 'vae'
+    image_size = 64
+
+    def __init__(self, model_path=VAE_MODEL_PATH, device=DEVICE, num_samples=NUM_MC_SAMPLES,
+                 alpha=LATENT_ALPHA, threshold=None, analytic=False, startup=None):
+        self.module = load_method_module('vae')
+        self.model = load_checkpoint_model(self.module.BayesianVAE, model_path, device, startup)
+        self.model.eval()
+        self.device = device
+        self.num_samples = num_samples
+        self.alpha = alpha
+        self.threshold = threshold
+        self.analytic = analytic  # deterministic moment propagation instead of num_samples MC draws
+
+    @torch.no_grad()
+    def score_tensors(self, images):
+        """uint8 batch -> (expected negative ELBO [B], latent variance [B], combined score [B])."""
+        images = normalize_batch(images.to(self.device))
+        if self.analytic:
+            return self.module.analytic_scores(self.model, images, alpha=self.alpha)
+        return self.module.bayesian_scores(self.model, images, samples=self.num_samples, alpha=self.alpha)
+
+    def score(self, images):
+        elbo, latent_var, score = self.score_tensors(images)
+        results = []
+        for s, e, v in zip(score.cpu().tolist(), elbo.cpu().tolist(), latent_var.cpu().tolist()):
+            result = {'score': s, 'elbo': e, 'latent_variance': v}
+            if self.threshold is not None:
+                result['prediction'] = "OOD" if s > self.threshold else "ID"
+            results.append(result)
+        return results
+
+
+class StudentScorer:
+    """
+    Distilled single-pass student (common/student.py, trained by distill.py) on uint8 [B, 3, 64, 64]
+    batches: one deterministic forward pass approximates both teachers' 30-sample outputs.
+    """
+    name = 'student'
+    image_size = STUDENT_SIZE
+
+    def __init__(self, model_path=STUDENT_MODEL_PATH, device=DEVICE, threshold=ENTROPY_THRESHOLD,
+                 vae_threshold=None, startup=None):
+        self.model = load_checkpoint_model(UncertaintyStudent, model_path, device, startup)
+        self.model.eval()
+        self.device = device
+        self.threshold = threshold
+        self.vae_threshold = vae_threshold
+
+    def score_tensors(self, images):
+        return student_predict(self.model, normalize_batch(images.to(self.device)))
+
+    def score(self, images):
+        outputs = {k: v.cpu() for k, v in self.score_tensors(images).items()}
+        confidence, pred = outputs['probs'].max(dim=1)
+        results = []
+        for i in range(len(pred)):
+            result = {'entropy': float(outputs['entropy'][i]), 'vae_score': float(outputs['vae_score'][i]),
+                      'elbo': float(outputs['elbo'][i]), 'latent_variance': float(outputs['latent_variance'][i]),
+                      'pred_class': CLASSES[int(pred[i])], 'confidence': float(confidence[i])}
+            ood = result['entropy'] > self.threshold
+            if self.vae_threshold is not None:
+                ood = ood or result['vae_score'] > self.vae_threshold
+            result['prediction'] = "OOD" if ood else "ID"
+            results.append(result)
+        return results
+
+
+def build_scorers(names, classifier_path=CLASSIFIER_MODEL_PATH, vae_path=VAE_MODEL_PATH, vae_threshold=None,
+                  mc_mode='head', student_path=STUDENT_MODEL_PATH, startup=None):
+    """mc_mode 'analytic' switches both the classifier and the VAE to their sampling-free approximations."""
+    scorers = []
+    for name in names:
+        if name == 'classifier':
+            scorers.append(ClassifierScorer(classifier_path, mc_mode=mc_mode, startup=startup))
+        elif name == 'vae':
+            scorers.append(VAEScorer(vae_path, threshold=vae_threshold, analytic=mc_mode == 'analytic',
+                                     startup=startup))
+        elif name == 'student':
+            scorers.append(StudentScorer(student_path, vae_threshold=vae_threshold, startup=startup))
+        else:
+            raise ValueError(f"Unknown scorer: {name}")
+    return scorers
@@ -0,0 +1,251 @@
+"""
+Long-lived local OOD scoring service.
+
+Keeps the ResNet18 classifier and/or the BayesianVAE warm, coalesces
+concurrent single-image requests into micro-batches (flushed when full or
+when the oldest request hits --max-latency-ms) and answers with JSON.
+
+    cd /app/src/Animals-10/pipeline
+    python serve.py --port 8000                      # TCP on 127.0.0.1
+    python serve.py --socket /tmp/ood.sock           # Unix socket
+
+    curl -s -X POST localhost:8000/score -H 'Content-Type: application/json' -d '{"path": "/app/data/pokemon/x.png"}'
+    curl -s -X POST localhost:8000/score --data-binary @image.jpg -H 'Content-Type: image/jpeg'
+    curl -s localhost:8000/health
+
+The request loop is asyncio; decoding runs on a small thread pool and all
+model inference on one dedicated worker thread. The pending queue is
+bounded: when it is full the server answers 503 instead of queueing more.
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from scorers import CLASSIFIER_MODEL_PATH, STUDENT_MODEL_PATH, VAE_MODEL_PATH, build_scorers, decode_image
+from common.profiling import StartupTimer
+
+# --- [Configuration] ---
+HOST = '127.0.0.1'
+PORT = 8000
+MAX_BATCH_SIZE = 32
+MAX_LATENCY_MS = 10.0  # oldest request waits at most this long for a batch to fill
+MAX_QUEUE = 256  # pending (decoded, not yet scored) requests before answering 503
+DECODE_THREADS = 4
+MAX_BODY_BYTES = 32 * 1024 * 1024
+
+
+class MicroBatcher:
+    """Collects decoded images from many requests and scores them together."""
+
+    def __init__(self, scorers, max_batch_size, max_latency_ms, max_queue):
+        self.scorers = scorers
+        self.sizes = sorted({s.image_size for s in scorers})
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        # one inference thread: torch already parallelizes inside each op
+        self.infer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ood-infer')
+        self.stats = {'requests': 0, 'batches': 0, 'images': 0, 'rejected': 0}
+
+    def full(self):
+        return self.queue.full()
+
+    async def submit(self, tensors):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((time.perf_counter(), tensors, future))
+        self.stats['requests'] += 1
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self.queue.get()
+            items = [first]
+            deadline = first[0] + self.max_latency
+            while len(items) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.infer_executor, self._score, [it[1] for it in items])
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats['batches'] += 1
+            self.stats['images'] += len(items)
+            for (_, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _score(self, batch):
+        results = [{} for _ in batch]
+        for scorer in self.scorers:
+            images = torch.stack([tensors[scorer.image_size] for tensors in batch])
+            for result, scored in zip(results, scorer.score(images)):
+                result[scorer.name] = scored
+        return results
+
+
+class OODServer:
+    def __init__(self, batcher, decode_threads):
+        self.batcher = batcher
+        self.decode_executor = ThreadPoolExecutor(max_workers=decode_threads, thread_name_prefix='ood-decode')
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                status, payload = await self._dispatch(method, target, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+            raise ConnectionError("request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    async def _dispatch(self, method, target, headers, body):
+        if method == 'GET' and target == '/health':
+            return 200, {'status': 'ok', 'models': [s.name for s in self.batcher.scorers],
+                         'queue_depth': self.batcher.queue.qsize(), **self.batcher.stats}
+        if method != 'POST' or target != '/score':
+            return 404, {'error': f"unknown endpoint {method} {target}"}
+
+        # Backpressure: refuse before spending any decode work
+        if self.batcher.full():
+            self.batcher.stats['rejected'] += 1
+            return 503, {'error': 'queue full, retry later'}
+
+        start = time.perf_counter()
+        # a JSON path request; curl -d without a JSON content type still sends the body as a form, so sniff '{' too
+        if headers.get('content-type', '').startswith('application/json') or body.lstrip().startswith(b'{'):
+            try:
+                source = json.loads(body)['path']
+            except (ValueError, KeyError):
+                return 400, {'error': 'expected JSON body {"path": ...}'}
+        else:
+            source = io.BytesIO(body)
+
+        loop = asyncio.get_running_loop()
+        try:
+            tensors = await loop.run_in_executor(self.decode_executor, decode_image, source, self.batcher.sizes)
+        except Exception as e:
+            return 400, {'error': f"cannot decode image: {e}"}
+
+        if self.batcher.full():
+            self.batcher.stats['rejected'] += 1
+            return 503, {'error': 'queue full, retry later'}
+        try:
+            result = await self.batcher.submit(tensors)
+        except Exception as e:
+            return 500, {'error': f"inference failed: {e}"}
+        result['latency_ms'] = (time.perf_counter() - start) * 1000.0
+        if isinstance(source, str):
+            result['path'] = source
+        return 200, result
+
+    @staticmethod
+    def _write_response(writer, status, payload, keep_alive):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error',
+                  503: 'Service Unavailable'}[status]
+        body = json.dumps(payload).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {reason}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+
+async def serve(args, startup):
+    scorers = build_scorers(args.models, classifier_path=args.classifier_model, vae_path=args.vae_model,
+                            vae_threshold=args.vae_threshold, mc_mode=args.mc_mode, student_path=args.student_model,
+                            startup=startup)
+    batcher = MicroBatcher(scorers, args.max_batch_size, args.max_latency_ms, args.max_queue)
+    server = OODServer(batcher, args.decode_threads)
+    batch_task = asyncio.create_task(batcher.run())
+
+    if args.socket:
+        listener = await asyncio.start_unix_server(server.handle, path=args.socket)
+        where = args.socket
+    else:
+        listener = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+        where = f"http://{args.host}:{args.port}"
+    startup.report()
+    print(f">>> [Server] {', '.join(args.models)} ready on {where} "
+          f"(max batch {args.max_batch_size}, max latency {args.max_latency_ms} ms, queue {args.max_queue})")
+
+    async with listener:
+        try:
+            await listener.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Resident OOD scoring server with dynamic micro-batching")
+    parser.add_argument('--host', type=str, default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--socket', type=str, default=None, help="Listen on a Unix socket instead of TCP")
+    parser.add_argument('--models', nargs='+', choices=['classifier', 'vae', 'student'],
+                        default=['classifier', 'vae'],
+                        help="student: the distilled single-pass model (distill.py) instead of the MC teachers")
+    parser.add_argument('--classifier-model', type=str, default=CLASSIFIER_MODEL_PATH)
+    parser.add_argument('--vae-model', type=str, default=VAE_MODEL_PATH)
+    parser.add_argument('--student-model', type=str, default=STUDENT_MODEL_PATH)
+    parser.add_argument('--vae-threshold', type=float, default=None,
+                        help="Optional score threshold to add an ID/OOD prediction to VAE results")
+    parser.add_argument('--mc-mode', choices=['head', 'full', 'analytic'], default='head',
+                        help="analytic: sampling-free moment propagation for both the VAE and the classifier")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-latency-ms', type=float, default=MAX_LATENCY_MS)
+    parser.add_argument('--max-queue', type=int, default=MAX_QUEUE)
+    parser.add_argument('--decode-threads', type=int, default=DECODE_THREADS)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads for inference")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    startup = StartupTimer()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    try:
+        asyncio.run(serve(args, startup))
+    except KeyboardInterrupt:
+        print("\n>>> [Server] Stopped")
@@ -0,0 +1,391 @@
+"""
+Continuous OOD screening of a stream of image files.
+
+Paths arrive either on stdin (one per line, scoring stops at EOF) or from an
+inbox directory that is watched with inotify (Linux, no extra package) or,
+where inotify is unavailable, by polling. Arriving images are grouped into
+batches that are flushed when --max-batch-size images are waiting or the
+oldest one has waited --max-latency-ms, decoded once on a thread pool for
+all model input sizes, scored with the warm classifier and/or BayesianVAE,
+and reported as one JSON line per image.
+
+    cd /app/src/Animals-10/pipeline
+    find /data/incoming -name '*.jpg' | python stream.py --models vae --vae-threshold 160 > scores.jsonl
+    python stream.py --watch /data/inbox --quarantine /data/quarantine --processed-dir /data/screened
+
+An image is OOD when any scorer that makes a decision says so (the VAE only
+decides when --vae-threshold is given). With --quarantine, OOD images are
+moved there; with --processed-dir, the other images of a watched inbox are
+moved out of it after scoring. JSON lines go to stdout (or --output), logs
+to stderr.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import queue
+import select
+import shutil
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from scorers import CLASSIFIER_MODEL_PATH, STUDENT_MODEL_PATH, VAE_MODEL_PATH, build_scorers, decode_image
+from common.profiling import StartupTimer
+
+# --- [Configuration] ---
+MAX_BATCH_SIZE = 32
+MAX_LATENCY_MS = 200.0  # oldest queued image waits at most this long for a batch to fill
+POLL_INTERVAL = 1.0  # seconds between inbox scans when inotify is unavailable
+DECODE_THREADS = 4
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# inotify(7): a file is ready once it was closed after writing or moved into the directory,
+# and leaves the inbox when it is moved out or deleted
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_LEFT = IN_MOVED_FROM | IN_DELETE
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.')
+
+
+class Inotify:
+    """Minimal inotify binding through libc (files written to, moved into / out of or deleted from one directory)."""
+
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or libc_name is None:
+            raise OSError("inotify is only available on Linux")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_LEFT) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout):
+        """(file name, event mask) pairs of the events within `timeout` s; None means the event queue overflowed."""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            events.append((os.fsdecode(data[offset:offset + length].rstrip(b'\0')), mask))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InboxWatcher(threading.Thread):
+    """
+    Queues every image that is written to `directory`, plus the ones already there at startup.
+    Files found by a directory scan (startup, polling) are queued once their size did not change
+    between two scans, so a file still being written is not scored truncated.
+    `seen` holds the queued paths that are still in the inbox.
+    """
+
+    def __init__(self, directory, out_queue, stop, poll_interval=POLL_INTERVAL, use_inotify=True):
+        super().__init__(name='inbox-watcher', daemon=True)
+        self.directory = directory
+        self.out_queue = out_queue
+        self.stop = stop
+        self.poll_interval = poll_interval
+        self.seen = set()
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify(directory)
+            except OSError as e:
+                log(f">>> [Stream] inotify unavailable ({e}), polling every {poll_interval} s")
+
+    def _queue(self, name, rewritten=False):
+        """
+        rewritten=True: an inotify event, i.e. a completed (re)write, queued again if the name was seen
+        before, unless the earlier entry is still waiting (it will be decoded with the final content).
+        """
+        path = os.path.join(self.directory, name)
+        if not is_image(name) or (path in self.seen and (not rewritten or self._waiting(path))):
+            return
+        self.seen.add(path)
+        self.out_queue.put((path, time.monotonic()))
+
+    def _waiting(self, path):
+        with self.out_queue.mutex:
+            return any(item is not None and item[0] == path for item in self.out_queue.queue)
+
+    def _queue_stable(self, previous, current):
+        """Queues the images whose size is the same in both scans (still being written otherwise)."""
+        for name, size in sorted(current.items()):
+            if previous.get(name) == size:
+                self._queue(name)
+
+    def _scan(self):
+        """Directory listing: name -> size, for the images not queued yet."""
+        sizes = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and is_image(entry.name) and entry.path not in self.seen:
+                    sizes[entry.name] = entry.stat().st_size
+        # forget files that left the inbox (quarantined / processed), so a re-delivered file is scored again
+        present = {os.path.join(self.directory, name) for name in os.listdir(self.directory)}
+        self.seen &= present
+        return sizes
+
+    def run(self):
+        # files written before the watch started: compared with a second scan one interval later
+        previous = self._scan()
+        if self.inotify is not None:
+            startup_deadline = time.monotonic() + self.poll_interval
+            try:
+                while not self.stop.is_set():
+                    if previous is not None and time.monotonic() >= startup_deadline:
+                        # a file closed in the meantime was queued by its event; one still open gets one later
+                        self._queue_stable(previous, self._scan())
+                        previous = None
+                    events = self.inotify.read(timeout=0.5 if previous is None else
+                                               min(0.5, max(0.0, startup_deadline - time.monotonic())))
+                    if events is None:  # overflow: events were lost, fall back to a full scan
+                        for name in sorted(self._scan()):
+                            self._queue(name)
+                        continue
+                    for name, mask in events:
+                        if mask & IN_LEFT:
+                            self.seen.discard(os.path.join(self.directory, name))
+                        else:
+                            self._queue(name, rewritten=True)
+            finally:
+                self.inotify.close()
+            return
+
+        # Polling: a file is queued once its size did not change between two scans
+        while not self.stop.wait(self.poll_interval):
+            current = self._scan()
+            self._queue_stable(previous, current)
+            previous = current
+
+
+class StdinReader(threading.Thread):
+    """Queues one path per stdin line, then None at EOF."""
+
+    def __init__(self, out_queue):
+        super().__init__(name='stdin-reader', daemon=True)
+        self.out_queue = out_queue
+
+    def run(self):
+        for line in sys.stdin:
+            path = line.strip()
+            if path:
+                self.out_queue.put((path, time.monotonic()))
+        self.out_queue.put(None)
+
+
+def collect_batch(in_queue, max_batch_size, max_latency, stop):
+    """
+    Blocks for the first item, then gathers more until the batch is full or the first
+    item has waited max_latency and nothing else is queued. Returns (items, eof).
+    """
+    while True:
+        if stop.is_set():
+            return [], True
+        try:
+            first = in_queue.get(timeout=0.5)
+            break
+        except queue.Empty:
+            continue
+    if first is None:
+        return [], True
+    items = [first]
+    deadline = first[1] + max_latency
+    while len(items) < max_batch_size:
+        # past the deadline, still take whatever is already queued (backlog built up while scoring)
+        timeout = max(0.0, deadline - time.monotonic())
+        try:
+            item = in_queue.get(timeout=timeout) if timeout > 0 else in_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+def move_unique(path, directory):
+    """Moves path into directory, adding a numeric suffix instead of overwriting."""
+    os.makedirs(directory, exist_ok=True)
+    stem, ext = os.path.splitext(os.path.basename(path))
+    dest, i = os.path.join(directory, stem + ext), 1
+    while os.path.exists(dest):
+        dest, i = os.path.join(directory, f"{stem}_{i}{ext}"), i + 1
+    shutil.move(path, dest)
+    return dest
+
+
+def _decode(path, sizes):
+    try:
+        return decode_image(path, sizes), None
+    except Exception as e:
+        return None, str(e)
+
+
+class StreamScreener:
+    def __init__(self, scorers, decode_threads, quarantine=None, processed_dir=None, output=sys.stdout):
+        self.scorers = scorers
+        self.sizes = sorted({s.image_size for s in scorers})
+        self.decode_executor = ThreadPoolExecutor(max_workers=decode_threads, thread_name_prefix='stream-decode')
+        self.quarantine = quarantine
+        self.processed_dir = processed_dir
+        self.output = output
+        self.stats = {'images': 0, 'batches': 0, 'ood': 0, 'errors': 0, 'latency_ms_total': 0.0}
+
+    def process(self, items):
+        paths = [path for path, _ in items]
+        decoded = list(self.decode_executor.map(_decode, paths, [self.sizes] * len(paths)))
+        ok = [i for i, (tensors, _) in enumerate(decoded) if tensors is not None]
+
+        results = [{'path': path} for path in paths]
+        for i, (_, error) in enumerate(decoded):
+            if error is not None:
+                results[i]['error'] = f"cannot decode image: {error}"
+        if ok:
+            with torch.no_grad():
+                for scorer in self.scorers:
+                    images = torch.stack([decoded[i][0][scorer.image_size] for i in ok])
+                    for i, scored in zip(ok, scorer.score(images)):
+                        results[i][scorer.name] = scored
+
+        now = time.monotonic()
+        for (path, arrived), result in zip(items, results):
+            if 'error' not in result:
+                result['ood'] = any(result[s.name].get('prediction') == "OOD" for s in self.scorers)
+                self._route(path, result)
+            result['latency_ms'] = (now - arrived) * 1000.0
+            self._emit(result)
+        self.stats['batches'] += 1
+
+    def _route(self, path, result):
+        try:
+            if result['ood'] and self.quarantine:
+                result['moved_to'] = move_unique(path, self.quarantine)
+            elif not result['ood'] and self.processed_dir:
+                result['moved_to'] = move_unique(path, self.processed_dir)
+        except OSError as e:
+            result['move_error'] = str(e)
+
+    def _emit(self, result):
+        self.stats['images'] += 1
+        self.stats['ood'] += int(result.get('ood', False))
+        self.stats['errors'] += int('error' in result)
+        self.stats['latency_ms_total'] += result['latency_ms']
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+
+    def close(self):
+        self.decode_executor.shutdown()
+        images = self.stats['images']
+        mean_latency = self.stats['latency_ms_total'] / images if images else 0.0
+        log(f">>> [Stream] {images} images in {self.stats['batches']} batches, {self.stats['ood']} OOD, "
+            f"{self.stats['errors']} unreadable, mean latency {mean_latency:.1f} ms")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stream OOD screening from stdin or a watched inbox directory")
+    parser.add_argument('--watch', type=str, default=None, metavar='DIR',
+                        help="Inbox directory to watch (default: read paths from stdin)")
+    parser.add_argument('--poll', action='store_true', help="Poll the inbox instead of using inotify")
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--models', nargs='+', choices=['classifier', 'vae', 'student'],
+                        default=['classifier', 'vae'],
+                        help="student: the distilled single-pass model (distill.py) instead of the MC teachers")
+    parser.add_argument('--classifier-model', type=str, default=CLASSIFIER_MODEL_PATH)
+    parser.add_argument('--vae-model', type=str, default=VAE_MODEL_PATH)
+    parser.add_argument('--student-model', type=str, default=STUDENT_MODEL_PATH)
+    parser.add_argument('--vae-threshold', type=float, default=None,
+                        help="Score threshold above which the VAE calls an image OOD (else it only reports scores)")
+    parser.add_argument('--mc-mode', choices=['head', 'full', 'analytic'], default='head',
+                        help="analytic: sampling-free moment propagation for both the VAE and the classifier")
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--max-latency-ms', type=float, default=MAX_LATENCY_MS)
+    parser.add_argument('--decode-threads', type=int, default=DECODE_THREADS)
+    parser.add_argument('--quarantine', type=str, default=None, metavar='DIR', help="Move OOD images here")
+    parser.add_argument('--processed-dir', type=str, default=None, metavar='DIR',
+                        help="Move the non-OOD images here after scoring (keeps a watched inbox empty)")
+    parser.add_argument('--output', type=str, default=None, help="Append JSON lines to this file instead of stdout")
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads for inference")
+    args = parser.parse_args()
+    if args.watch and not os.path.isdir(args.watch):
+        parser.error(f"--watch directory not found: {args.watch}")
+    return args
+
+
+def main():
+    args = parse_args()
+    startup = StartupTimer()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    scorers = build_scorers(args.models, classifier_path=args.classifier_model, vae_path=args.vae_model,
+                            vae_threshold=args.vae_threshold, mc_mode=args.mc_mode, student_path=args.student_model,
+                            startup=startup)
+    startup.report(file=sys.stderr)
+    if not any(s.name in ('classifier', 'student') or s.threshold is not None for s in scorers):
+        log(">>> [Stream] No scorer makes ID/OOD decisions (VAE without --vae-threshold): scores only")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    in_queue = queue.Queue()
+    if args.watch:
+        source = InboxWatcher(args.watch, in_queue, stop, args.poll_interval, use_inotify=not args.poll)
+        log(f">>> [Stream] Watching {args.watch} ({'polling' if source.inotify is None else 'inotify'})")
+    else:
+        source = StdinReader(in_queue)
+        log(">>> [Stream] Reading image paths from stdin")
+    source.start()
+
+    output = open(args.output, 'a', encoding='utf-8') if args.output else sys.stdout
+    screener = StreamScreener(scorers, args.decode_threads, args.quarantine, args.processed_dir, output)
+    try:
+        while True:
+            items, eof = collect_batch(in_queue, args.max_batch_size, args.max_latency_ms / 1000.0, stop)
+            if items:
+                screener.process(items)
+            if eof:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        screener.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
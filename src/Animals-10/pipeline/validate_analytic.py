@@ -0,0 +1,205 @@
+"""
+Validation report for the sampling-free 'analytic' scoring mode.
+
+The analytic mode propagates the mean and variance of the dropout output
+through the following linear layers instead of averaging NUM_MC_SAMPLES
+stochastic passes:
+
+    classifier  Dropout(0.5) -> Linear: exact logit mean / covariance, then
+                E[softmax] over sigma points (classifier/model.py analytic_probs)
+    VAE         Dropout(0.2) -> fc_mu / fc_logvar: exact latent variance and
+                KL moments, decoder once at the mean latent (vae/model.py analytic_scores)
+
+This script scores a seeded sample of both image trees with both modes and
+reports, per score: AUROC under MC and analytic, rank correlation and mean
+absolute difference to MC, ID / OOD decision agreement, and images/s. A second
+independent MC run gives the noise floor the analytic differences should be
+read against ("MC vs MC"). The analytic mode is scored twice to confirm that it
+is bit-for-bit repeatable. The report is saved as JSON (--output).
+
+    cd /app/src/Animals-10/pipeline
+    python validate_analytic.py                    # 1000 images per tree, both models
+    python validate_analytic.py --limit 0 --models classifier
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from distill import auroc, spearman
+from scorers import (CLASSIFIER_MODEL_PATH, ENTROPY_THRESHOLD, NUM_MC_SAMPLES, VAE_MODEL_PATH, ClassifierScorer,
+                     VAEScorer)
+from common.tensor_cache import DEFAULT_CACHE_DIR, file_checksum, load_cached_dataset
+
+# --- [Configuration] ---
+ID_DATA_DIR = '/app/data/animals'
+OOD_DATA_DIR = '/app/data/pokemon'
+REPORT_PATH = '/app/models/Animals-10/analytic_validation.json'
+LIMIT = 1000  # images sampled per tree (0 = all)
+BATCH_SIZE = 64
+SEED = 0
+VAE_ID_TPR = 0.95  # the VAE has no fixed threshold: decisions use the MC score at 95% ID TPR
+SCORE_NAMES = {'classifier': ['entropy'], 'vae': ['elbo', 'latent_variance', 'score']}
+
+
+def sample_indices(size, limit, seed):
+    if not limit or limit >= size:
+        return np.arange(size)
+    return np.sort(np.random.default_rng(seed).choice(size, limit, replace=False))
+
+
+def set_mode(scorer, analytic):
+    if scorer.name == 'classifier':
+        scorer.mc_mode = 'analytic' if analytic else 'head'
+    else:
+        scorer.analytic = analytic
+
+
+@torch.no_grad()
+def score_tree(scorer, dataset, indices, batch_size, analytic, seconds):
+    """{score name: [N]} for dataset[indices]; adds the model time to seconds[mode]."""
+    set_mode(scorer, analytic)
+    columns = []
+    for start in range(0, len(indices), batch_size):
+        images = dataset.get_batch(indices[start:start + batch_size])
+        begin = time.perf_counter()
+        outputs = scorer.score_tensors(images)
+        seconds['analytic' if analytic else 'mc'] += time.perf_counter() - begin
+        # classifier: (entropy, mean probs), VAE: (elbo, latent variance, score)
+        outputs = outputs[:1] if scorer.name == 'classifier' else outputs
+        columns.append(torch.stack([o.float() for o in outputs], dim=1).cpu().numpy())
+    values = np.concatenate(columns)
+    return {name: values[:, i] for i, name in enumerate(SCORE_NAMES[scorer.name])}
+
+
+def compare(mc, mc_ref, analytic, labels, threshold):
+    entry = {'mc_mean': float(mc.mean()), 'analytic_mean': float(analytic.mean()),
+             'spearman': spearman(mc, analytic), 'spearman_mc_vs_mc': spearman(mc, mc_ref),
+             'mae': float(np.abs(mc - analytic).mean()), 'mae_mc_vs_mc': float(np.abs(mc - mc_ref).mean())}
+    if (labels == 0).any() and (labels == 1).any():
+        entry.update(mc_auroc=auroc(mc, labels), mc_ref_auroc=auroc(mc_ref, labels),
+                     analytic_auroc=auroc(analytic, labels))
+        entry['auroc_delta'] = entry['analytic_auroc'] - entry['mc_auroc']
+    if threshold is not None:
+        entry.update(threshold=float(threshold),
+                     decision_agreement=float(((mc > threshold) == (analytic > threshold)).mean()),
+                     decision_agreement_mc_vs_mc=float(((mc > threshold) == (mc_ref > threshold)).mean()))
+    return entry
+
+
+def validate(scorer, trees, args):
+    """trees: [(dataset, indices, label)] -> report section for one model."""
+    seconds = {'mc': 0.0, 'analytic': 0.0}
+    runs = {'mc': [], 'mc_ref': [], 'analytic': [], 'analytic_repeat': []}
+    labels = []
+    for dataset, indices, label in trees:
+        desc = f"{scorer.name} {'ID' if label == 0 else 'OOD'}"
+        for start in tqdm(range(0, len(indices), args.chunk), desc=desc):
+            chunk = indices[start:start + args.chunk]
+            runs['mc'].append(score_tree(scorer, dataset, chunk, args.batch_size, False, seconds))
+            runs['mc_ref'].append(score_tree(scorer, dataset, chunk, args.batch_size, False, {'mc': 0.0}))
+            runs['analytic'].append(score_tree(scorer, dataset, chunk, args.batch_size, True, seconds))
+            runs['analytic_repeat'].append(score_tree(scorer, dataset, chunk, args.batch_size, True,
+                                                      {'analytic': 0.0}))
+        labels.append(np.full(len(indices), label))
+    labels = np.concatenate(labels)
+    runs = {run: {name: np.concatenate([part[name] for part in parts]) for name in SCORE_NAMES[scorer.name]}
+            for run, parts in runs.items()}
+
+    scores = {}
+    for name in SCORE_NAMES[scorer.name]:
+        mc = runs['mc'][name]
+        if scorer.name == 'classifier':
+            threshold = scorer.threshold
+        elif name == 'score' and (labels == 0).any():
+            threshold = np.quantile(mc[labels == 0], VAE_ID_TPR)
+        else:
+            threshold = None
+        scores[name] = compare(mc, runs['mc_ref'][name], runs['analytic'][name], labels, threshold)
+    repeat_diff = max(float(np.abs(runs['analytic'][n] - runs['analytic_repeat'][n]).max())
+                      for n in SCORE_NAMES[scorer.name])
+    images = len(labels)
+    return {
+        'id_images': int((labels == 0).sum()),
+        'ood_images': int((labels == 1).sum()),
+        'scores': scores,
+        'mc_images_per_sec': images / seconds['mc'] if seconds['mc'] > 0 else 0.0,
+        'analytic_images_per_sec': images / seconds['analytic'] if seconds['analytic'] > 0 else 0.0,
+        'analytic_max_repeat_difference': repeat_diff,
+    }
+
+
+def print_report(report):
+    print(f"==========================================")
+    print(f" Analytic vs {NUM_MC_SAMPLES}-sample MC")
+    for model, section in report['models'].items():
+        print(f" [{model}] {section['id_images']} ID, {section['ood_images']} OOD images")
+        for name, e in section['scores'].items():
+            if 'auroc_delta' in e:
+                print(f"   {name + ' AUROC:':<34}MC {e['mc_auroc']:.4f} (rerun {e['mc_ref_auroc']:.4f})  "
+                      f"analytic {e['analytic_auroc']:.4f}  (delta {e['auroc_delta']:+.4f})")
+            print(f"   {name + ' rank corr.:':<34}{e['spearman']:.4f} (MC vs MC {e['spearman_mc_vs_mc']:.4f})")
+            print(f"   {name + ' mean abs. diff.:':<34}{e['mae']:.4g} (MC vs MC {e['mae_mc_vs_mc']:.4g})")
+            if 'decision_agreement' in e:
+                print(f"   {name + ' decisions agree:':<34}{e['decision_agreement']:.1%} "
+                      f"(MC vs MC {e['decision_agreement_mc_vs_mc']:.1%}, threshold {e['threshold']:.4g})")
+        speedup = section['analytic_images_per_sec'] / max(section['mc_images_per_sec'], 1e-12)
+        print(f"   {'Throughput:':<34}MC {section['mc_images_per_sec']:.1f} img/s  "
+              f"analytic {section['analytic_images_per_sec']:.1f} img/s  ({speedup:.1f}x)")
+        print(f"   {'Analytic repeatability:':<34}max |run1 - run2| = "
+              f"{section['analytic_max_repeat_difference']:.3g}")
+    print(f" {'Saved report to:':<36}{report['output']}")
+    print(f"==========================================")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare the analytic (sampling-free) scores with MC sampling")
+    parser.add_argument('--models', nargs='+', choices=['classifier', 'vae'], default=['classifier', 'vae'])
+    parser.add_argument('--classifier-model', type=str, default=CLASSIFIER_MODEL_PATH)
+    parser.add_argument('--vae-model', type=str, default=VAE_MODEL_PATH)
+    parser.add_argument('--limit', type=int, default=LIMIT, help="Images sampled per tree (0 = all)")
+    parser.add_argument('--seed', type=int, default=SEED, help="Seed of the image sample and the MC draws")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--chunk', type=int, default=BATCH_SIZE * 8,
+                        help="Images scored by all four runs before moving on (bounds the data read twice)")
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--output', type=str, default=REPORT_PATH)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+
+    report = {'samples': NUM_MC_SAMPLES, 'limit': args.limit, 'seed': args.seed, 'models': {}}
+    for name in args.models:
+        if name == 'classifier':
+            scorer = ClassifierScorer(args.classifier_model, threshold=ENTROPY_THRESHOLD)
+            report['classifier_model'] = file_checksum(args.classifier_model)
+        else:
+            scorer = VAEScorer(args.vae_model)
+            report['vae_model'] = file_checksum(args.vae_model)
+        trees = []
+        for label, root in enumerate((ID_DATA_DIR, OOD_DATA_DIR)):
+            if not os.path.isdir(root):
+                continue
+            dataset = load_cached_dataset(root, scorer.image_size, cache_dir=args.cache_dir)
+            trees.append((dataset, sample_indices(len(dataset), args.limit, args.seed + label), label))
+        report['models'][name] = validate(scorer, trees, args)
+
+    report.update(output=args.output, created=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
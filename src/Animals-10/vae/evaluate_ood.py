@@ -1,17 +1,35 @@
 import torch
-import torch.nn.functional as F
 from torchvision import transforms, datasets
-from model import BayesianVAE
-import matplotlib.pyplot as plt
+from model import BayesianVAE, analytic_scores, bayesian_draw, bayesian_scores
 import numpy as np
 import os
-import csv
+import sys
+import argparse
 from tqdm import tqdm
-from torch.utils.data import DataLoader
-from sklearn.metrics import roc_auc_score, roc_curve, precision_recall_curve, auc
+from torch.utils.data import DataLoader, Subset
+
+# Make the shared src/Animals-10/common package importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import DEFAULT_CACHE_DIR, file_checksum, load_cached_dataset, normalize_batch
+from common.score_store import ScoreStore
+from common.sequential_mc import ElboAccumulator, add_adaptive_args, adaptive_config, sequential_mc
+from common.checkpoint import EvalCheckpoint, add_checkpoint_args, exclude_paths, resolve_run_dir
+from common.profiling import StageProfiler, StartupTimer, add_profiling_args
+from common.weights import load_checkpoint_model
+from common.student import UncertaintyStudent, student_predict
+from common.fast_decode import FastImageLoader, add_fast_decode_args, dataset_paths
+from common.result_sink import add_result_args, export_csv, read_columns
+from common.streaming_metrics import StreamingMetrics, add_metrics_args, labelled_batches, live_metrics_from_args
+from common.autotune import add_autotune_args, resolve_settings
+from common.worker_pool import SharedModelPool, add_pool_args
+from common.file_manifest import add_manifest_args, fan_out, manifest_from_args, split_duplicates, write_groups
+from common.sharding import (add_shard_args, configure_worker, launch_local_shards, merge_shard_sinks,
+                             run_id_from_dir, shard_indices, shard_sink_path, strip_launcher_args)
 
 # --- [Configuration] ---
 MODEL_PATH = '/app/models/Animals-10/vae/vae_final.pth'
+# Distilled single-pass student (pipeline/distill.py), used with --student
+STUDENT_PATH = '/app/models/Animals-10/student/uncertainty_student.pth'
 
 # Point to the full dataset directories
 ID_DATA_DIR = '/app/data/animals'
@@ -19,8 +37,27 @@ OOD_DATA_DIR = '/app/data/pokemon'
 
 # Base directory for all runs
 BASE_RESULT_DIR = '/app/results/Animals-10/vae_full_analysis'
+# Scores shared across runs: (model hash, scoring config, image content hash) -> scores
+SCORE_STORE_PATH = os.path.join(BASE_RESULT_DIR, 'score_store.sqlite')
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Scoring
+IMAGE_SIZE = 64
+NUM_MC_SAMPLES = 30
+# Defaults only: a common/autotune.py result stored for this machine takes precedence
+BATCH_SIZE = 64  # images per batch (each image is expanded to NUM_MC_SAMPLES draws)
+NUM_WORKERS = 4
+
+# Tuning the Alpha
+# This weight determines how much we trust "Uncertainty" vs "Reconstruction Error"
+LATENT_ALPHA = 100.0
+
+# Columns of the per-image result sink (label: 0 = ID, 1 = OOD)
+RESULT_SCHEMA = {'path': 'str', 'label': 'int8', 'score': 'float32', 'elbo': 'float32',
+                 'latent_variance': 'float32', 'mc_samples': 'int16'}
+CSV_HEADER = ['Filename', 'Type', 'Score', 'Path', 'ELBO', 'Latent_Variance', 'MC_Samples']
+TYPE_NAMES = np.array(['ID_Animal', 'OOD_Pokemon'])
+
 
 # --- [New Feature] Directory Management ---
 def get_next_run_dir(base_dir):
@@ -43,6 +80,24 @@ def get_next_run_dir(base_dir):
 
 # --- Helper Classes ---
 class ImageFolderWithPaths(datasets.ImageFolder):
+    def __init__(self, root, transform=None, manifest=None):
+        # With a common.file_manifest.FileManifest the classes and samples come from the
+        # manifest instead of an ImageFolder rescan of the tree
+        self.manifest = manifest
+        super().__init__(root=root, transform=transform)
+
+    def find_classes(self, directory):
+        if self.manifest is None:
+            return super().find_classes(directory)
+        classes = list(self.manifest.classes)
+        return classes, {c: i for i, c in enumerate(classes)}
+
+    def make_dataset(self, directory, class_to_idx, *args, **kwargs):
+        if self.manifest is None:
+            return super().make_dataset(directory, class_to_idx, *args, **kwargs)
+        # ImageFolder only takes images inside a class directory
+        return [(path, label) for path, label, _ in self.manifest.samples if label >= 0]
+
     def __getitem__(self, index):
         original = super(ImageFolderWithPaths, self).__getitem__(index)
         path = self.imgs[index][0]
@@ -51,114 +106,193 @@ class ImageFolderWithPaths(datasets.ImageFolder):
 
 
 class OODSystem:
-    def __init__(self, model_path):
+    def __init__(self, model_path, startup=None, analytic=False, model=None):
         self.device = DEVICE
-        self.model = BayesianVAE().to(self.device)
-
-        if not os.path.exists(model_path):
-            raise FileNotFoundError(f"Model not found at {model_path}")
-
-        state_dict = torch.load(model_path, map_location=self.device)
-        clean_state = {k.replace("_orig_mod.", ""): v for k, v in state_dict.items()}
-        self.model.load_state_dict(clean_state)
+        # analytic: deterministic moment propagation (model.analytic_scores) instead of MC draws
+        self.analytic = analytic
+        # Built on the meta device (no random init) and given the memory-mapped weights;
+        # the first load converts the .pth once (keys without the torch.compile '_orig_mod.' prefix).
+        # `model` wraps an already loaded one instead (the shared weights of a --pool-workers process).
+        self.model = model if model is not None else load_checkpoint_model(BayesianVAE, model_path, self.device,
+                                                                           startup)
         self.model.eval()
 
-    def detect_bayesian(self, img_tensor, samples=30):
-        # [H100 Optimization] Replicate input for batch processing
-        batch = img_tensor.repeat(samples, 1, 1, 1).to(self.device)
-        target = img_tensor.to(self.device).repeat(samples, 1, 1, 1)
-
+    def detect_bayesian_batch(self, images, samples=NUM_MC_SAMPLES):
+        """
+        Scores a batch of B images at once.
+        Returns (expected_elbo, latent_variance, score) tensors of shape [B].
+        """
+        images = images.to(self.device)
+        if images.dtype == torch.uint8:
+            # Tensor cache batches arrive as uint8; equivalent to ToTensor()
+            images = normalize_batch(images)
         with torch.no_grad():
-            recon_batch, mu, logvar = self.model(batch)
-
-        # 1. Negative ELBO (Model Fit)
-        recon_loss = F.mse_loss(recon_batch, target, reduction='none').sum(dim=(1, 2, 3))
-        kld_loss = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp(), dim=1)
-
-        # Expected Value over 30 samples
-        expected_elbo = (recon_loss + kld_loss).mean().item()
-
-        # 2. Epistemic Uncertainty (Model Confusion)
-        # Variance of the latent vector across 30 samples
-        latent_variance = mu.var(dim=0).sum().item()
-
-        # Tuning the Alpha
-        # This weight determines how much we trust "Uncertainty" vs "Reconstruction Error"
-        alpha = 100.0
-
-        return expected_elbo + (latent_variance * alpha)
-
+            if self.analytic:
+                return analytic_scores(self.model, images, alpha=LATENT_ALPHA)
+            return bayesian_scores(self.model, images, samples=samples, alpha=LATENT_ALPHA)
+
+    def detect_bayesian_adaptive(self, images, threshold, adaptive):
+        """
+        Sequential version of detect_bayesian_batch: draws samples in chunks and stops per
+        image once the score is confidently above / below `threshold`.
+        Returns (expected_elbo, latent_variance, score, samples_used) tensors of shape [B].
+        """
+        images = images.to(self.device)
+        if images.dtype == torch.uint8:
+            images = normalize_batch(images)
+        with torch.no_grad():
+            accumulator = ElboAccumulator(images.shape[0], self.model.fc_mu.out_features, self.device,
+                                          alpha=LATENT_ALPHA)
+            score, n_used = sequential_mc(bayesian_draw(self.model, images), accumulator, threshold, **adaptive)
+        expected_elbo, latent_variance, _, _ = accumulator.components()
+        return expected_elbo.float(), latent_variance.float(), score, n_used
 
-def run_full_analysis():
-    # 1. [Modified] Setup Directory using the new function
-    current_run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
+    def detect_bayesian(self, img_tensor, samples=NUM_MC_SAMPLES):
+        _, _, score = self.detect_bayesian_batch(img_tensor[:1], samples=samples)
+        return score.item()
 
-    # All files will now be saved inside 'current_run_dir'
-    csv_path = os.path.join(current_run_dir, f'full_analysis_report_run_{run_id}.csv')
-    roc_plot_path = os.path.join(current_run_dir, f'roc_curve_run_{run_id}.png')
 
-    # 2. Load Full Datasets (No Random Sampling)
-    transform = transforms.Compose([transforms.Resize((64, 64)), transforms.ToTensor()])
-
-    print(f">>> Loading Full ID Dataset from: {ID_DATA_DIR}")
-    # No SubsetRandomSampler -> Loads everything
-    dataset_id = ImageFolderWithPaths(root=ID_DATA_DIR, transform=transform)
-    loader_id = DataLoader(dataset_id, batch_size=1, shuffle=False, num_workers=4)
+class StudentSystem:
+    """
+    Same interface as OODSystem.detect_bayesian_batch, but the expected ELBO, latent variance
+    and score are predicted in one deterministic pass by the distilled student.
+    """
+    def __init__(self, model_path, startup=None, model=None):
+        self.device = DEVICE
+        self.model = model if model is not None else load_checkpoint_model(UncertaintyStudent, model_path,
+                                                                           self.device, startup)
+        self.model.eval()
 
-    print(f">>> Loading Full OOD Dataset from: {OOD_DATA_DIR}")
-    dataset_ood = ImageFolderWithPaths(root=OOD_DATA_DIR, transform=transform)
-    loader_ood = DataLoader(dataset_ood, batch_size=1, shuffle=False, num_workers=4)
-
-    system = OODSystem(MODEL_PATH)
-
-    # Metric Arrays
-    y_true = []  # 0 = ID, 1 = OOD
-    y_scores = []  # Anomaly Scores
-
-    f = open(csv_path, 'w', newline='', encoding='utf-8')
-    writer = csv.writer(f)
-    writer.writerow(['Filename', 'Type', 'Score', 'Path'])
-
-    # --- Processing ID ---
-    print(f"Processing {len(dataset_id)} Animal images...")
-    for img, path, filename in tqdm(loader_id):
-        if img.shape[1] != 3: continue
-        score = system.detect_bayesian(img)
-        y_true.append(0)
-        y_scores.append(score)
-        writer.writerow([filename, 'ID_Animal', f"{score:.4f}", path[0]])
-
-    # --- Processing OOD ---
-    print(f"Processing {len(dataset_ood)} Pokemon images...")
-    for img, path, filename in tqdm(loader_ood):
-        if img.shape[1] != 3: continue
-        score = system.detect_bayesian(img)
-        y_true.append(1)
-        y_scores.append(score)
-        writer.writerow([filename, 'OOD_Pokemon', f"{score:.4f}", path[0]])
-
-    f.close()
+    def detect_bayesian_batch(self, images):
+        images = images.to(self.device)
+        if images.dtype == torch.uint8:
+            images = normalize_batch(images)
+        outputs = student_predict(self.model, images)
+        return outputs['elbo'], outputs['latent_variance'], outputs['vae_score']
+
+
+def score_system(system, images, threshold=None, adaptive=None):
+    """(expected_elbo, latent_variance, score, samples_used) of one batch, for any of the scoring modes."""
+    if adaptive:
+        return system.detect_bayesian_adaptive(images, threshold, adaptive)
+    elbo, latent_var, score = system.detect_bayesian_batch(images)
+    samples = 1 if isinstance(system, StudentSystem) or system.analytic else NUM_MC_SAMPLES
+    return elbo, latent_var, score, torch.full((len(score),), samples, dtype=torch.long)
+
+
+def pool_score(model, images, student, analytic, threshold, adaptive):
+    """Score function of the --pool-workers processes: the shared model wrapped in the matching system."""
+    system = StudentSystem(None, model=model) if student else OODSystem(None, analytic=analytic, model=model)
+    return score_system(system, images, threshold, adaptive)
+
+
+def autotune_scorer(student_path, analytic):
+    """Score function for the autotune probe (runs in a spawned process, so the model is loaded again)."""
+    system = StudentSystem(student_path) if student_path else OODSystem(MODEL_PATH, analytic=analytic)
+    return system.detect_bayesian_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Full-dataset BayesianVAE OOD analysis")
+    parser.add_argument('--cache-dir', nargs='?', const=DEFAULT_CACHE_DIR, default=None,
+                        help=f"Read images from the preprocessed uint8 tensor cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--score-store', nargs='?', const=SCORE_STORE_PATH, default=None,
+                        help=f"Reuse scores of unchanged images across runs (default: {SCORE_STORE_PATH})")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="OOD decision threshold on the combined score (required for --adaptive)")
+    parser.add_argument('--student', nargs='?', const=STUDENT_PATH, default=None,
+                        help=f"Predict the scores with the distilled single-pass student instead of "
+                             f"{NUM_MC_SAMPLES} MC draws (default: {STUDENT_PATH})")
+    parser.add_argument('--analytic', action='store_true',
+                        help=f"Propagate the dropout moments through the model in one deterministic pass "
+                             f"instead of {NUM_MC_SAMPLES} MC draws (pipeline/validate_analytic.py compares the two)")
+    add_adaptive_args(parser, max_samples=NUM_MC_SAMPLES)
+    add_shard_args(parser)
+    add_checkpoint_args(parser)
+    add_profiling_args(parser)
+    add_result_args(parser)
+    add_metrics_args(parser)
+    add_fast_decode_args(parser)
+    add_autotune_args(parser, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS)
+    add_pool_args(parser)
+    add_manifest_args(parser)
+    args = parser.parse_args()
+    if args.adaptive and args.threshold is None:
+        parser.error("--adaptive needs --threshold to decide when an image is clearly ID or OOD")
+    if args.adaptive and args.student:
+        parser.error("--adaptive and --student are alternatives (the student does not sample)")
+    if args.analytic and (args.adaptive or args.student):
+        parser.error("--analytic does not sample and cannot be combined with --adaptive or --student")
+    if args.early_stop is not None and args.metrics_every <= 0:
+        parser.error("--early-stop needs live metrics (--metrics-every > 0)")
+    if args.fast_decode and args.cache_dir:
+        parser.error("--fast-decode and --cache-dir are alternatives (the cache is already decoded)")
+    if args.pool_workers > 1 and DEVICE.type != 'cpu':
+        parser.error("--pool-workers shares the weights between CPU processes; a GPU scores in one process")
+    return args
+
+
+def split_by_score_store(dataset, score_store):
+    """
+    Returns (dataset of images that still need scoring, [(path, filename, stored values), ...]).
+    """
+    if score_store is None:
+        return dataset, []
+    # Sharded runs pass a Subset of the full dataset
+    if isinstance(dataset, Subset):
+        base, indices = dataset.dataset, list(dataset.indices)
+    else:
+        base, indices = dataset, list(range(len(dataset)))
+    paths = [base.samples[i][0] for i in indices]
+    hits, misses = score_store.partition(paths)
+    stored = [(paths[i], os.path.basename(paths[i]), hits[i]) for i in sorted(hits)]
+    print(f">>> [Score Store] {len(stored)} reused, {len(misses)} to score")
+    return Subset(base, [indices[i] for i in misses]), stored
+
+
+def csv_columns(chunk):
+    """Result sink chunk -> the columns of the CSV report."""
+    return [[os.path.basename(p) for p in chunk['path']], TYPE_NAMES[chunk['label']].tolist(),
+            np.char.mod('%.4f', chunk['score']).tolist(), chunk['path'].tolist(),
+            np.char.mod('%.4f', chunk['elbo']).tolist(), np.char.mod('%.6f', chunk['latent_variance']).tolist(),
+            chunk['mc_samples'].tolist()]
+
+
+def write_metrics(run_dir, run_id, sink_dir):
+    """AUROC / AUPR summary and ROC curve for one (possibly merged) run, read from its result sink."""
+    roc_plot_path = os.path.join(run_dir, f'roc_curve_run_{run_id}.png')
+    # only the numeric columns needed for the metrics are loaded
+    columns = read_columns(sink_dir, ['label', 'score', 'mc_samples'])
+    y_true, y_scores, sample_counts = columns['label'], columns['score'], columns['mc_samples']
 
     # --- Advanced Metrics (AUROC) ---
     print("\n>>> Calculating OOD Performance Metrics...")
 
+    # One exact threshold sweep (same numbers as sklearn) gives:
     # AUROC: The probability that a random OOD image has a higher score than a random ID image.
-    auroc = roc_auc_score(y_true, y_scores)
-
     # AUPR: Area Under Precision-Recall Curve (Good if datasets are imbalanced)
-    precision, recall, _ = precision_recall_curve(y_true, y_scores)
-    pr_auc = auc(recall, precision)
+    # FPR at 95% TPR and the threshold maximizing TPR - FPR
+    sweep = StreamingMetrics(exact=True)
+    sweep.update(y_scores, y_true)
+    operating = sweep.summary()
+    auroc, pr_auc = operating['auroc'], operating['aupr']
 
     print(f"==========================================")
     print(f" Run ID:                 {run_id}")
     print(f" Total Images Scanned:   {len(y_true)}")
     print(f" AUROC Score (Accuracy): {auroc:.5f} (Target: > 0.95)")
     print(f" AUPR Score:             {pr_auc:.5f}")
-    print(f" Saved Results to:       {current_run_dir}")
+    print(f" FPR @ 95% TPR:          {operating['fpr_at_95_tpr']:.5f}")
+    print(f" Best Threshold:         {operating['best_threshold']:.4f} "
+          f"(TPR {operating['best_tpr']:.4f}, FPR {operating['best_fpr']:.4f})")
+    print(f" Mean MC Samples/Image:  {np.mean(sample_counts):.1f}")
+    print(f" Saved Results to:       {run_dir}")
     print(f"==========================================")
 
-    # Plot ROC Curve
-    fpr, tpr, _ = roc_curve(y_true, y_scores)
+    # Plot ROC Curve (matplotlib is only imported here, it is not needed to start scoring)
+    import matplotlib.pyplot as plt
+    _, tp, fp = sweep.curve()
+    fpr, tpr = fp / fp[-1], tp / tp[-1]
     plt.figure(figsize=(8, 6))
     plt.plot(fpr, tpr, color='darkorange', lw=2, label=f'AUROC = {auroc:.3f}')
     plt.plot([0, 1], [0, 1], color='navy', lw=2, linestyle='--')
@@ -173,5 +307,252 @@ def run_full_analysis():
     print(f"Saved ROC Curve to {roc_plot_path}")
 
 
+def finish_run(run_dir, run_id, sink_dir, export):
+    write_metrics(run_dir, run_id, sink_dir)
+    if export:
+        export_csv(sink_dir, os.path.normpath(sink_dir) + '.csv', CSV_HEADER, csv_columns)
+
+
+# --- Sharded runs: merge the part sinks into the usual report ---
+def merge_run(run_dir, export=False):
+    run_id = run_id_from_dir(run_dir)
+    sink_dir = os.path.join(run_dir, f'full_analysis_report_run_{run_id}')
+    chunks = merge_shard_sinks(run_dir, sink_dir)
+    print(f">>> Merged {chunks} shard chunks into {sink_dir}")
+    finish_run(run_dir, run_id, sink_dir, export)
+
+
+def run_full_analysis(args):
+    startup = StartupTimer()
+    configure_worker(args.threads, args.cpus)
+
+    if args.merge:
+        merge_run(args.merge, args.export_csv)
+        return
+
+    if args.workers > 1:
+        # Local shard processes, each pinned to its own CPU set, then one merge
+        # (--resume is passed through, so every shard continues from its own checkpoint)
+        if args.resume:
+            current_run_dir = resolve_run_dir(BASE_RESULT_DIR, args.resume)
+        else:
+            current_run_dir, _ = get_next_run_dir(BASE_RESULT_DIR)
+        launch_local_shards(os.path.abspath(__file__), strip_launcher_args(sys.argv[1:]),
+                            args.workers, current_run_dir, args.threads)
+        merge_run(current_run_dir, args.export_csv)
+        return
+
+    # 1. [Modified] Setup Directory using the new function (or a shared one for multi-node shards,
+    #    or the interrupted run being resumed)
+    if args.run_dir:
+        current_run_dir, run_id = args.run_dir, run_id_from_dir(args.run_dir)
+        os.makedirs(current_run_dir, exist_ok=True)
+    elif args.resume:
+        current_run_dir = resolve_run_dir(BASE_RESULT_DIR, args.resume)
+        run_id = run_id_from_dir(current_run_dir)
+    else:
+        current_run_dir, run_id = get_next_run_dir(BASE_RESULT_DIR)
+
+    # All files will now be saved inside 'current_run_dir'
+    sharded = args.num_shards > 1
+    if sharded:
+        sink_dir = shard_sink_path(current_run_dir, args.num_shards, args.shard_index)
+    else:
+        sink_dir = os.path.join(current_run_dir, f'full_analysis_report_run_{run_id}')
+
+    # 2. Load Full Datasets (No Random Sampling)
+    transform = transforms.Compose([transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)), transforms.ToTensor()])
+
+    # --manifest / --dedup: file lists, sizes, mtimes and content / perceptual hashes come from the
+    # incrementally updated file manifest instead of a walk over the tree
+    print(f">>> Loading Full ID Dataset from: {ID_DATA_DIR}")
+    manifest_id = manifest_from_args(args, ID_DATA_DIR)
+    # No SubsetRandomSampler -> Loads everything
+    if args.cache_dir:
+        # root_files=False: like ImageFolderWithPaths, only images inside a class directory are scored
+        dataset_id = load_cached_dataset(ID_DATA_DIR, IMAGE_SIZE, cache_dir=args.cache_dir, manifest=manifest_id,
+                                         root_files=False)
+    else:
+        dataset_id = ImageFolderWithPaths(root=ID_DATA_DIR, transform=transform, manifest=manifest_id)
+
+    print(f">>> Loading Full OOD Dataset from: {OOD_DATA_DIR}")
+    manifest_ood = manifest_from_args(args, OOD_DATA_DIR)
+    if args.cache_dir:
+        dataset_ood = load_cached_dataset(OOD_DATA_DIR, IMAGE_SIZE, cache_dir=args.cache_dir,
+                                          manifest=manifest_ood, root_files=False)
+    else:
+        dataset_ood = ImageFolderWithPaths(root=OOD_DATA_DIR, transform=transform, manifest=manifest_ood)
+
+    # Batch size / threads / DataLoader workers: flags > autotune result stored for this host > a fresh probe.
+    # Shard processes only reuse stored results, so shards on one machine never probe at the same time.
+    mode = 'student' if args.student else 'analytic' if args.analytic else 'adaptive' if args.adaptive else 'mc'
+    source = 'cache' if args.cache_dir else 'fast_decode' if args.fast_decode else 'decode'
+    settings = resolve_settings(args, f"vae/{mode}/{source}", autotune_scorer, (args.student, args.analytic),
+                                dataset_id, DEVICE, probe_loader=not args.fast_decode, allow_probe=not sharded)
+
+    if sharded:
+        # Each shard owns a deterministic contiguous slice of the sorted file lists
+        dataset_id = Subset(dataset_id, shard_indices(len(dataset_id), args.num_shards, args.shard_index))
+        dataset_ood = Subset(dataset_ood, shard_indices(len(dataset_ood), args.num_shards, args.shard_index))
+
+    if args.student:
+        print(f">>> Using distilled student: {args.student}")
+        system = StudentSystem(args.student, startup)
+    else:
+        system = OODSystem(MODEL_PATH, startup, analytic=args.analytic)
+
+    # Images already written before the last checkpoint are not scored again
+    checkpoint = EvalCheckpoint(sink_dir, args.checkpoint_every, resume=args.resume is not None)
+    dataset_id = exclude_paths(dataset_id, checkpoint.done)
+    dataset_ood = exclude_paths(dataset_ood, checkpoint.done)
+
+    # --dedup: one representative per duplicate cluster is scored; its result is copied to the
+    # other members when the rows are written
+    dataset_id, groups_id = split_duplicates(dataset_id, manifest_id, args.dedup, args.dedup_distance)
+    dataset_ood, groups_ood = split_duplicates(dataset_ood, manifest_ood, args.dedup, args.dedup_distance)
+    duplicates = {**groups_id, **groups_ood}
+    if duplicates:
+        write_groups(os.path.join(current_run_dir, f"part_{args.shard_index:03d}_duplicate_groups.json" if sharded
+                                  else 'duplicate_groups.json'), duplicates)
+
+    # Only images without a stored score for this checkpoint + config go through the model
+    adaptive = adaptive_config(args) if args.adaptive else None
+    score_store = None
+    if args.score_store:
+        store_config = {'scorer': 'bayesian_vae', 'samples': NUM_MC_SAMPLES, 'alpha': LATENT_ALPHA,
+                        'image_size': IMAGE_SIZE}
+        if args.student:
+            store_config = {'scorer': 'student', 'student': file_checksum(args.student), 'image_size': IMAGE_SIZE}
+        if args.analytic:
+            store_config = {'scorer': 'bayesian_vae', 'mode': 'analytic', 'alpha': LATENT_ALPHA,
+                            'image_size': IMAGE_SIZE}
+        if adaptive:
+            store_config.update(adaptive=adaptive, threshold=args.threshold)
+        if args.fast_decode:
+            # draft-mode inputs differ slightly from a full decode, so their scores are kept apart
+            store_config.update(decode='draft')
+        score_store = ScoreStore(args.score_store, MODEL_PATH, store_config)
+        for manifest in (manifest_id, manifest_ood):
+            if manifest is not None:
+                # The manifest already holds every image's SHA-1 (no stat / read per image)
+                score_store.seed_hashes(manifest.hashes())
+    dataset_id, stored_id = split_by_score_store(dataset_id, score_store)
+    dataset_ood, stored_ood = split_by_score_store(dataset_ood, score_store)
+
+    if args.fast_decode:
+        # Reduced-size JPEG decoding on threads, uint8 batches (normalized in detect_bayesian_*)
+        loader_id = FastImageLoader(dataset_paths(dataset_id), IMAGE_SIZE, settings['batch_size'],
+                                    args.decode_threads)
+        loader_ood = FastImageLoader(dataset_paths(dataset_ood), IMAGE_SIZE, settings['batch_size'],
+                                     args.decode_threads)
+    else:
+        loader_id = DataLoader(dataset_id, batch_size=settings['batch_size'], shuffle=False,
+                               num_workers=settings['num_workers'])
+        loader_ood = DataLoader(dataset_ood, batch_size=settings['batch_size'], shuffle=False,
+                                num_workers=settings['num_workers'])
+
+    # Typed per-image columns, written in chunks; a resumed sink is cut back to the last checkpoint
+    # (metrics are computed from the sink at the end, so nothing is kept in Python lists)
+    sink = checkpoint.open_sink(RESULT_SCHEMA)
+    checkpoint.restore_rng()
+
+    # Opt-in per-stage timers / counters (--profile), exported into the run directory
+    profiler = StageProfiler(args.profile, current_run_dir, DEVICE, interval=args.profile_interval,
+                             prefix=f"part_{args.shard_index:03d}_" if sharded else '',
+                             torch_profile=args.torch_profile)
+
+    # Live AUROC / AUPR / FPR@95TPR on fixed-memory histograms (--metrics-every), optional early stop
+    prefix = f"part_{args.shard_index:03d}_" if sharded else ''
+    live = live_metrics_from_args(args, os.path.join(current_run_dir, f'{prefix}live_metrics.json'), profiler)
+    live.resume_from(sink_dir)
+
+    # Reused scores are written without touching the model
+    for stored, label in ((stored_id, 0), (stored_ood, 1)):
+        if stored:
+            paths, values = fan_out(duplicates, [path for path, _, _ in stored], [v for _, _, v in stored])
+            scores = [v['score'] for v in values]
+            sink.append(path=paths, label=np.full(len(paths), label),
+                        score=scores, elbo=[v['elbo'] for v in values],
+                        latent_variance=[v['latent_variance'] for v in values],
+                        mc_samples=[v.get('samples', NUM_MC_SAMPLES) for v in values])
+            live.update(scores, label)
+            checkpoint.update(paths)
+
+    # --pool-workers: the weights go into shared memory once and N spawned workers score
+    # batches from one queue, each attached to those pages read-only
+    pool = None
+    if args.pool_workers > 1:
+        pool = SharedModelPool(system.model, pool_score, args.pool_workers, threads=args.pool_threads,
+                               args=(bool(args.student), args.analytic, args.threshold, adaptive))
+
+    startup.report(profiler)
+
+    # --- Processing ID / OOD ---
+    # (interleaved with --early-stop, so the live metrics see both classes from the start)
+    print(f"Processing {len(dataset_id)} Animal and {len(dataset_ood)} Pokemon images...")
+    batches = labelled_batches([loader_id, loader_ood], live.interleaved)
+
+    def scored():
+        """(label, paths, (elbo, latent_var, score, samples_used)) per batch, in loader order."""
+        # profiler.iterate times how long each batch waits on the DataLoader (data_wait)
+        batch_iter = profiler.iterate(tqdm(batches, total=len(loader_id) + len(loader_ood)))
+        if pool is not None:
+            items = (((label, paths), imgs) for label, (imgs, paths, _) in batch_iter if imgs.shape[1] == 3)
+            for (label, paths), outputs in pool.map(items):
+                yield label, paths, outputs
+            return
+        for label, (imgs, paths, _) in batch_iter:
+            if imgs.shape[1] != 3: continue
+            with profiler.stage('h2d'):
+                imgs = imgs.to(system.device)
+            with profiler.stage('mc_forward'):
+                outputs = score_system(system, imgs, args.threshold, adaptive)
+            yield label, paths, outputs
+
+    for label, paths, (elbo, latent_var, score, n_used) in scored():
+        with profiler.stage('d2h'):
+            batch_samples = n_used.cpu().numpy()
+            batch_scores = score.cpu().numpy()
+            batch_elbo = elbo.cpu().numpy()
+            batch_var = latent_var.cpu().numpy()
+
+        with profiler.stage('result_write'):
+            # Members of a duplicate cluster get their representative's row (--dedup)
+            written, *columns = fan_out(duplicates, paths, batch_scores, batch_elbo, batch_var, batch_samples)
+            sink.append(path=written, label=np.full(len(written), label), score=columns[0],
+                        elbo=columns[1], latent_variance=columns[2], mc_samples=columns[3])
+        live.update(columns[0], label)
+        if score_store is not None:
+            with profiler.stage('score_store'):
+                for i in range(len(batch_scores)):
+                    score_store.put(paths[i], {'score': float(batch_scores[i]), 'elbo': float(batch_elbo[i]),
+                                               'latent_variance': float(batch_var[i]),
+                                               'samples': int(batch_samples[i])})
+                score_store.commit()
+        with profiler.stage('checkpoint'):
+            checkpoint.update(written)
+
+        profiler.count('images', len(batch_scores))
+        profiler.count('mc_samples', int(batch_samples.sum()))
+        profiler.step()
+        if live.step():
+            break
+    if pool is not None:
+        # Per-worker peak RSS / PSS / private memory (also profiler gauges with --profile)
+        pool.report(profiler)
+    live.finish()
+
+    checkpoint.close()
+    if score_store is not None:
+        score_store.close()
+    profiler.finish()
+
+    if sharded:
+        print(f"\n>>> Shard {args.shard_index + 1}/{args.num_shards} saved to: {sink_dir}")
+        return
+
+    finish_run(current_run_dir, run_id, sink_dir, args.export_csv)
+
+
 if __name__ == "__main__":
-    run_full_analysis()
\ No newline at end of file
+    run_full_analysis(parse_args())
\ No newline at end of file
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+DROPOUT_P = 0.2  # MC Dropout rate on the encoder features (always active)
+
 
 class BayesianVAE(nn.Module):
     def __init__(self, latent_dim=128):
@@ -32,12 +34,15 @@ class BayesianVAE(nn.Module):
         eps = torch.randn_like(std)
         return mu + eps * std
 
-    def forward(self, x):
-        x = self.encoder_conv(x)
+    def encode_features(self, x):
+        """Deterministic part of the encoder: conv stack -> flattened 8192-d features."""
+        return self.encoder_conv(x)
 
+    def forward_features(self, x):
+        """Stochastic part: dropout -> (mu, logvar) -> reparameterize -> decoder."""
         # [System Key] MC Dropout 강제 활성화 (training=True)
         # eval()을 호출해도 이 라인은 항상 Dropout을 수행합니다.
-        x = F.dropout(x, p=0.2, training=True)
+        x = F.dropout(x, p=DROPOUT_P, training=True)
 
         mu = self.fc_mu(x)
         logvar = self.fc_logvar(x)
@@ -49,6 +54,94 @@ class BayesianVAE(nn.Module):
         reconstruction = self.decoder(x_recon)
         return reconstruction, mu, logvar
 
+    def forward(self, x):
+        return self.forward_features(self.encode_features(x))
+
+
+def bayesian_draws(model, features, images, samples):
+    """
+    Runs the stochastic part S times for B images from their cached encoder features.
+    Returns per-draw negative ELBO [S, B] and latent mean mu [S, B, D].
+    """
+    batch_size = images.shape[0]
+    features = features.unsqueeze(0).expand(samples, -1, -1).reshape(samples * batch_size, -1)
+    recon, mu, logvar = model.forward_features(features)
+
+    recon = recon.view(samples, batch_size, *images.shape[1:])
+    recon_loss = (recon - images.unsqueeze(0)).pow(2).sum(dim=(2, 3, 4))
+    mu = mu.view(samples, batch_size, -1)
+    logvar = logvar.view(samples, batch_size, -1)
+    kld_loss = -0.5 * torch.sum(1 + logvar - mu.pow(2) - logvar.exp(), dim=2)
+    return recon_loss + kld_loss, mu
+
+
+def bayesian_draw(model, images):
+    """
+    Draw function for adaptive (sequential) sampling: draw(active_mask, n) -> (elbo [n, A], mu [n, A, D]).
+    The encoder features are computed once up front and reused for every chunk.
+    """
+    features = model.encode_features(images)
+    return lambda active, n: bayesian_draws(model, features[active], images[active], n)
+
+
+def bayesian_scores(model, images, samples=30, alpha=100.0):
+    """
+    Batched MC scoring for B images.
+
+    The conv encoder runs once per image; only the flattened features are
+    expanded to [S * B] for the stochastic dropout / sampling / decoding part.
+    Returns per-image tensors (expected negative ELBO, latent variance, combined score).
+    """
+    features = model.encode_features(images)
+    elbo, mu = bayesian_draws(model, features, images, samples)
+
+    # 1. Negative ELBO (Model Fit), averaged over the S samples of each image
+    expected_elbo = elbo.mean(dim=0)
+
+    # 2. Epistemic Uncertainty (Model Confusion): variance of mu across the S samples
+    latent_variance = mu.var(dim=0).sum(dim=1)
+
+    return expected_elbo, latent_variance, expected_elbo + latent_variance * alpha
+
+
+def analytic_moments(linear, x, p=DROPOUT_P):
+    """
+    Mean and per-output variance [B, out] of linear(dropout(x, p)) without sampling.
+    With masks m ~ Bernoulli(1 - p) and x / (1 - p) scaling:
+        mean     = W x + b
+        variance = (W * W) (x * x) * p / (1 - p)
+    """
+    mean = linear(x)
+    variance = F.linear(x.pow(2) * (p / (1.0 - p)), linear.weight.pow(2))
+    return mean, variance
+
+
+def analytic_scores(model, images, alpha=100.0):
+    """
+    Deterministic moment-propagation counterpart of bayesian_scores(): one pass, no sampling.
+
+    - latent variance: exact expected variance of mu under the dropout masks
+      (the sum of the per-dimension variances from analytic_moments).
+    - KL term: exact in mu (E[mu^2] = mean^2 + var); E[exp(logvar)] assumes a
+      Gaussian logvar, exp(mean + var / 2).
+    - reconstruction term: first order, the decoder runs once at the mean latent
+      instead of averaging over dropout masks and reparameterization noise, so it
+      leaves out the decoder's curvature. pipeline/validate_analytic.py measures
+      the resulting difference to the 30-sample MC scores.
+    Returns per-image tensors (expected negative ELBO, latent variance, combined score).
+    """
+    features = model.encode_features(images)
+    mu_mean, mu_var = analytic_moments(model.fc_mu, features)
+    logvar_mean, logvar_var = analytic_moments(model.fc_logvar, features)
+
+    recon = model.decoder(model.decoder_input(mu_mean))
+    recon_loss = (recon - images).pow(2).sum(dim=(1, 2, 3))
+    kld_loss = -0.5 * torch.sum(1 + logvar_mean - (mu_mean.pow(2) + mu_var) - torch.exp(logvar_mean + 0.5 * logvar_var),
+                                dim=1)
+    expected_elbo = recon_loss + kld_loss
+    latent_variance = mu_var.sum(dim=1)
+    return expected_elbo, latent_variance, expected_elbo + latent_variance * alpha
+
 
 def vae_loss_function(recon_x, x, mu, logvar):
     BCE = F.mse_loss(recon_x, x, reduction='sum')
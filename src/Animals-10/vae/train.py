@@ -1,9 +1,15 @@
 import torch
 import torch.optim as optim
-from torch.utils.data import DataLoader
 from torchvision import datasets, transforms
 from model import BayesianVAE, vae_loss_function
 import os
+import sys
+import argparse
+
+# Make the shared src/Animals-10/common package importable
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tensor_cache import load_cached_dataset, normalize_batch
+from common.train_engine import TrainEngine, add_train_args, checkpoint_path, train_loader
 
 # --- [설정] ---
 DATA_PATH = '/app/data/animals'
@@ -13,11 +19,28 @@ MODEL_SAVE_PATH = '/app/models/Animals-10/vae/vae_final.pth'
 
 BATCH_SIZE = 256
 NUM_EPOCHS = 50
+IMAGE_SIZE = 64
+NUM_WORKERS = 8  # DataLoader workers for --no-cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train the BayesianVAE on Animals-10")
+    add_train_args(parser, epochs=NUM_EPOCHS, batch_size=BATCH_SIZE)
+    parser.add_argument('--compile', choices=['auto', 'on', 'off'], default='auto',
+                        help="torch.compile the model (auto: on CUDA only, compilation dominates short CPU runs)")
+    return parser.parse_args()
+
 
+def elbo_loss(model, images, labels):
+    recon, mu, logvar = model(images)
+    return vae_loss_function(recon, images, mu, logvar)
 
-def train():
+
+def train(args):
     # [H100 Optimization]
     torch.set_float32_matmul_precision('high')
+    if args.threads:
+        torch.set_num_threads(args.threads)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"Using device: {device}")
 
@@ -31,36 +54,34 @@ def train():
         os.makedirs(save_dir, exist_ok=True)
         print(f"Created directory: {save_dir}")
 
-    transform = transforms.Compose([transforms.Resize((64, 64)), transforms.ToTensor()])
-    dataset = datasets.ImageFolder(root=DATA_PATH, transform=transform)
-    dataloader = DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=8, pin_memory=True)
+    # Default: uint8 batches straight from the tensor cache (decoded once); --no-cache decodes every epoch
+    transform = transforms.Compose([transforms.Resize((IMAGE_SIZE, IMAGE_SIZE)), transforms.ToTensor()])
+    if args.no_cache:
+        dataset = datasets.ImageFolder(root=DATA_PATH, transform=transform)
+    else:
+        dataset = load_cached_dataset(DATA_PATH, IMAGE_SIZE, cache_dir=args.cache_dir, return_paths=False)
+    dataloader = train_loader(dataset, args.batch_size, seed=args.seed, num_workers=NUM_WORKERS,
+                              pin_memory=device.type == 'cuda')
 
-    model = BayesianVAE().to(device)
-    model = torch.compile(model)
+    model = BayesianVAE()
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
 
-    print(">>> H100 학습 시작...")
-    model.train()
-    for epoch in range(NUM_EPOCHS):
-        total_loss = 0
-        for data, _ in dataloader:
-            data = data.to(device)
-            optimizer.zero_grad()
-
-            # [H100] BF16 Mixed Precision
-            with torch.amp.autocast(device_type='cuda', dtype=torch.bfloat16):
-                recon, mu, logvar = model(data)
-                loss = vae_loss_function(recon, data, mu, logvar)
-
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item()
+    # BF16 autocast wherever supported (CUDA or AVX512-BF16 / AMX CPUs), channels_last, per-epoch checkpoints.
+    # The checkpoint and the saved weights come from the uncompiled module (no '_orig_mod.' key prefix).
+    use_compile = args.compile == 'on' or (args.compile == 'auto' and device.type == 'cuda')
+    engine = TrainEngine(model, optimizer, elbo_loss, device, checkpoint_path(MODEL_SAVE_PATH),
+                         normalize=normalize_batch, loss_reduction='sum', precision=args.precision,
+                         channels_last=not args.no_channels_last, compile=use_compile,
+                         checkpoint_every=args.checkpoint_every, seed=args.seed,
+                         config={'batch_size': args.batch_size, 'image_size': IMAGE_SIZE})
+    start_epoch = engine.resume() if args.resume else 0
 
-        print(f"Epoch {epoch + 1}/{NUM_EPOCHS}: Loss {total_loss / len(dataset):.4f}")
+    print(">>> 학습 시작...")
+    engine.fit(dataloader, args.epochs, start_epoch)
 
-    torch.save(model.state_dict(), MODEL_SAVE_PATH)
+    engine.save_model(MODEL_SAVE_PATH)
     print(f">>> 모델 저장 완료: {MODEL_SAVE_PATH}")
 
 
 if __name__ == "__main__":
-    train()
\ No newline at end of file
+    train(parse_args())
\ No newline at end of file